@@ -43,8 +43,10 @@ from kb.file_ops import (
 from kb.rename_manager import ensure_state_defaults as ensure_rename_manager_state
 from kb.rename_manager import render_panel as render_rename_manager_panel
 from kb.rename_manager import render_prompt as render_rename_prompt
+from kb.disk_cache import layered_cache
+from kb.lru_cache import CacheBuckets, new_runtime_cache
 from kb.retriever import BM25Retriever
-from kb.store import load_all_chunks
+from kb.retriever_registry import get_shared_retriever
 from kb.retrieval_engine import configure_cache as configure_retrieval_cache
 from kb.task_runtime import _bg_cancel_all, _bg_enqueue, _bg_ensure_started, _bg_remove_queued_tasks_for_pdf, _bg_snapshot, _build_bg_task, _gen_get_task, _gen_mark_cancel, _gen_start_task, _is_live_assistant_text, _live_assistant_task_id, _live_assistant_text
 
@@ -104,32 +106,23 @@ if not hasattr(RUNTIME, "GEN_TASKS"):
 
 # Background conversion queue state is kept in an imported module.
 # This survives Streamlit reruns more reliably than script-level globals.
-_CACHE_LOCK = RUNTIME.CACHE_LOCK
+if not isinstance(getattr(RUNTIME, "CACHE", None), CacheBuckets):
+    # Older runtime_state kept plain dicts per bucket.
+    RUNTIME.CACHE = new_runtime_cache()
 _CACHE = RUNTIME.CACHE
 
 
 def _cache_get(bucket: str, key: str):
-    with _CACHE_LOCK:
-        d = _CACHE.get(bucket) or {}
-        return d.get(key)
+    return _CACHE.get(bucket, key)
 
 
 def _cache_set(bucket: str, key: str, val, *, max_items: int = 600) -> None:
-    with _CACHE_LOCK:
-        d = _CACHE.setdefault(bucket, {})
-        d[key] = val
-        # Simple bound to avoid unbounded growth.
-        if len(d) > int(max_items):
-            try:
-                # Drop about half (oldest insertion order in Py>=3.7 dict).
-                for k in list(d.keys())[: max(1, len(d) // 2)]:
-                    d.pop(k, None)
-            except Exception:
-                d.clear()
-
+    # One LRU per bucket, bounded by max_items.
+    _CACHE.set(bucket, key, val, max_items=max_items)
 
 
-configure_retrieval_cache(_cache_get, _cache_set)
+# trans/rerank/refs_pack/deep_read also persist under the DB dir of the task using them (kb/disk_cache.py, kb/db_scope.py).
+configure_retrieval_cache(*layered_cache(_cache_get, _cache_set))
 
 
 
@@ -185,11 +178,6 @@ configure_retrieval_cache(_cache_get, _cache_set)
 
 
 
-
-
-def _load_retriever(db_dir: Path) -> BM25Retriever:
-    chunks = load_all_chunks(db_dir)
-    return BM25Retriever(chunks)
 
 
 def _render_kb_empty_hint(*, compact: bool = False) -> None:
@@ -320,6 +308,56 @@ def _split_kb_miss_notice(text: str) -> tuple[str, str]:
 
 
 
+# Chat history is read in keyset pages, newest first; older pages are loaded on demand.
+_CHAT_PAGE_MSGS = 40
+
+
+def _load_chat_window(chat_store: ChatStore, conv_id: str) -> list[dict]:
+    """
+    Newest messages of conv_id: one page, or as many as "load older" has extended it to.
+    Sets _chat_msgs_has_older when the conversation goes further back.
+    """
+    if str(st.session_state.get("_chat_msgs_limit_conv") or "") != conv_id:
+        st.session_state["_chat_msgs_limit_conv"] = conv_id
+        st.session_state["_chat_msgs_limit"] = _CHAT_PAGE_MSGS
+    try:
+        limit = max(_CHAT_PAGE_MSGS, int(st.session_state.get("_chat_msgs_limit") or 0))
+    except Exception:
+        limit = _CHAT_PAGE_MSGS
+    try:
+        msgs = chat_store.get_messages_before(conv_id, None, limit + 1)
+    except Exception:
+        msgs = []
+    st.session_state["_chat_msgs_has_older"] = len(msgs) > limit
+    return msgs[-limit:]
+
+
+def _load_older_chat_page(chat_store: ChatStore, conv_id: str, msgs: list[dict]) -> list[dict]:
+    """Prepend the page before the oldest loaded message (and the refs of its user turns)."""
+    try:
+        oldest = min(int(m.get("id") or 0) for m in msgs) if msgs else 0
+    except Exception:
+        oldest = 0
+    if oldest <= 0:
+        return msgs
+    try:
+        older = chat_store.get_messages_before(conv_id, oldest, _CHAT_PAGE_MSGS + 1)
+    except Exception:
+        return msgs
+    st.session_state["_chat_msgs_has_older"] = len(older) > _CHAT_PAGE_MSGS
+    older = older[-_CHAT_PAGE_MSGS:]
+    merged = older + list(msgs)
+    st.session_state["messages"] = merged
+    st.session_state["_chat_msgs_limit"] = len(merged)
+    refs = st.session_state.get("_chat_refs_cache")
+    if isinstance(refs, dict):
+        try:
+            refs.update(chat_store.list_message_refs_for_ids(int(m.get("id") or 0) for m in older if m.get("role") == "user"))
+        except Exception:
+            pass
+    return merged
+
+
 def _page_chat(
     settings,
     chat_store: ChatStore,
@@ -366,10 +404,7 @@ def _page_chat(
         or (not isinstance(st.session_state.get("messages"), list))
     )
     if need_refresh_msgs:
-        try:
-            st.session_state["messages"] = chat_store.get_messages(conv_id)
-        except Exception:
-            st.session_state["messages"] = []
+        st.session_state["messages"] = _load_chat_window(chat_store, conv_id)
         st.session_state["_chat_msgs_cache_conv"] = conv_id
     msgs = list(st.session_state.get("messages") or [])
 
@@ -381,7 +416,8 @@ def _page_chat(
     )
     if need_refresh_refs:
         try:
-            st.session_state["_chat_refs_cache"] = chat_store.list_message_refs(conv_id) or {}
+            visible_user_ids = [int(m.get("id") or 0) for m in msgs if m.get("role") == "user"]
+            st.session_state["_chat_refs_cache"] = chat_store.list_message_refs_for_ids(visible_user_ids) or {}
         except Exception:
             st.session_state["_chat_refs_cache"] = {}
         st.session_state["_chat_refs_cache_conv"] = conv_id
@@ -422,6 +458,10 @@ def _page_chat(
     if (not msgs) and (not running_for_conv):
         st.markdown(f"<div class='chat-empty-state'>{html.escape(S['no_msgs'])}</div>", unsafe_allow_html=True)
     else:
+        if (not running_for_conv) and bool(st.session_state.get("_chat_msgs_has_older")):
+            if st.button(S["load_older"], key=f"load_older_{conv_id}"):
+                msgs = _load_older_chat_page(chat_store, conv_id, msgs)
+                refs_by_user = st.session_state.get("_chat_refs_cache") or {}
         render_msgs = list(msgs)
         hidden_msgs = 0
         if running_for_conv:
@@ -540,7 +580,7 @@ def _page_chat(
             except Exception:
                 assistant_msg_id = 0
             chat_store.set_title_if_default(conv_id, txt)
-            st.session_state["messages"] = chat_store.get_messages(conv_id)
+            st.session_state["messages"] = _load_chat_window(chat_store, conv_id)
 
             ok = _gen_start_task(
                 {
@@ -1442,6 +1482,16 @@ def main() -> None:
             save_prefs(prefs_path, prefs_knobs)
             prefs.update(prefs_knobs)
 
+        with st.expander(S["cache_stats"], expanded=False):
+            for name, bs in sorted(_CACHE.stats().items()):
+                hits, misses = int(bs.get("hits") or 0), int(bs.get("misses") or 0)
+                rate = (100.0 * hits / (hits + misses)) if (hits + misses) else 0.0
+                size = f" · {int(bs['bytes']) / (1024 * 1024):.1f} MB" if bs.get("bytes") is not None else ""
+                st.caption(
+                    f"{name}: {int(bs.get('items') or 0)} items{size} · "
+                    f"hit {hits} / miss {misses} ({rate:.0f}%) · evict {int(bs.get('evictions') or 0)}"
+                )
+
         st.markdown("<div class='hr'></div>", unsafe_allow_html=True)
         st.subheader("模型/Key")
         try:
@@ -1474,12 +1524,40 @@ def main() -> None:
         if st.button(S["new_chat"], key="new_chat"):
             st.session_state["conv_id"] = chat_store.create_conversation()
 
+        search_q = st.text_input(S["search_chats"], key="chat_search_q").strip()
+        if search_q:
+            try:
+                search_hits = chat_store.search_messages(search_q, limit=8)
+            except Exception:
+                search_hits = []
+            if not search_hits:
+                st.caption(S["search_no_hits"])
+            for h in search_hits:
+                label = f"{h.get('title', '')} | {h.get('snippet', '')}"
+                if st.button(label[:120], key=f"chat_hit_{h['message_id']}"):
+                    # Set before the selectbox below is created, so it opens the hit's conversation.
+                    st.session_state["conv_id"] = h["conv_id"]
+                    st.session_state["conv_select"] = h["conv_id"]
+                    st.session_state.setdefault("_chat_search_titles", {})[h["conv_id"]] = str(h.get("title") or "")
+                    # Widen the chat window so it reaches back to the matched message (and the question before it).
+                    try:
+                        n_from = chat_store.count_messages_from(h["conv_id"], int(h["message_id"]))
+                    except Exception:
+                        n_from = 0
+                    st.session_state["_chat_msgs_limit_conv"] = h["conv_id"]
+                    st.session_state["_chat_msgs_limit"] = max(_CHAT_PAGE_MSGS, n_from + 1)
+
         convs = chat_store.list_conversations(limit=50)
         conv_ids = [c["id"] for c in convs] if convs else [st.session_state["conv_id"]]
         conv_labels = {}
         for c in convs:
             ts = time.strftime("%m-%d %H:%M", time.localtime(float(c.get("updated_at", 0) or 0)))
             conv_labels[c["id"]] = f"{ts} | {c.get('title','')}"
+        if st.session_state["conv_id"] not in conv_ids:
+            # An older conversation opened from search results.
+            cur_conv = st.session_state["conv_id"]
+            conv_ids.insert(0, cur_conv)
+            conv_labels[cur_conv] = str((st.session_state.get("_chat_search_titles") or {}).get(cur_conv) or cur_conv)
 
         selected_conv_id = st.selectbox(
             S["pick_chat"],
@@ -1502,37 +1580,26 @@ def main() -> None:
             if "conv_select" in st.session_state:
                 del st.session_state["conv_select"]
 
-    # Retriever (auto-reload when DB changes)
-    docs_json = db_dir / "docs.json"
-    cur_mtime = docs_json.stat().st_mtime if docs_json.exists() else None
-    prev_mtime = st.session_state.get("db_mtime")
-    mtime_changed = bool(
-        (cur_mtime is not None)
-        and ((prev_mtime is None) or (float(cur_mtime) > float(prev_mtime) + 1e-6))
-    )
-    need_reload = (
-        ("retriever" not in st.session_state)
-        or bool(reload_btn)
-        or bool(retriever_reload_flag.get("reload"))
-        or mtime_changed
-    )
-    if need_reload:
+    # Retriever (auto-reload when DB changes).
+    # One shared instance per DB dir for the whole process: a docs.json change is picked up
+    # in the background while this session keeps searching the current snapshot.
+    force_reload = bool(reload_btn) or bool(retriever_reload_flag.get("reload"))
+    if force_reload or ("retriever" not in st.session_state):
         with st.spinner("\u52a0\u8f7d\u77e5\u8bc6\u5e93..."):
-            st.session_state.pop("retriever_load_error", None)
-            try:
-                st.session_state["retriever"] = _load_retriever(db_dir)
-            except Exception as e:
-                # Never crash the UI for new users / empty DB / corrupt chunks; fall back to an empty retriever.
-                st.session_state["retriever"] = BM25Retriever([])
-                st.session_state["retriever_load_error"] = f"{type(e).__name__}: {e}"
-            st.session_state["db_mtime"] = cur_mtime or time.time()
-            retriever_reload_flag["reload"] = False
+            retriever, retriever_err = get_shared_retriever(db_dir, force=force_reload, wait=True)
+        retriever_reload_flag["reload"] = False
+    else:
+        retriever, retriever_err = get_shared_retriever(db_dir)
+    st.session_state["retriever"] = retriever
+    if retriever_err:
+        # Never crash the UI for new users / empty DB / corrupt chunks; the registry falls back to an empty retriever.
+        st.session_state["retriever_load_error"] = retriever_err
+    else:
+        st.session_state.pop("retriever_load_error", None)
 
     if clear_btn:
         st.session_state["conv_id"] = chat_store.create_conversation()
 
-    st.session_state["messages"] = chat_store.get_messages(st.session_state["conv_id"])
-
     if page != S["page_chat"]:
         _teardown_chat_dock_runtime()
 
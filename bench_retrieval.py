@@ -0,0 +1,377 @@
+"""
+Benchmark for the retrieval hot path, on a synthetic markdown corpus.
+
+  python bench_retrieval.py --sizes 1000,10000 --out bench.json
+
+Each size gets its own corpus (generated once per --workdir) and DB built with ingest.py.
+LLM calls are stubbed (optionally with a fixed latency), so numbers only reflect local work.
+Output: JSON with p50/p95 latency per operation and peak RSS after each stage.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import math
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable
+
+import kb.retrieval_engine as retrieval_engine
+from kb.bm25_index import open_bm25_index
+from kb.config import Settings
+from kb.db_scope import use_db_dir
+from kb.retrieval_engine import (
+    _deep_read_md_for_context,
+    _group_hits_by_doc_for_refs,
+    _group_hits_by_doc_for_refs_fast,
+    _search_hits_with_fallback,
+)
+from kb.retriever import BM25Retriever
+from kb.store import load_all_chunks
+
+_TOPICS = [
+    "single-pixel imaging",
+    "single-shot imaging",
+    "compressive imaging",
+    "compressed sensing",
+    "spectral imaging",
+    "phase retrieval",
+    "wavelet reconstruction",
+    "metasurface optics",
+    "photon counting",
+    "light field",
+    "structured illumination",
+    "deep unfolding network",
+]
+_SECTIONS = ["Introduction", "Related Work", "Method", "Experiments", "Results", "Discussion", "Conclusion", "References"]
+_CJK_QUERIES = [
+    "单像素成像的重建方法",  # single-pixel imaging reconstruction
+    "压缩感知采样策略",  # compressed sensing sampling
+    "光谱成像和超表面",  # spectral imaging and metasurface
+]
+
+
+class _StubChat:
+    """Stands in for DeepSeekChat: deterministic answers shaped like the real prompts expect."""
+
+    latency_s = 0.0
+
+    def __init__(self, settings) -> None:
+        self._settings = settings
+
+    def chat(self, messages: list[dict], temperature: float = 0.2, max_tokens: int = 1200) -> str:
+        if self.latency_s > 0:
+            time.sleep(self.latency_s)
+        system = str(messages[0].get("content") or "") if messages else ""
+        user = str(messages[-1].get("content") or "") if messages else ""
+        if '"items"' in system:
+            try:
+                docs = json.loads(user).get("docs") or []
+            except Exception:
+                docs = []
+            items = []
+            for d in docs:
+                i = int(d.get("i") or 0)
+                hs = d.get("headings") or []
+                items.append(
+                    {
+                        "i": i,
+                        "score": float(90 - 7 * (i % 10)),
+                        "why": "stub",
+                        "what": "stub summary",
+                        "find": ["stub phrase"],
+                        "section": hs[0] if hs else "",
+                    }
+                )
+            return json.dumps({"items": items})
+        if '"score"' in system:
+            return json.dumps({"score": 50, "why": "stub"})
+        return "single-pixel imaging reconstruction"
+
+    def chat_stream(self, messages: list[dict], temperature: float = 0.2, max_tokens: int = 1200):
+        out = self.chat(messages, temperature=temperature, max_tokens=max_tokens)
+        for i in range(0, len(out), 24):
+            yield out[i : i + 24]
+
+
+def _stub_settings(db_dir: Path) -> Settings:
+    return Settings(
+        api_key="bench-stub",
+        base_url="http://127.0.0.1:9/v1",
+        model="stub",
+        db_dir=db_dir,
+        chat_db_path=db_dir / "bench_chat.sqlite3",
+        library_db_path=db_dir / "bench_library.sqlite3",
+        timeout_s=5.0,
+        max_retries=0,
+    )
+
+
+def _gen_word(rng: random.Random, n_vocab: int) -> str:
+    # Zipf-like: a few frequent words, a long tail of rare ones.
+    return f"w{int(n_vocab ** rng.random())}"
+
+
+def _gen_paragraph(rng: random.Random, topic: str, n_vocab: int) -> str:
+    words: list[str] = []
+    for _ in range(rng.randint(50, 90)):
+        r = rng.random()
+        if r < 0.08:
+            words.extend(rng.choice(_TOPICS).split())
+        elif r < 0.12:
+            words.extend(topic.split())
+        elif r < 0.35:
+            words.append(rng.choice(["the", "of", "and", "with", "for", "we", "is", "a"]))
+        else:
+            words.append(_gen_word(rng, n_vocab))
+    return " ".join(words).capitalize() + "."
+
+
+def generate_corpus(md_dir: Path, n_chunks: int, *, seed: int = 0, chunks_per_doc: int = 20) -> int:
+    """
+    Write synthetic papers (headings, page markers, references) until roughly n_chunks
+    chunks at ingest.py's default chunk size. Returns the number of files.
+    """
+    rng = random.Random(seed)
+    md_dir.mkdir(parents=True, exist_ok=True)
+    n_vocab = max(2000, n_chunks * 4)
+    n_docs = max(1, math.ceil(n_chunks / chunks_per_doc))
+    # Headings and paragraph boundaries cut chunks short of the 1400-char size; calibrated empirically.
+    target_chars = chunks_per_doc * 860
+    for d in range(n_docs):
+        topic = _TOPICS[d % len(_TOPICS)]
+        lines = [f"# {topic.title()} study {d}", ""]
+        page = 1
+        page_chars = 0
+        size = 0
+        sec = 0
+        while size < target_chars:
+            name = _SECTIONS[min(sec, len(_SECTIONS) - 2)] if size < target_chars * 0.9 else _SECTIONS[-1]
+            lines += [f"## {sec + 1} {name}", ""]
+            for sub in range(rng.randint(1, 3)):
+                lines += [f"### {sec + 1}.{sub + 1} {topic} {_gen_word(rng, n_vocab)}", ""]
+                for _ in range(rng.randint(2, 5)):
+                    para = _gen_paragraph(rng, topic, n_vocab)
+                    lines += [para, ""]
+                    size += len(para)
+                    page_chars += len(para)
+                    if page_chars > 3000:
+                        page += 1
+                        page_chars = 0
+                        lines += [f"<!-- kb_page: {page} -->", ""]
+            sec += 1
+        (md_dir / f"paper_{d:06d}.md").write_text("\n".join(lines), encoding="utf-8")
+    return n_docs
+
+
+def _ingest(md_dir: Path, db_dir: Path, jobs: int) -> float:
+    t0 = time.perf_counter()
+    subprocess.run(
+        [sys.executable, str(Path(__file__).with_name("ingest.py")), "--src", str(md_dir), "--db", str(db_dir), "--jobs", str(jobs)],
+        check=True,
+        stdout=subprocess.DEVNULL,
+    )
+    return time.perf_counter() - t0
+
+
+def _peak_rss_mb() -> float | None:
+    try:
+        import resource
+
+        peak = float(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+        # KiB on Linux, bytes on macOS.
+        return round(peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024, 1)
+    except Exception:
+        pass
+    try:
+        import psutil  # type: ignore
+
+        mi = psutil.Process().memory_info()
+        return round(float(getattr(mi, "peak_wset", mi.rss)) / (1024 * 1024), 1)
+    except Exception:
+        return None
+
+
+def _summary(samples: list[float]) -> dict:
+    xs = sorted(samples)
+    if not xs:
+        return {"n": 0}
+
+    def pct(p: float) -> float:
+        return xs[min(len(xs) - 1, max(0, math.ceil(p * len(xs)) - 1))]
+
+    return {
+        "n": len(xs),
+        "p50_ms": round(pct(0.50) * 1000, 3),
+        "p95_ms": round(pct(0.95) * 1000, 3),
+        "mean_ms": round(statistics.fmean(xs) * 1000, 3),
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+
+
+def _measure(fn: Callable[[int], object], repeat: int) -> dict:
+    samples: list[float] = []
+    for i in range(max(1, repeat)):
+        t0 = time.perf_counter()
+        fn(i)
+        samples.append(time.perf_counter() - t0)
+    return _summary(samples)
+
+
+def _make_queries(n: int, seed: int) -> list[str]:
+    rng = random.Random(seed + 1)
+    qs = []
+    for i in range(n):
+        if i % 5 == 4:
+            qs.append(_CJK_QUERIES[i % len(_CJK_QUERIES)])
+        else:
+            qs.append(f"how does {rng.choice(_TOPICS)} handle {rng.choice(['noise', 'sampling', 'reconstruction', 'resolution'])}")
+    return qs
+
+
+def bench_size(n_chunks: int, work: Path, args) -> dict:
+    md_dir = work / f"md-{n_chunks}"
+    db_dir = work / f"db-{n_chunks}"
+    out: dict = {"target_chunks": n_chunks, "ops": {}}
+    if not (db_dir / "docs.json").exists():
+        shutil.rmtree(md_dir, ignore_errors=True)
+        shutil.rmtree(db_dir, ignore_errors=True)
+        out["docs"] = generate_corpus(md_dir, n_chunks, seed=args.seed)
+        out["ingest_s"] = round(_ingest(md_dir, db_dir, args.jobs), 3)
+    settings = _stub_settings(db_dir)
+    # Doc index lookups in the refs builder follow this DB dir.
+    with use_db_dir(db_dir):
+        _bench_ops(out, db_dir, settings, args)
+    out["peak_rss_mb"] = _peak_rss_mb()
+    return out
+
+
+def _bench_ops(out: dict, db_dir: Path, settings, args) -> None:
+    ops = out["ops"]
+    build_repeat = max(1, int(args.build_repeat))
+    repeat = max(1, int(args.repeat))
+
+    holder: dict = {}
+    ops["load_all_chunks"] = _measure(lambda _i: holder.__setitem__("chunks", load_all_chunks(db_dir)), build_repeat)
+    chunks = holder["chunks"]
+    out["chunks"] = len(chunks)
+    ops["BM25Retriever.__init__"] = _measure(lambda _i: holder.__setitem__("r", BM25Retriever(chunks)), build_repeat)
+    ops["BM25Retriever.__init__[token_cache]"] = _measure(
+        lambda _i: holder.__setitem__("r", BM25Retriever(chunks, tokens_db=db_dir)), build_repeat
+    )
+    del chunks
+    holder.pop("chunks", None)
+    retriever = holder.pop("r")
+    index = open_bm25_index(db_dir)
+
+    queries = _make_queries(max(1, int(args.queries)), args.seed)
+    for top_k in (6, 36, 120):
+        ops[f"BM25Retriever.search[top_k={top_k}]"] = _measure(lambda i: retriever.search(queries[i % len(queries)], top_k=top_k), repeat)
+        if index is not None:
+            ops[f"BM25IndexRetriever.search[top_k={top_k}]"] = _measure(
+                lambda i: index.search(queries[i % len(queries)], top_k=top_k), repeat
+            )
+
+    fallback: dict[str, list[dict]] = {}
+
+    def _fallback(i: int) -> None:
+        q = queries[i % len(queries)]
+        hits, _scores, _used, _tr = _search_hits_with_fallback(q, retriever, 6, settings)
+        fallback[q] = hits
+
+    ops["_search_hits_with_fallback"] = _measure(_fallback, repeat)
+    for q in queries:
+        if q not in fallback:
+            _fallback(queries.index(q))
+
+    for deep in (False, True):
+        ops[f"_group_hits_by_doc_for_refs[deep_read={deep}]"] = _measure(
+            lambda i: _group_hits_by_doc_for_refs(
+                fallback[queries[i % len(queries)]],
+                queries[i % len(queries)],
+                6,
+                deep_query=queries[i % len(queries)],
+                deep_read=deep,
+                llm_rerank=True,
+                settings=settings,
+            ),
+            repeat,
+        )
+    ops["_group_hits_by_doc_for_refs_fast"] = _measure(lambda i: _group_hits_by_doc_for_refs_fast(fallback[queries[i % len(queries)]], 6), repeat)
+
+    srcs = []
+    for q in queries:
+        for h in fallback[q][:1]:
+            srcs.append((str((h.get("meta") or {}).get("source_path") or ""), q))
+    if srcs:
+        ops["_deep_read_md_for_context"] = _measure(lambda i: _deep_read_md_for_context(Path(srcs[i % len(srcs)][0]), srcs[i % len(srcs)][1]), repeat)
+
+
+def _git_rev() -> str:
+    try:
+        r = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=Path(__file__).parent, capture_output=True, text=True, timeout=10)
+        return r.stdout.strip()
+    except Exception:
+        return ""
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Benchmark the retrieval hot path on a synthetic corpus (LLM stubbed).")
+    ap.add_argument("--sizes", default="1000,10000", help="Comma-separated corpus sizes in chunks. Default: 1000,10000 (100000 for large runs)")
+    ap.add_argument("--repeat", type=int, default=30, help="Timed runs per query-level operation. Default: 30")
+    ap.add_argument("--build-repeat", type=int, default=3, help="Timed runs for load/build operations. Default: 3")
+    ap.add_argument("--queries", type=int, default=20, help="Distinct queries, cycled through. Default: 20")
+    ap.add_argument("--jobs", type=int, default=0, help="ingest.py --jobs for building the corpus DB. Default: 0 (all CPUs)")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--llm-latency-ms", type=float, default=0.0, help="Sleep per stubbed LLM call. Default: 0")
+    ap.add_argument("--cache", action="store_true", help="Enable the in-memory retrieval cache (default: every call is cold).")
+    ap.add_argument("--workdir", default="", help="Keep corpora/DBs here and reuse them across runs. Default: a temp dir")
+    ap.add_argument("--out", default="", help="Write JSON here instead of stdout.")
+    args = ap.parse_args()
+
+    _StubChat.latency_s = max(0.0, float(args.llm_latency_ms) / 1000.0)
+    retrieval_engine.DeepSeekChat = _StubChat  # type: ignore[assignment]
+    if args.cache:
+        cache: dict[str, dict] = {}
+        retrieval_engine.configure_cache(
+            lambda bucket, key: (cache.get(bucket) or {}).get(key),
+            lambda bucket, key, val, **_kw: cache.setdefault(bucket, {}).__setitem__(key, val),
+        )
+
+    sizes = [int(s) for s in str(args.sizes).split(",") if s.strip()]
+    tmp = None
+    if args.workdir:
+        work = Path(args.workdir).expanduser().resolve()
+        work.mkdir(parents=True, exist_ok=True)
+    else:
+        tmp = tempfile.mkdtemp(prefix="kb_bench_")
+        work = Path(tmp)
+    try:
+        report = {
+            "git": _git_rev(),
+            "python": sys.version.split()[0],
+            "platform": sys.platform,
+            "created_at": time.time(),
+            "params": {k: v for k, v in vars(args).items() if k not in ("out", "workdir")},
+            "sizes": [bench_size(n, work, args) for n in sizes],
+        }
+    finally:
+        if tmp is not None:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        Path(args.out).write_text(text, encoding="utf-8")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
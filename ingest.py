@@ -1,9 +1,18 @@
 ﻿from __future__ import annotations
 
 import argparse
+import os
+from collections import deque
+from itertools import islice
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
 from pathlib import Path
+from typing import Callable, Iterable, Iterator
 
-from kb.chunking import chunk_markdown
+from kb.bm25_index import build_bm25_index, sync_bm25_index
+from kb.chunk_store import colstore_dir, convert_jsonl_to_columnar
+from kb.chunking import _merge_blocks_into_chunks, _parse_blocks
+from kb.doc_index import DocIndexWriter, build_deep_chunks, doc_headings
+from kb.token_cache import TokenCacheWriter
 from kb.store import (
     compute_doc_id,
     compute_file_sha1,
@@ -12,6 +21,24 @@ from kb.store import (
     save_docs_index,
     write_doc_chunks,
 )
+from kb.tokenize import tokenize
+
+
+def _map_bounded(pool: Executor, fn: Callable, items: Iterable, window: int) -> Iterator:
+    """
+    Like pool.map() (results in input order) but with at most `window` calls in flight, so
+    results the serial writer has not reached yet do not pile up in memory.
+    """
+    it = iter(items)
+    pending: deque[Future] = deque(pool.submit(fn, item) for item in islice(it, max(1, window)))
+    try:
+        while pending:
+            res = pending.popleft().result()
+            pending.extend(pool.submit(fn, item) for item in islice(it, 1))
+            yield res
+    finally:
+        for fut in pending:
+            fut.cancel()
 
 
 def _iter_md_files(src: Path, glob: str, exclude_dirs: set[str], exclude_names: set[str]) -> list[Path]:
@@ -32,6 +59,46 @@ def _iter_md_files(src: Path, glob: str, exclude_dirs: set[str], exclude_names:
     return sorted(files)
 
 
+def _hash_and_chunk(task: tuple[str, str | None, int, int, bool]) -> dict:
+    """
+    Hash one markdown file, then chunk and tokenize it unless its sha1 equals prev_sha1.
+    Headings and deep-read sub-chunks are built for changed files, and for unchanged ones when
+    want_structure is set (not in doc_index.sqlite3 yet, or touched since).
+    Top-level (picklable) so --jobs can run it in worker processes.
+    """
+    path_s, prev_sha1, chunk_size, chunk_overlap, want_structure = task
+    p = Path(path_s)
+    st = p.stat()
+    sha1 = compute_file_sha1(p)
+    if (prev_sha1 is not None) and prev_sha1 == sha1:
+        res = {"sha1": sha1, "chunks": None, "mtime": st.st_mtime, "size": st.st_size}
+        if want_structure:
+            blocks = _parse_blocks(p.read_text(encoding="utf-8", errors="replace"))
+            res["headings"] = doc_headings(blocks)
+            res["deep_chunks"] = build_deep_chunks(blocks, str(p))
+        return res
+
+    text = p.read_text(encoding="utf-8", errors="replace")
+    # One parse feeds the chunks, the heading table and the deep-read layer (same as chunk_markdown).
+    blocks = _parse_blocks(text)
+    chunks = _merge_blocks_into_chunks(
+        blocks,
+        source_path=str(p),
+        chunk_size=chunk_size,
+        overlap=chunk_overlap,
+    )
+    tokens = [tokenize(c.get("text", "")) for c in chunks]
+    return {
+        "sha1": sha1,
+        "chunks": chunks,
+        "tokens": tokens,
+        "headings": doc_headings(blocks),
+        "deep_chunks": build_deep_chunks(blocks, str(p)),
+        "mtime": st.st_mtime,
+        "size": st.st_size,
+    }
+
+
 def main() -> None:
     ap = argparse.ArgumentParser(description="Ingest markdown files into a lightweight KB (BM25).")
     ap.add_argument("--src", required=True, help="Source markdown file or directory.")
@@ -48,6 +115,17 @@ def main() -> None:
     ap.add_argument("--prune", action="store_true", help="Remove docs from DB if source file is missing.")
     ap.add_argument("--chunk-size", type=int, default=1400, help="Chunk size in characters. Default: 1400")
     ap.add_argument("--chunk-overlap", type=int, default=200, help="Chunk overlap in characters. Default: 200")
+    ap.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="Worker processes for hashing/chunking (0 = all CPUs). Output is identical to a serial run. Default: 1",
+    )
+    ap.add_argument(
+        "--columnar",
+        action="store_true",
+        help="Also write the binary columnar chunk store (kept up to date automatically once it exists).",
+    )
     args = ap.parse_args()
 
     src = Path(args.src).expanduser().resolve()
@@ -61,37 +139,64 @@ def main() -> None:
 
     changed = 0
     skipped = 0
+    written: set[str] = set()
     total_chunks = 0
 
-    for p in md_files:
-        sha1 = compute_file_sha1(p)
-        doc_id = compute_doc_id(p)
+    doc_index = DocIndexWriter(db_dir)
+    doc_ids = [compute_doc_id(p) for p in md_files]
+    tasks = []
+    for p, doc_id in zip(md_files, doc_ids):
         prev = docs_index.get(doc_id)
-
-        if args.incremental and prev and prev.get("sha1") == sha1:
-            skipped += 1
-            continue
-
-        text = p.read_text(encoding="utf-8", errors="replace")
-        chunks = chunk_markdown(
-            text,
-            source_path=str(p),
-            chunk_size=args.chunk_size,
-            overlap=args.chunk_overlap,
-        )
-
-        write_doc_chunks(db_dir, doc_id, chunks)
-
-        docs_index[doc_id] = {
-            "doc_id": doc_id,
-            "path": str(p),
-            "sha1": sha1,
-            "mtime": p.stat().st_mtime,
-            "num_chunks": len(chunks),
-        }
-
-        changed += 1
-        total_chunks += len(chunks)
+        prev_sha1 = prev.get("sha1") if (args.incremental and prev) else None
+        try:
+            st = p.stat()
+            want_structure = not doc_index.is_fresh(doc_id, mtime=st.st_mtime, size=st.st_size)
+        except OSError:
+            want_structure = True
+        tasks.append((str(p), prev_sha1, args.chunk_size, args.chunk_overlap, want_structure))
+
+    jobs = int(args.jobs) if int(args.jobs) > 0 else (os.cpu_count() or 1)
+    jobs = max(1, min(jobs, len(tasks)))
+    pool = ProcessPoolExecutor(max_workers=jobs) if jobs > 1 else None
+    token_cache = TokenCacheWriter(db_dir)
+    try:
+        # Results come back in input order, so chunk files and docs.json come out exactly as in a serial run.
+        if pool is not None:
+            results = _map_bounded(pool, _hash_and_chunk, tasks, window=2 * jobs)
+        else:
+            results = map(_hash_and_chunk, tasks)
+        for p, doc_id, res in zip(md_files, doc_ids, results):
+            if res.get("headings") is not None:
+                doc_index.save_doc(
+                    doc_id,
+                    str(p),
+                    mtime=res["mtime"],
+                    size=res["size"],
+                    headings=res["headings"],
+                    deep_chunks=res["deep_chunks"],
+                )
+            chunks = res.get("chunks")
+            if chunks is None:
+                skipped += 1
+                continue
+
+            write_doc_chunks(db_dir, doc_id, chunks)
+            token_cache.save_doc(doc_id, chunks, res.get("tokens"))
+            written.add(doc_id)
+
+            docs_index[doc_id] = {
+                "doc_id": doc_id,
+                "path": str(p),
+                "sha1": res["sha1"],
+                "mtime": res["mtime"],
+                "num_chunks": len(chunks),
+            }
+
+            changed += 1
+            total_chunks += len(chunks)
+    finally:
+        if pool is not None:
+            pool.shutdown()
 
     if args.prune:
         removed = prune_missing_docs(db_dir, docs_index)
@@ -99,10 +204,35 @@ def main() -> None:
         removed = 0
 
     save_docs_index(db_dir, docs_index)
+    try:
+        token_cache.prune(docs_index.keys())
+    finally:
+        token_cache.close()
+    try:
+        doc_index.prune(docs_index.keys())
+    finally:
+        doc_index.close()
+
+    # Incremental runs only apply the changed docs to the BM25 index; full runs rebuild it.
+    if args.incremental:
+        idx_stats = sync_bm25_index(db_dir, force_doc_ids=written)
+    else:
+        build_bm25_index(db_dir)
+        idx_stats = {"rebuilt": 1}
+
+    n_col = None
+    if args.columnar or colstore_dir(db_dir).exists():
+        n_col = convert_jsonl_to_columnar(db_dir, force_doc_ids=written)
 
     print(f"Docs: {len(md_files)} | updated: {changed} | skipped: {skipped} | removed: {removed}")
     if changed:
         print(f"New/updated chunks written: {total_chunks}")
+    if idx_stats.get("rebuilt"):
+        print("BM25 index: rebuilt")
+    elif any(idx_stats.get(k) for k in ("added", "replaced", "removed")):
+        print(f"BM25 index: added {idx_stats['added']} | replaced {idx_stats['replaced']} | removed {idx_stats['removed']}")
+    if n_col is not None:
+        print(f"Columnar store: {n_col} chunks")
     print(f"DB: {db_dir}")
 
 
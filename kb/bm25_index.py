@@ -0,0 +1,545 @@
+from __future__ import annotations
+
+import heapq
+import math
+import os
+import sqlite3
+import time
+from array import array
+from pathlib import Path
+
+from .chunk_store import ColumnarChunkStore, open_columnar_store
+from .retriever import BM25Retriever, RetrieverSnapshot
+from .store import current_doc_records, load_all_chunks, load_doc_chunks
+from .token_cache import TokenCacheReader
+from .tokenize import tokenize
+
+# Same parameters as rank_bm25.BM25Okapi defaults, so both retrievers score identically.
+_K1 = 1.5
+_B = 0.75
+_EPSILON = 0.25
+
+_INDEX_VERSION = 3
+
+
+def bm25_index_path(db_dir: Path) -> Path:
+    return Path(db_dir) / "bm25_index.sqlite3"
+
+
+def _init_schema(conn: sqlite3.Connection) -> None:
+    conn.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+    conn.execute(
+        """
+        CREATE TABLE docs (
+          doc_id TEXT PRIMARY KEY,
+          sha1 TEXT NOT NULL,
+          num_chunks INTEGER NOT NULL,
+          indexed_chunks INTEGER NOT NULL,
+          token_len INTEGER NOT NULL
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE chunks (
+          doc_id TEXT NOT NULL,
+          pos INTEGER NOT NULL,
+          PRIMARY KEY (doc_id, pos)
+        ) WITHOUT ROWID
+        """
+    )
+    # first_*: where the term first occurs in the corpus (doc, chunk pos, token index), the
+    # order in which BM25Okapi sums idf.
+    conn.execute(
+        """
+        CREATE TABLE terms (
+          term TEXT PRIMARY KEY,
+          df INTEGER NOT NULL,
+          first_doc TEXT NOT NULL DEFAULT '',
+          first_pos INTEGER NOT NULL DEFAULT 0,
+          first_tok INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+        """
+    )
+    conn.execute("CREATE INDEX idx_terms_first ON terms(first_doc, first_pos, first_tok, df)")
+    # One row per (term, doc): a uint32 array of (pos, tf, chunk_len) triples,
+    # plus the term's first occurrence in the doc (chunk pos, token index).
+    conn.execute(
+        """
+        CREATE TABLE postings (
+          term TEXT NOT NULL,
+          doc_id TEXT NOT NULL,
+          data BLOB NOT NULL,
+          first_pos INTEGER NOT NULL,
+          first_tok INTEGER NOT NULL,
+          PRIMARY KEY (term, doc_id)
+        ) WITHOUT ROWID
+        """
+    )
+    conn.execute("CREATE INDEX idx_postings_doc_id ON postings(doc_id)")
+
+
+def _average_idf(conn: sqlite3.Connection, n_chunks: int) -> float:
+    """
+    Mirrors BM25Okapi._calc_idf: raw idf summed in corpus first-occurrence order, so a
+    rebuild and a delta round the sum (and so the epsilon floor) bit-identically.
+
+    A delta still needs this full pass: every term's idf depends on n_chunks, which any
+    added or removed chunk changes, and a running sum updated out of order would round
+    differently from a rebuild. The pass is one scan of the covering idx_terms_first
+    (no sort), and idf is computed once per distinct df value.
+    """
+    idf_of: dict[int, float] = {}
+    idf_sum = 0.0
+    n_terms = 0
+    for (freq,) in conn.execute("SELECT df FROM terms ORDER BY first_doc, first_pos, first_tok"):
+        idf = idf_of.get(freq)
+        if idf is None:
+            idf = idf_of[freq] = math.log(n_chunks - int(freq) + 0.5) - math.log(int(freq) + 0.5)
+        idf_sum += idf
+        n_terms += 1
+    return idf_sum / n_terms if n_terms else 0.0
+
+
+def _read_meta(conn: sqlite3.Connection) -> dict[str, str]:
+    return {str(k): str(v) for k, v in conn.execute("SELECT key, value FROM meta").fetchall()}
+
+
+def _write_meta(conn: sqlite3.Connection, *, n_chunks: int, total_len: int, avg_idf: float) -> None:
+    meta = {
+        "version": _INDEX_VERSION,
+        "n_chunks": n_chunks,
+        "total_len": total_len,
+        # repr() round-trips floats exactly.
+        "avg_idf": repr(avg_idf),
+        "updated_at": time.time(),
+    }
+    conn.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", ((k, str(v)) for k, v in meta.items()))
+
+
+def _index_doc(
+    conn: sqlite3.Connection,
+    db_dir: Path,
+    doc_id: str,
+    record: tuple[str, int],
+    tokens: TokenCacheReader,
+) -> tuple[dict[str, int], dict[str, tuple[int, int]], int, int]:
+    """
+    Insert one doc's chunks and postings.
+    Returns (per-term chunk counts in first-occurrence order, per-term first (chunk pos, token index),
+    n_chunks, token_len).
+    """
+    chunks = load_doc_chunks(db_dir, doc_id)
+    postings: dict[str, array] = {}
+    firsts: dict[str, tuple[int, int]] = {}
+    token_len = 0
+    for pos, c in enumerate(chunks):
+        toks = tokens.tokens(doc_id, pos, c.get("text", ""))
+        freqs: dict[str, int] = {}
+        for k, t in enumerate(toks):
+            if t not in freqs:
+                freqs[t] = 0
+                if t not in firsts:
+                    firsts[t] = (pos, k)
+            freqs[t] += 1
+        for t, tf in freqs.items():
+            postings.setdefault(t, array("I")).extend((pos, tf, len(toks)))
+        token_len += len(toks)
+    conn.executemany(
+        "INSERT INTO postings (term, doc_id, data, first_pos, first_tok) VALUES (?, ?, ?, ?, ?)",
+        ((t, doc_id, arr.tobytes(), firsts[t][0], firsts[t][1]) for t, arr in postings.items()),
+    )
+    conn.executemany("INSERT INTO chunks (doc_id, pos) VALUES (?, ?)", ((doc_id, i) for i in range(len(chunks))))
+    conn.execute(
+        "INSERT INTO docs (doc_id, sha1, num_chunks, indexed_chunks, token_len) VALUES (?, ?, ?, ?, ?)",
+        (doc_id, record[0], record[1], len(chunks), token_len),
+    )
+    return {t: len(arr) // 3 for t, arr in postings.items()}, firsts, len(chunks), token_len
+
+
+def _unindex_doc(conn: sqlite3.Connection, doc_id: str) -> tuple[dict[str, int], int, int]:
+    """Delete one doc from the index. Returns (per-term chunk counts, n_chunks, token_len)."""
+    row = conn.execute("SELECT indexed_chunks, token_len FROM docs WHERE doc_id = ?", (doc_id,)).fetchone()
+    if row is None:
+        return {}, 0, 0
+    triple = 3 * array("I").itemsize
+    counts = {str(t): len(data) // triple for t, data in conn.execute("SELECT term, data FROM postings WHERE doc_id = ?", (doc_id,))}
+    conn.execute("DELETE FROM postings WHERE doc_id = ?", (doc_id,))
+    conn.execute("DELETE FROM chunks WHERE doc_id = ?", (doc_id,))
+    conn.execute("DELETE FROM docs WHERE doc_id = ?", (doc_id,))
+    return counts, int(row[0]), int(row[1])
+
+
+def build_bm25_index(db_dir: Path) -> int:
+    """
+    Rebuild the on-disk inverted index from the chunk files.
+    Chunks are visited in load_all_chunks() order so ties rank exactly like BM25Retriever.
+
+    Returns the number of indexed chunks.
+    """
+    db_dir = Path(db_dir)
+    path = bm25_index_path(db_dir)
+    tmp = path.with_name(f"{path.name}.tmp{os.getpid()}")
+    if tmp.exists():
+        tmp.unlink()
+
+    records = current_doc_records(db_dir)
+    df: dict[str, int] = {}
+    first: dict[str, tuple[str, int, int]] = {}
+    n_chunks = 0
+    total_len = 0
+
+    conn = sqlite3.connect(str(tmp))
+    tokens = TokenCacheReader(db_dir)
+    try:
+        _init_schema(conn)
+        for doc_id, rec in records.items():
+            counts, firsts, n, token_len = _index_doc(conn, db_dir, doc_id, rec, tokens)
+            for t, cnt in counts.items():
+                df[t] = df.get(t, 0) + cnt
+                if t not in first:
+                    first[t] = (doc_id, *firsts[t])
+            n_chunks += n
+            total_len += token_len
+        conn.executemany(
+            "INSERT INTO terms (term, df, first_doc, first_pos, first_tok) VALUES (?, ?, ?, ?, ?)",
+            ((t, d, *first[t]) for t, d in df.items()),
+        )
+        _write_meta(conn, n_chunks=n_chunks, total_len=total_len, avg_idf=_average_idf(conn, n_chunks))
+        conn.commit()
+    finally:
+        tokens.close()
+        conn.close()
+
+    # Readers only hold the file open during a search; on Windows a replace can still race one.
+    for attempt in range(10):
+        try:
+            os.replace(tmp, path)
+            break
+        except PermissionError:
+            if attempt >= 9:
+                raise
+            time.sleep(0.2)
+    return n_chunks
+
+
+def sync_bm25_index(db_dir: Path, *, force_doc_ids: set[str] | None = None) -> dict[str, int]:
+    """
+    Apply a delta to the on-disk index: add, replace or remove the chunks of the docs
+    whose (sha1, num_chunks) in docs.json differ from what was indexed.
+    force_doc_ids are replaced even if their record did not change (e.g. re-chunked).
+
+    Work is proportional to the changed docs; corpus statistics are updated in place.
+    A missing or outdated index is rebuilt from scratch.
+    Returns {"added": n, "replaced": n, "removed": n, "rebuilt": 0|1}.
+    """
+    db_dir = Path(db_dir)
+    path = bm25_index_path(db_dir)
+    version = ""
+    if path.exists():
+        try:
+            conn = sqlite3.connect(str(path), timeout=30)
+            try:
+                version = _read_meta(conn).get("version", "")
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            version = ""
+    if version != str(_INDEX_VERSION):
+        build_bm25_index(db_dir)
+        return {"added": 0, "replaced": 0, "removed": 0, "rebuilt": 1}
+
+    force = set(force_doc_ids or ())
+    stats = {"added": 0, "replaced": 0, "removed": 0, "rebuilt": 0}
+    conn = sqlite3.connect(str(path), timeout=30)
+    tokens = TokenCacheReader(db_dir)
+    try:
+        # Diff inside the write transaction, so concurrent syncs do not apply the same delta twice.
+        conn.execute("BEGIN IMMEDIATE")
+        indexed = {
+            str(doc_id): (str(sha1), int(num))
+            for doc_id, sha1, num in conn.execute("SELECT doc_id, sha1, num_chunks FROM docs")
+        }
+        expected = current_doc_records(db_dir)
+        removed = [d for d in indexed if d not in expected]
+        upsert = [d for d, rec in expected.items() if (indexed.get(d) != rec) or (d in force)]
+        if not removed and not upsert:
+            conn.rollback()
+            return stats
+
+        meta = _read_meta(conn)
+        n_chunks = int(meta.get("n_chunks") or 0)
+        total_len = int(meta.get("total_len") or 0)
+        df_delta: dict[str, int] = {}
+        for doc_id in removed + [d for d in upsert if d in indexed]:
+            counts, n, token_len = _unindex_doc(conn, doc_id)
+            for t, cnt in counts.items():
+                df_delta[t] = df_delta.get(t, 0) - cnt
+            n_chunks -= n
+            total_len -= token_len
+        for doc_id in upsert:
+            counts, _firsts, n, token_len = _index_doc(conn, db_dir, doc_id, expected[doc_id], tokens)
+            for t, cnt in counts.items():
+                df_delta[t] = df_delta.get(t, 0) + cnt
+            n_chunks += n
+            total_len += token_len
+
+        conn.executemany(
+            "INSERT INTO terms (term, df) VALUES (?, ?) ON CONFLICT(term) DO UPDATE SET df = df + excluded.df",
+            ((t, d) for t, d in df_delta.items() if d != 0),
+        )
+        conn.execute("DELETE FROM terms WHERE df <= 0")
+        # Only terms whose postings changed can have moved their first occurrence: the
+        # earliest remaining doc (postings are keyed by (term, doc_id)) holds it.
+        for t in df_delta:
+            row = conn.execute(
+                "SELECT doc_id, first_pos, first_tok FROM postings WHERE term = ? ORDER BY doc_id LIMIT 1", (t,)
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE terms SET first_doc = ?, first_pos = ?, first_tok = ? WHERE term = ?",
+                    (row[0], row[1], row[2], t),
+                )
+        _write_meta(conn, n_chunks=n_chunks, total_len=total_len, avg_idf=_average_idf(conn, n_chunks))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        tokens.close()
+        conn.close()
+
+    stats["removed"] = len(removed)
+    stats["replaced"] = sum(1 for d in upsert if d in indexed)
+    stats["added"] = len(upsert) - stats["replaced"]
+    return stats
+
+
+def bm25_index_is_fresh(db_dir: Path) -> bool:
+    path = bm25_index_path(db_dir)
+    if not path.exists():
+        return False
+    try:
+        conn = sqlite3.connect(f"{path.resolve().as_uri()}?mode=ro", uri=True, timeout=30)
+        try:
+            meta = _read_meta(conn)
+            rows = conn.execute("SELECT doc_id, sha1, num_chunks FROM docs").fetchall()
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return False
+    if meta.get("version") != str(_INDEX_VERSION):
+        return False
+    indexed = {str(doc_id): (str(sha1), int(num)) for doc_id, sha1, num in rows}
+    return indexed == current_doc_records(db_dir)
+
+
+class BM25IndexRetriever(RetrieverSnapshot):
+    """
+    Read-only BM25 retriever over the on-disk index written by ingest.py.
+    - same search() contract and scores as BM25Retriever
+    - per query, only the postings of the query terms are read
+    - chunk text/meta is loaded for returned hits only: from the columnar store when it
+      holds the same doc version, else from the doc's chunk file
+    """
+
+    def __init__(self, db_dir: Path) -> None:
+        super().__init__()
+        self._db_dir = Path(db_dir)
+        self._path = bm25_index_path(self._db_dir)
+        self._n_chunks = 0
+        self._store: ColumnarChunkStore | None = None
+        self.reload()
+
+    @property
+    def db_dir(self) -> Path:
+        return self._db_dir
+
+    def reload(self) -> None:
+        """Re-read the corpus header after the index was updated on disk."""
+        conn = self._connect()
+        try:
+            meta = _read_meta(conn)
+        finally:
+            conn.close()
+        self._n_chunks = int(meta.get("n_chunks") or 0)
+        # Hits are checked per doc against the index's sha1, so a stale store is still usable.
+        self._store = open_columnar_store(self._db_dir, require_fresh=False)
+
+    def _release(self) -> None:
+        # Columnar store mmaps; searches after this read chunk files instead.
+        store, self._store = self._store, None
+        if store is not None:
+            store.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        # Short-lived read-only connections: ingest may replace the file between searches.
+        return sqlite3.connect(f"{self._path.resolve().as_uri()}?mode=ro", uri=True, timeout=30, check_same_thread=False)
+
+    @property
+    def is_empty(self) -> bool:
+        return self._n_chunks <= 0
+
+    def _search(self, query: str, top_k: int) -> list[dict]:
+        q = tokenize(query)
+        if not q:
+            return []
+        try:
+            conn = self._connect()
+        except sqlite3.Error:
+            return []
+        try:
+            # One read transaction, so stats and postings come from the same index state.
+            conn.execute("BEGIN")
+            meta = _read_meta(conn)
+            n = int(meta.get("n_chunks") or 0)
+            if n <= 0:
+                return []
+            avgdl = int(meta.get("total_len") or 0) / n
+            eps = _EPSILON * float(meta.get("avg_idf") or 0.0)
+
+            term_postings: dict[str, tuple[float, list] | None] = {}
+            scores: dict[tuple[str, int], float] = {}
+            # Repeated query terms are scored repeatedly, like BM25Okapi.get_scores().
+            for t in q:
+                if t not in term_postings:
+                    row = conn.execute("SELECT df FROM terms WHERE term = ?", (t,)).fetchone()
+                    if row is None:
+                        term_postings[t] = None
+                    else:
+                        freq = int(row[0])
+                        idf = math.log(n - freq + 0.5) - math.log(freq + 0.5)
+                        if idf < 0:
+                            idf = eps
+                        rows = conn.execute("SELECT doc_id, data FROM postings WHERE term = ?", (t,)).fetchall()
+                        term_postings[t] = (idf, rows)
+                entry = term_postings[t]
+                if entry is None:
+                    continue
+                idf, rows = entry
+                for doc_id, data in rows:
+                    arr = array("I")
+                    arr.frombytes(data)
+                    for j in range(0, len(arr), 3):
+                        tf = arr[j + 1]
+                        # Same operation order as BM25Okapi.get_scores() for bit-identical floats.
+                        s = idf * (tf * (_K1 + 1) / (tf + _K1 * (1 - _B + _B * arr[j + 2] / avgdl)))
+                        key = (doc_id, arr[j])
+                        scores[key] = scores.get(key, 0.0) + s
+
+            keys = self._rank(conn, scores, max(1, int(top_k)))
+            doc_sha1: dict[str, str] = {}
+            for doc_id, _pos in keys:
+                if doc_id not in doc_sha1:
+                    row = conn.execute("SELECT sha1 FROM docs WHERE doc_id = ?", (doc_id,)).fetchone()
+                    doc_sha1[doc_id] = str(row[0]) if row else ""
+        except sqlite3.Error:
+            return []
+        finally:
+            conn.close()
+        return self._materialize(keys, scores, doc_sha1)
+
+    @staticmethod
+    def _rank(conn: sqlite3.Connection, scores: dict[tuple[str, int], float], k: int) -> list[tuple[str, int]]:
+        """
+        Reproduce sorted(range(N), key=score, reverse=True)[:k] over the whole corpus:
+        positive scores first, then zero-score chunks in corpus order, then negative ones.
+        """
+        positive = [(s, key) for key, s in scores.items() if s > 0.0]
+        if not positive:
+            # Nothing matches: same as BM25Retriever (no arbitrary documents).
+            return []
+        out = [key for _s, key in heapq.nsmallest(k, positive, key=lambda x: (-x[0], x[1]))]
+        if len(out) >= k:
+            return out
+        for doc_id, pos in conn.execute("SELECT doc_id, pos FROM chunks ORDER BY doc_id, pos"):
+            key = (str(doc_id), int(pos))
+            if scores.get(key, 0.0) != 0.0:
+                continue
+            out.append(key)
+            if len(out) >= k:
+                return out
+        negative = [(s, key) for key, s in scores.items() if s < 0.0]
+        out.extend(key for _s, key in heapq.nsmallest(k - len(out), negative, key=lambda x: (-x[0], x[1])))
+        return out
+
+    def _materialize(
+        self,
+        keys: list[tuple[str, int]],
+        scores: dict[tuple[str, int], float],
+        doc_sha1: dict[str, str],
+    ) -> list[dict]:
+        store = self._store
+        doc_chunks: dict[str, list[dict]] = {}
+        hits: list[dict] = []
+        for doc_id, pos in keys:
+            score = float(scores.get((doc_id, pos), 0.0))
+            rec = store.doc_record(doc_id) if store is not None else None
+            if rec is not None and rec[0] == doc_sha1.get(doc_id) and pos < rec[1]:
+                i = store.doc_range(doc_id)[pos]
+                hits.append({"score": score, "id": store.chunk_id(i), "text": store.text(i), "meta": store.meta(i)})
+                continue
+            if doc_id not in doc_chunks:
+                try:
+                    doc_chunks[doc_id] = load_doc_chunks(self._db_dir, doc_id)
+                except Exception:
+                    doc_chunks[doc_id] = []
+            chunks = doc_chunks[doc_id]
+            if pos >= len(chunks):
+                continue
+            c = chunks[pos]
+            hits.append(
+                {
+                    "score": score,
+                    "id": c.get("id", f"{doc_id}:{pos}"),
+                    "text": c.get("text", ""),
+                    "meta": c.get("meta", {}),
+                }
+            )
+        return hits
+
+
+def open_bm25_index(db_dir: Path) -> BM25IndexRetriever | None:
+    """Open the on-disk index if it matches docs.json; None when missing or stale."""
+    if not bm25_index_is_fresh(db_dir):
+        return None
+    try:
+        return BM25IndexRetriever(db_dir)
+    except sqlite3.Error:
+        return None
+
+
+def load_retriever(db_dir: Path) -> BM25IndexRetriever | BM25Retriever:
+    """
+    Prefer the persistent index, bringing it up to date with docs.json first.
+    Falls back to an in-memory BM25 if the index cannot be written; that one reads
+    chunk texts from the columnar store when it is fresh instead of holding them.
+    """
+    if not bm25_index_is_fresh(db_dir):
+        try:
+            sync_bm25_index(db_dir)
+        except (sqlite3.Error, OSError):
+            pass
+    idx = open_bm25_index(db_dir)
+    if idx is not None:
+        return idx
+    store = open_columnar_store(db_dir)
+    if store is not None:
+        return BM25Retriever.from_store(store, tokens_db=db_dir)
+    return BM25Retriever(load_all_chunks(db_dir), tokens_db=db_dir)
+
+
+def refresh_retriever(db_dir: Path, current=None) -> BM25IndexRetriever | BM25Retriever:
+    """
+    Bring a loaded retriever up to date after docs.json changed.
+    For an index-backed retriever only the docs delta is applied before reopening;
+    anything else is reloaded. `current` itself is left untouched, so threads that
+    still hold it keep a consistent object.
+    """
+    if isinstance(current, BM25IndexRetriever) and current.db_dir == Path(db_dir):
+        try:
+            sync_bm25_index(db_dir)
+            return BM25IndexRetriever(db_dir)
+        except (sqlite3.Error, OSError):
+            pass
+    return load_retriever(db_dir)
@@ -1,10 +1,231 @@
 from __future__ import annotations
 
+import atexit
+import hashlib
+import os
 import sqlite3
+import threading
 import time
 import uuid
 import json
+import zlib
 from pathlib import Path
+from typing import Any
+
+# Connections are long-lived and thread-affine: one per (thread, db file), reused by every
+# ChatStore on that file, so statements stay prepared and PRAGMAs run once per connection.
+_LOCAL = threading.local()
+_INIT_LOCK = threading.Lock()
+_INITIALIZED: set[str] = set()
+# db file -> tokenizer of its messages_fts table ("" when FTS5 is unavailable).
+_FTS_TOKENIZER: dict[str, str] = {}
+# Search ranks (bm25) at most this many of the newest matches, so very common terms stay cheap.
+_FTS_RANK_POOL = 2000
+
+
+_REFS_COLUMNS = (
+    "user_msg_id, conv_id, prompt, prompt_sig, hits_json, scores_json, hits_z, scores_z, used_query, used_translation, created_at, updated_at"
+)
+
+# Refs storage: message_refs.hits_z / scores_z hold zlib-compressed JSON, and the bulky per-doc
+# parts of each hit (its ref_headings list, snippet texts) live once in ref_parts, content-addressed
+# and compressed, referenced by id. A paper's headings are then stored once, not once per question.
+# message_ref_parts links rows to the parts they use, so unreferenced parts can be dropped.
+_PART_WHOLE_KEYS = ("ref_headings",)
+_PART_EACH_KEYS = ("ref_snippets", "ref_show_snippets")
+
+
+def _zpack(obj) -> bytes:
+    return zlib.compress(json.dumps(obj, ensure_ascii=False, default=str).encode("utf-8"), 6)
+
+
+def _zunpack(blob):
+    return json.loads(zlib.decompress(bytes(blob)).decode("utf-8"))
+
+
+def _put_part(conn: sqlite3.Connection, value, used: set[int]) -> int:
+    raw = json.dumps(value, ensure_ascii=False, default=str).encode("utf-8")
+    digest = hashlib.sha1(raw).digest()
+    # Callers hold the write lock (BEGIN IMMEDIATE), so the part cannot vanish before it is linked.
+    conn.execute("INSERT OR IGNORE INTO ref_parts (digest, payload) VALUES (?, ?)", (digest, zlib.compress(raw, 6)))
+    pid = int(conn.execute("SELECT id FROM ref_parts WHERE digest = ?", (digest,)).fetchone()[0])
+    used.add(pid)
+    return pid
+
+
+def _pack_hits(conn: sqlite3.Connection, hits: list) -> tuple[bytes, set[int]]:
+    """Compressed hits with headings/snippets moved to ref_parts; also returns the part ids used."""
+    used: set[int] = set()
+    out: list[dict] = []
+    for h in hits:
+        if not isinstance(h, dict):
+            out.append({"h": h})
+            continue
+        h2 = dict(h)
+        parts: dict[str, Any] = {}
+        meta = h2.get("meta")
+        if isinstance(meta, dict):
+            meta = dict(meta)
+            for k in _PART_WHOLE_KEYS:
+                v = meta.get(k)
+                if isinstance(v, list) and v:
+                    parts[k] = _put_part(conn, meta.pop(k), used)
+            for k in _PART_EACH_KEYS:
+                v = meta.get(k)
+                if isinstance(v, list) and v and all(isinstance(x, str) for x in v):
+                    parts[k] = [_put_part(conn, x, used) for x in meta.pop(k)]
+            h2["meta"] = meta
+        txt = h2.get("text")
+        if isinstance(txt, str) and txt:
+            parts["text"] = _put_part(conn, h2.pop("text"), used)
+        out.append({"h": h2, "p": parts} if parts else {"h": h2})
+    return _zpack(out), used
+
+
+def _unpack_hits(packed: list, parts: dict[int, Any]) -> list:
+    out: list = []
+    for ent in packed:
+        h = ent.get("h") if isinstance(ent, dict) else None
+        p = ent.get("p") if isinstance(ent, dict) else None
+        if not isinstance(h, dict) or not isinstance(p, dict):
+            out.append(h)
+            continue
+        meta = dict(h.get("meta") or {})
+        for k, v in p.items():
+            if k == "text":
+                h["text"] = parts.get(v, "")
+            elif isinstance(v, list):
+                meta[k] = [parts.get(i, "") for i in v]
+            else:
+                v2 = parts.get(v, [])
+                # Shared between rows that reference the same part; hand out copies.
+                meta[k] = list(v2) if isinstance(v2, list) else v2
+        if "meta" in h or meta:
+            h["meta"] = meta
+        out.append(h)
+    return out
+
+
+def _part_ids(packed: list) -> set[int]:
+    ids: set[int] = set()
+    for ent in packed:
+        p = ent.get("p") if isinstance(ent, dict) else None
+        for v in (p or {}).values():
+            if isinstance(v, list):
+                ids.update(int(i) for i in v)
+            else:
+                ids.add(int(v))
+    return ids
+
+
+def _load_parts(conn: sqlite3.Connection, ids: set[int]) -> dict[int, Any]:
+    out: dict[int, Any] = {}
+    ids_l = sorted(ids)
+    for k in range(0, len(ids_l), 500):
+        part = ids_l[k : k + 500]
+        for pid, payload in conn.execute(
+            f"SELECT id, payload FROM ref_parts WHERE id IN ({','.join('?' * len(part))})", part
+        ).fetchall():
+            try:
+                out[int(pid)] = _zunpack(payload)
+            except Exception:
+                pass
+    return out
+
+
+def _link_parts(conn: sqlite3.Connection, user_msg_id: int, used: set[int]) -> None:
+    """Point one message_refs row at `used`, dropping parts no row references any more."""
+    old = {int(r[0]) for r in conn.execute("SELECT part_id FROM message_ref_parts WHERE user_msg_id = ?", (user_msg_id,))}
+    conn.execute("DELETE FROM message_ref_parts WHERE user_msg_id = ?", (user_msg_id,))
+    conn.executemany("INSERT INTO message_ref_parts (user_msg_id, part_id) VALUES (?, ?)", ((user_msg_id, p) for p in sorted(used)))
+    _drop_orphan_parts(conn, old - used)
+
+
+def _drop_orphan_parts(conn: sqlite3.Connection, ids) -> None:
+    conn.executemany(
+        "DELETE FROM ref_parts WHERE id = ? AND NOT EXISTS (SELECT 1 FROM message_ref_parts WHERE part_id = ?)",
+        ((int(p), int(p)) for p in ids),
+    )
+
+
+def _unlink_refs(conn: sqlite3.Connection, where: str, params: tuple) -> None:
+    """Delete message_refs rows matching `where` together with their part links and orphaned parts."""
+    ids = [int(r[0]) for r in conn.execute(f"SELECT user_msg_id FROM message_refs WHERE {where}", params)]
+    parts: set[int] = set()
+    for mid in ids:
+        parts.update(int(r[0]) for r in conn.execute("SELECT part_id FROM message_ref_parts WHERE user_msg_id = ?", (mid,)))
+        conn.execute("DELETE FROM message_ref_parts WHERE user_msg_id = ?", (mid,))
+    conn.execute(f"DELETE FROM message_refs WHERE {where}", params)
+    _drop_orphan_parts(conn, parts)
+
+
+def _json_list(text) -> list:
+    try:
+        v = json.loads(text or "[]")
+    except Exception:
+        return []
+    return v if isinstance(v, list) else []
+
+
+def _refs_by_user_msg(conn: sqlite3.Connection, rows) -> dict[int, dict]:
+    packed_by_mid: dict[int, list] = {}
+    ids: set[int] = set()
+    for r in rows:
+        if r["hits_z"] is None:
+            continue
+        try:
+            packed = _zunpack(r["hits_z"])
+        except Exception:
+            packed = []
+        packed = packed if isinstance(packed, list) else []
+        packed_by_mid[int(r["user_msg_id"] or 0)] = packed
+        ids |= _part_ids(packed)
+    parts = _load_parts(conn, ids) if ids else {}
+
+    out: dict[int, dict] = {}
+    for r in rows:
+        try:
+            mid = int(r["user_msg_id"] or 0)
+        except Exception:
+            mid = 0
+        if mid <= 0:
+            continue
+        if r["hits_z"] is not None:
+            hits = _unpack_hits(packed_by_mid.get(mid) or [], parts)
+            try:
+                scores = _zunpack(r["scores_z"]) if r["scores_z"] is not None else []
+            except Exception:
+                scores = []
+            if not isinstance(scores, list):
+                scores = []
+        else:
+            # Row written before the compressed layout (and not migrated yet).
+            hits = _json_list(r["hits_json"])
+            scores = _json_list(r["scores_json"])
+        out[mid] = {
+            "user_msg_id": mid,
+            "conv_id": str(r["conv_id"] or ""),
+            "prompt": str(r["prompt"] or ""),
+            "prompt_sig": str(r["prompt_sig"] or ""),
+            "hits": hits,
+            "scores": scores,
+            "used_query": str(r["used_query"] or ""),
+            "used_translation": bool(int(r["used_translation"] or 0)),
+            "created_at": float(r["created_at"] or 0.0),
+            "updated_at": float(r["updated_at"] or 0.0),
+        }
+    return out
+
+
+def _search_hit(r, snippet: str) -> dict:
+    return {
+        "conv_id": str(r["conv_id"] or ""),
+        "title": str(r["title"] or ""),
+        "message_id": int(r["id"]),
+        "role": str(r["role"] or ""),
+        "created_at": float(r["created_at"] or 0.0),
+        "snippet": snippet.replace("\n", " ").strip(),
+    }
 
 
 class ChatStore:
@@ -17,19 +238,37 @@ class ChatStore:
 
     def __init__(self, db_path: Path) -> None:
         self._db_path = Path(db_path)
-        self._db_path.parent.mkdir(parents=True, exist_ok=True)
-        self._init_db()
+        try:
+            self._key = str(self._db_path.expanduser().resolve())
+        except Exception:
+            self._key = str(self._db_path)
+        # Schema DDL runs once per file per process (cheap to build a ChatStore per call site).
+        with _INIT_LOCK:
+            if self._key not in _INITIALIZED:
+                self._db_path.parent.mkdir(parents=True, exist_ok=True)
+                self._init_db()
+                _INITIALIZED.add(self._key)
 
     def _connect(self) -> sqlite3.Connection:
-        # WAL helps concurrent reads while Streamlit reruns.
-        conn = sqlite3.connect(str(self._db_path), timeout=30, check_same_thread=False)
-        conn.row_factory = sqlite3.Row
-        conn.execute("PRAGMA journal_mode=WAL;")
-        conn.execute("PRAGMA synchronous=NORMAL;")
+        """This thread's connection to the db file (opened on first use, then reused)."""
+        conns: dict[str, sqlite3.Connection] | None = getattr(_LOCAL, "conns", None)
+        if conns is None:
+            conns = {}
+            _LOCAL.conns = conns
+        conn = conns.get(self._key)
+        if conn is None:
+            # WAL helps concurrent reads while Streamlit reruns.
+            conn = sqlite3.connect(str(self._db_path), timeout=30, cached_statements=256)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL;")
+            conn.execute("PRAGMA synchronous=NORMAL;")
+            conns[self._key] = conn
         return conn
 
     def _init_db(self) -> None:
         with self._connect() as conn:
+            # One writer at a time, so concurrent processes do not migrate the same rows twice.
+            conn.execute("BEGIN IMMEDIATE")
             conn.execute(
                 """
                 CREATE TABLE IF NOT EXISTS conversations (
@@ -70,6 +309,86 @@ class ChatStore:
                 """
             )
             conn.execute("CREATE INDEX IF NOT EXISTS idx_message_refs_conv_id ON message_refs(conv_id);")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS ref_parts (
+                  id INTEGER PRIMARY KEY,
+                  digest BLOB NOT NULL UNIQUE,
+                  payload BLOB NOT NULL
+                );
+                """
+            )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS message_ref_parts (
+                  user_msg_id INTEGER NOT NULL,
+                  part_id INTEGER NOT NULL,
+                  PRIMARY KEY (user_msg_id, part_id)
+                ) WITHOUT ROWID;
+                """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_message_ref_parts_part ON message_ref_parts(part_id);")
+            cols = {str(r[1]) for r in conn.execute("PRAGMA table_info(message_refs)")}
+            if "hits_z" not in cols:
+                conn.execute("ALTER TABLE message_refs ADD COLUMN hits_z BLOB")
+                conn.execute("ALTER TABLE message_refs ADD COLUMN scores_z BLOB")
+            self._migrate_refs(conn)
+            _FTS_TOKENIZER[self._key] = self._init_fts(conn)
+
+    def _init_fts(self, conn: sqlite3.Connection) -> str:
+        """
+        messages_fts mirrors messages.content (external content table, synced by triggers).
+        trigram matches CJK text by substring; unicode61 is the fallback on older SQLite builds.
+        """
+        row = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'").fetchone()
+        if row is None:
+            for tok in ("trigram", "unicode61"):
+                try:
+                    conn.execute(
+                        f"CREATE VIRTUAL TABLE messages_fts USING fts5(content, content='messages', content_rowid='id', tokenize='{tok}')"
+                    )
+                    break
+                except sqlite3.OperationalError:
+                    continue
+            else:
+                return ""
+            conn.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
+            row = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'").fetchone()
+        conn.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN
+              INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+            END;
+            """
+        )
+        conn.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages BEGIN
+              INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+            END;
+            """
+        )
+        conn.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF content ON messages BEGIN
+              INSERT INTO messages_fts(messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+              INSERT INTO messages_fts(rowid, content) VALUES (new.id, new.content);
+            END;
+            """
+        )
+        return "trigram" if "trigram" in str(row[0] or "") else "unicode61"
+
+    def _migrate_refs(self, conn: sqlite3.Connection) -> None:
+        """Move rows still holding plain hits_json/scores_json to the compressed layout."""
+        rows = conn.execute("SELECT user_msg_id, hits_json, scores_json FROM message_refs WHERE hits_z IS NULL").fetchall()
+        for r in rows:
+            mid = int(r["user_msg_id"] or 0)
+            hits_z, used = _pack_hits(conn, _json_list(r["hits_json"]))
+            conn.execute(
+                "UPDATE message_refs SET hits_z = ?, scores_z = ?, hits_json = '', scores_json = '' WHERE user_msg_id = ?",
+                (hits_z, _zpack(_json_list(r["scores_json"])), mid),
+            )
+            _link_parts(conn, mid, used)
 
     def create_conversation(self, title: str = "新对话") -> str:
         conv_id = uuid.uuid4().hex
@@ -91,7 +410,8 @@ class ChatStore:
 
     def delete_conversation(self, conv_id: str) -> None:
         with self._connect() as conn:
-            conn.execute("DELETE FROM message_refs WHERE conv_id = ?", (conv_id,))
+            conn.execute("BEGIN IMMEDIATE")
+            _unlink_refs(conn, "conv_id = ?", (conv_id,))
             conn.execute("DELETE FROM messages WHERE conv_id = ?", (conv_id,))
             conn.execute("DELETE FROM conversations WHERE id = ?", (conv_id,))
 
@@ -119,6 +439,34 @@ class ChatStore:
             rows = conn.execute(sql, params).fetchall()
         return [dict(r) for r in rows]
 
+    def get_messages_before(self, conv_id: str, before_id: int | None, limit: int) -> list[dict]:
+        """
+        Keyset page: the newest `limit` messages with id < before_id (newest of the conversation
+        if before_id is None/0), returned in ascending id order.
+        """
+        n = max(0, int(limit))
+        if n <= 0:
+            return []
+        bid = int(before_id or 0)
+        with self._connect() as conn:
+            if bid > 0:
+                rows = conn.execute(
+                    "SELECT id, role, content, created_at FROM messages WHERE conv_id = ? AND id < ? ORDER BY id DESC LIMIT ?",
+                    (conv_id, bid, n),
+                ).fetchall()
+            else:
+                rows = conn.execute(
+                    "SELECT id, role, content, created_at FROM messages WHERE conv_id = ? ORDER BY id DESC LIMIT ?",
+                    (conv_id, n),
+                ).fetchall()
+        return [dict(r) for r in reversed(rows)]
+
+    def count_messages_from(self, conv_id: str, message_id: int) -> int:
+        """Messages of conv_id with id >= message_id (how large a newest-first window must be to show it)."""
+        with self._connect() as conn:
+            row = conn.execute("SELECT COUNT(*) FROM messages WHERE conv_id = ? AND id >= ?", (conv_id, int(message_id or 0))).fetchone()
+        return int(row[0] or 0)
+
     def append_message(self, conv_id: str, role: str, content: str) -> int:
         role = (role or "").strip()
         if role not in ("user", "assistant", "system"):
@@ -150,16 +498,36 @@ class ChatStore:
             conn.execute("UPDATE conversations SET updated_at = ? WHERE id = ?", (now, row["conv_id"]))
         return True
 
+    def update_messages_content(self, contents: dict[int, str]) -> int:
+        """Batched update_message_content in one transaction; returns the number of messages updated."""
+        items = [(int(mid), (text or "").strip()) for mid, text in (contents or {}).items() if int(mid or 0) > 0]
+        if not items:
+            return 0
+        now = time.time()
+        n = 0
+        conv_ids: set[str] = set()
+        with self._connect() as conn:
+            for mid, text in items:
+                row = conn.execute("SELECT conv_id FROM messages WHERE id = ?", (mid,)).fetchone()
+                if not row:
+                    continue
+                conn.execute("UPDATE messages SET content = ? WHERE id = ?", (text, mid))
+                conv_ids.add(str(row["conv_id"]))
+                n += 1
+            conn.executemany("UPDATE conversations SET updated_at = ? WHERE id = ?", ((now, c) for c in conv_ids))
+        return n
+
     def delete_message(self, message_id: int) -> bool:
         mid = int(message_id or 0)
         if mid <= 0:
             return False
         now = time.time()
         with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
             row = conn.execute("SELECT conv_id FROM messages WHERE id = ?", (mid,)).fetchone()
             if not row:
                 return False
-            conn.execute("DELETE FROM message_refs WHERE user_msg_id = ?", (mid,))
+            _unlink_refs(conn, "user_msg_id = ?", (mid,))
             conn.execute("DELETE FROM messages WHERE id = ?", (mid,))
             conn.execute("UPDATE conversations SET updated_at = ? WHERE id = ?", (now, row["conv_id"]))
         return True
@@ -185,21 +553,22 @@ class ChatStore:
         prompt_sig = (prompt_sig or "").strip()
         used_query = (used_query or "").strip()
         try:
-            hits_json = json.dumps(list(hits or []), ensure_ascii=False, default=str)
+            hits_l = json.loads(json.dumps(list(hits or []), ensure_ascii=False, default=str))
         except Exception:
-            hits_json = "[]"
+            hits_l = []
         try:
-            scores_json = json.dumps(list(scores or []), ensure_ascii=False, default=str)
+            scores_z = _zpack(list(scores or []))
         except Exception:
-            scores_json = "[]"
+            scores_z = _zpack([])
         with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            hits_z, used = _pack_hits(conn, hits_l)
             row = conn.execute("SELECT user_msg_id, created_at FROM message_refs WHERE user_msg_id = ?", (mid,)).fetchone()
             if row:
-                created_at = float(row["created_at"] or now)
                 conn.execute(
                     """
                     UPDATE message_refs
-                    SET conv_id = ?, prompt = ?, prompt_sig = ?, hits_json = ?, scores_json = ?,
+                    SET conv_id = ?, prompt = ?, prompt_sig = ?, hits_json = '', scores_json = '', hits_z = ?, scores_z = ?,
                         used_query = ?, used_translation = ?, updated_at = ?
                     WHERE user_msg_id = ?
                     """,
@@ -207,8 +576,8 @@ class ChatStore:
                         conv_id,
                         prompt,
                         prompt_sig,
-                        hits_json,
-                        scores_json,
+                        hits_z,
+                        scores_z,
                         used_query,
                         1 if bool(used_translation) else 0,
                         now,
@@ -216,72 +585,119 @@ class ChatStore:
                     ),
                 )
             else:
-                created_at = now
                 conn.execute(
                     """
                     INSERT INTO message_refs
-                    (user_msg_id, conv_id, prompt, prompt_sig, hits_json, scores_json, used_query, used_translation, created_at, updated_at)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    (user_msg_id, conv_id, prompt, prompt_sig, hits_json, scores_json, hits_z, scores_z, used_query, used_translation, created_at, updated_at)
+                    VALUES (?, ?, ?, ?, '', '', ?, ?, ?, ?, ?, ?)
                     """,
                     (
                         mid,
                         conv_id,
                         prompt,
                         prompt_sig,
-                        hits_json,
-                        scores_json,
+                        hits_z,
+                        scores_z,
                         used_query,
                         1 if bool(used_translation) else 0,
-                        created_at,
+                        now,
                         now,
                     ),
                 )
+            _link_parts(conn, mid, used)
         return True
 
     def list_message_refs(self, conv_id: str) -> dict[int, dict]:
         with self._connect() as conn:
             rows = conn.execute(
-                """
-                SELECT user_msg_id, conv_id, prompt, prompt_sig, hits_json, scores_json, used_query,
-                       used_translation, created_at, updated_at
-                FROM message_refs
-                WHERE conv_id = ?
-                ORDER BY user_msg_id ASC
-                """,
+                f"SELECT {_REFS_COLUMNS} FROM message_refs WHERE conv_id = ? ORDER BY user_msg_id ASC",
                 (conv_id,),
             ).fetchall()
-        out: dict[int, dict] = {}
+            return _refs_by_user_msg(conn, rows)
+
+    def list_message_refs_for_ids(self, user_msg_ids) -> dict[int, dict]:
+        """Same shape as list_message_refs, but only decodes the refs of the given user messages."""
+        ids = sorted({int(x) for x in (user_msg_ids or []) if int(x or 0) > 0})
+        rows: list = []
+        with self._connect() as conn:
+            for k in range(0, len(ids), 500):
+                part = ids[k : k + 500]
+                rows.extend(
+                    conn.execute(
+                        f"SELECT {_REFS_COLUMNS} FROM message_refs WHERE user_msg_id IN ({','.join('?' * len(part))}) ORDER BY user_msg_id ASC",
+                        part,
+                    ).fetchall()
+                )
+            return _refs_by_user_msg(conn, rows)
+
+    def search_messages(self, query: str, limit: int = 20, *, open_mark: str = "[", close_mark: str = "]") -> list[dict]:
+        """
+        Full-text search over all messages, best match first (bm25).
+        - whitespace-separated terms must all occur (each matched as a phrase)
+        - ranking covers the newest _FTS_RANK_POOL matches
+        - returns conv_id, conv title, message_id, role, created_at and a snippet with the matches marked
+        """
+        terms = [t for t in (query or "").split() if t]
+        n = max(1, int(limit))
+        if not terms:
+            return []
+        tok = _FTS_TOKENIZER.get(self._key, "")
+        if (not tok) or (tok == "trigram" and any(len(t) < 3 for t in terms)):
+            return self._search_messages_like(terms, n, open_mark=open_mark, close_mark=close_mark)
+        match = " ".join('"' + t.replace('"', '""') + '"' for t in terms)
+        with self._connect() as conn:
+            # Walking matches in rowid order is cheap; bm25 over all of them is not.
+            floor = conn.execute(
+                "SELECT rowid FROM messages_fts WHERE messages_fts MATCH ? ORDER BY rowid DESC LIMIT 1 OFFSET ?",
+                (match, _FTS_RANK_POOL - 1),
+            ).fetchone()
+            # Rank first, then build snippets for the returned rows only.
+            top = conn.execute(
+                "SELECT rowid FROM messages_fts WHERE messages_fts MATCH ? AND rowid >= ? ORDER BY rank LIMIT ?",
+                (match, int(floor[0]) if floor else 0, n),
+            ).fetchall()
+            ids = [int(r[0]) for r in top]
+            if not ids:
+                return []
+            rows = conn.execute(
+                f"""
+                SELECT m.id, m.conv_id, m.role, m.created_at, c.title,
+                       snippet(messages_fts, 0, ?, ?, '…', 24) AS snippet
+                FROM messages_fts
+                JOIN messages m ON m.id = messages_fts.rowid
+                LEFT JOIN conversations c ON c.id = m.conv_id
+                WHERE messages_fts MATCH ? AND messages_fts.rowid IN ({','.join('?' * len(ids))})
+                """,
+                (open_mark, close_mark, match, *ids),
+            ).fetchall()
+        by_id = {int(r["id"]): r for r in rows}
+        return [_search_hit(by_id[i], str(by_id[i]["snippet"] or "")) for i in ids if i in by_id]
+
+    def _search_messages_like(self, terms: list[str], limit: int, *, open_mark: str, close_mark: str) -> list[dict]:
+        """Substring scan (newest first) for queries FTS cannot serve, e.g. 1-2 character CJK terms."""
+        where = " AND ".join("m.content LIKE ? ESCAPE '\\'" for _ in terms)
+        params = ["%" + t.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%" for t in terms]
+        with self._connect() as conn:
+            rows = conn.execute(
+                f"""
+                SELECT m.id, m.conv_id, m.role, m.created_at, m.content, c.title
+                FROM messages m LEFT JOIN conversations c ON c.id = m.conv_id
+                WHERE {where}
+                ORDER BY m.id DESC LIMIT ?
+                """,
+                (*params, int(limit)),
+            ).fetchall()
+        out: list[dict] = []
         for r in rows:
-            try:
-                mid = int(r["user_msg_id"] or 0)
-            except Exception:
-                mid = 0
-            if mid <= 0:
+            content = str(r["content"] or "")
+            i = content.lower().find(terms[0].lower())
+            if i < 0:
+                out.append(_search_hit(r, content[:100]))
                 continue
-            try:
-                hits = json.loads(r["hits_json"] or "[]")
-            except Exception:
-                hits = []
-            if not isinstance(hits, list):
-                hits = []
-            try:
-                scores = json.loads(r["scores_json"] or "[]")
-            except Exception:
-                scores = []
-            if not isinstance(scores, list):
-                scores = []
-            out[mid] = {
-                "user_msg_id": mid,
-                "conv_id": str(r["conv_id"] or ""),
-                "prompt": str(r["prompt"] or ""),
-                "prompt_sig": str(r["prompt_sig"] or ""),
-                "hits": hits,
-                "scores": scores,
-                "used_query": str(r["used_query"] or ""),
-                "used_translation": bool(int(r["used_translation"] or 0)),
-                "created_at": float(r["created_at"] or 0.0),
-                "updated_at": float(r["updated_at"] or 0.0),
-            }
+            a = max(0, i - 40)
+            b = min(len(content), i + len(terms[0]) + 60)
+            snip = content[a:i] + open_mark + content[i : i + len(terms[0])] + close_mark + content[i + len(terms[0]) : b]
+            out.append(_search_hit(r, ("…" if a > 0 else "") + snip + ("…" if b < len(content) else "")))
         return out
 
     def set_title_if_default(self, conv_id: str, new_title: str) -> None:
@@ -302,3 +718,74 @@ class ChatStore:
                 "UPDATE conversations SET title = ?, updated_at = ? WHERE id = ?",
                 (new_title, now, conv_id),
             )
+
+
+class ChatCheckpointWriter:
+    """
+    Write-behind buffer for streamed partial answers.
+    - keeps only the latest text per (db file, message id)
+    - one writer thread flushes every interval_s, one transaction per db file
+    - drop() before writing a final answer, so a late checkpoint cannot overwrite it
+    """
+
+    def __init__(self, interval_s: float = 1.0) -> None:
+        self._interval_s = max(0.05, float(interval_s))
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._pending: dict[tuple[str, int], tuple[Path, str]] = {}
+        self._thread: threading.Thread | None = None
+
+    def put(self, db_path: Path, message_id: int, content: str) -> None:
+        mid = int(message_id or 0)
+        if mid <= 0:
+            return
+        p = Path(db_path)
+        with self._lock:
+            self._pending[(str(p), mid)] = (p, str(content or ""))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="kb-chat-checkpoints", daemon=True)
+                self._thread.start()
+
+    def drop(self, db_path: Path, message_id: int) -> None:
+        """Forget the pending checkpoint of one message and wait for a write in progress."""
+        with self._lock:
+            self._pending.pop((str(Path(db_path)), int(message_id or 0)), None)
+        with self._write_lock:
+            pass
+
+    def flush(self) -> None:
+        """Write everything pending now (synchronously, in the caller's thread)."""
+        with self._write_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+            by_db: dict[str, tuple[Path, dict[int, str]]] = {}
+            for (key, mid), (p, text) in batch.items():
+                by_db.setdefault(key, (p, {}))[1][mid] = text
+            for p, contents in by_db.values():
+                try:
+                    ChatStore(p).update_messages_content(contents)
+                except Exception:
+                    pass
+
+    def _loop(self) -> None:
+        while True:
+            time.sleep(self._interval_s)
+            self.flush()
+
+
+_CHECKPOINT_WRITER: ChatCheckpointWriter | None = None
+_CHECKPOINT_WRITER_LOCK = threading.Lock()
+
+
+def checkpoint_writer() -> ChatCheckpointWriter:
+    """Process-wide checkpoint writer; flush interval from KB_CHECKPOINT_FLUSH_S (default 1.0)."""
+    global _CHECKPOINT_WRITER
+    with _CHECKPOINT_WRITER_LOCK:
+        if _CHECKPOINT_WRITER is None:
+            try:
+                interval = float(os.environ.get("KB_CHECKPOINT_FLUSH_S", "1.0"))
+            except ValueError:
+                interval = 1.0
+            _CHECKPOINT_WRITER = ChatCheckpointWriter(interval)
+            atexit.register(_CHECKPOINT_WRITER.flush)
+        return _CHECKPOINT_WRITER
@@ -0,0 +1,270 @@
+"""
+Columnar chunk store, kept alongside the per-doc JSONL files.
+
+Layout (one immutable generation directory, named in <db>/colstore/CURRENT):
+- text.bin / text_off.u64        all chunk texts (UTF-8) + n+1 byte offsets
+- heading.bin / heading_off.u64  heading_path per chunk, same encoding
+- doc_idx.u32 / pos.u32          owning doc (index into header "docs") and position in it
+- source_idx.i32                 index into header "source_paths" (-1: none)
+- page_start.i32 / page_end.i32 / char_len.i32   (-1: missing)
+- header.json                    counts, docs (doc_id, sha1, num_chunks, first, count), source_paths
+
+Numeric columns are memory-mapped with numpy; texts are sliced from an mmap on demand,
+so opening the store does not decode or allocate per-chunk objects.
+Only the meta keys emitted by chunk_markdown() are stored.
+"""
+
+from __future__ import annotations
+
+import json
+import mmap
+import os
+import shutil
+import time
+from pathlib import Path
+from typing import Iterator
+
+import numpy as np
+
+from .store import current_doc_records, load_doc_chunks
+
+_STORE_VERSION = 1
+_CURRENT = "CURRENT"
+
+_COLUMNS: dict[str, str] = {
+    "text_off.u64": "<u8",
+    "heading_off.u64": "<u8",
+    "doc_idx.u32": "<u4",
+    "pos.u32": "<u4",
+    "source_idx.i32": "<i4",
+    "page_start.i32": "<i4",
+    "page_end.i32": "<i4",
+    "char_len.i32": "<i4",
+}
+
+
+def colstore_dir(db_dir: Path) -> Path:
+    return Path(db_dir) / "colstore"
+
+
+def _current_generation(db_dir: Path) -> Path | None:
+    root = colstore_dir(db_dir)
+    try:
+        name = (root / _CURRENT).read_text(encoding="utf-8").strip()
+    except OSError:
+        return None
+    if not name:
+        return None
+    gen = root / name
+    return gen if gen.is_dir() else None
+
+
+def _opt_int(v) -> int:
+    try:
+        return int(v) if v is not None else -1
+    except Exception:
+        return -1
+
+
+def write_columnar_store(
+    db_dir: Path,
+    prev: ColumnarChunkStore | None = None,
+    *,
+    force_doc_ids: set[str] | None = None,
+) -> int:
+    """
+    Write a new generation of the columnar store from the JSONL chunk files.
+    Docs whose (sha1, num_chunks) match `prev` are copied from it instead of re-parsing JSON,
+    except force_doc_ids (re-chunked docs whose record may not have changed).
+
+    Returns the number of chunks written.
+    """
+    db_dir = Path(db_dir)
+    root = colstore_dir(db_dir)
+    root.mkdir(parents=True, exist_ok=True)
+    name = f"gen-{time.time_ns()}-{os.getpid()}"
+    gen = root / name
+    gen.mkdir()
+
+    records = current_doc_records(db_dir)
+    force = set(force_doc_ids or ())
+    cols: dict[str, list[int]] = {k: [] for k in _COLUMNS}
+    cols["text_off.u64"].append(0)
+    cols["heading_off.u64"].append(0)
+    source_paths: list[str] = []
+    source_ix: dict[str, int] = {}
+    docs_out: list[list] = []
+    text_end = 0
+    heading_end = 0
+    n = 0
+
+    with (gen / "text.bin").open("wb") as f_text, (gen / "heading.bin").open("wb") as f_head:
+        for doc_idx, (doc_id, (sha1, num)) in enumerate(records.items()):
+            rng = None
+            if (prev is not None) and (doc_id not in force) and prev.doc_record(doc_id) == (sha1, num):
+                rng = prev.doc_range(doc_id)
+            if rng is not None:
+                chunks: Iterator[dict] = (prev.chunk(i) for i in rng)
+            else:
+                chunks = iter(load_doc_chunks(db_dir, doc_id))
+            first = n
+            for pos, c in enumerate(chunks):
+                meta = c.get("meta", {}) or {}
+                tb = str(c.get("text", "") or "").encode("utf-8")
+                hb = str(meta.get("heading_path", "") or "").encode("utf-8")
+                f_text.write(tb)
+                f_head.write(hb)
+                text_end += len(tb)
+                heading_end += len(hb)
+                src = meta.get("source_path")
+                if src is None:
+                    si = -1
+                else:
+                    src = str(src)
+                    si = source_ix.get(src, -1)
+                    if si < 0:
+                        si = len(source_paths)
+                        source_ix[src] = si
+                        source_paths.append(src)
+                cols["text_off.u64"].append(text_end)
+                cols["heading_off.u64"].append(heading_end)
+                cols["doc_idx.u32"].append(doc_idx)
+                cols["pos.u32"].append(pos)
+                cols["source_idx.i32"].append(si)
+                cols["page_start.i32"].append(_opt_int(meta.get("page_start")))
+                cols["page_end.i32"].append(_opt_int(meta.get("page_end")))
+                cols["char_len.i32"].append(_opt_int(meta.get("char_len")))
+                n += 1
+            docs_out.append([doc_id, sha1, num, first, n - first])
+
+    for fname, dtype in _COLUMNS.items():
+        np.asarray(cols[fname], dtype=dtype).tofile(str(gen / fname))
+    header = {"version": _STORE_VERSION, "n": n, "docs": docs_out, "source_paths": source_paths}
+    (gen / "header.json").write_text(json.dumps(header, ensure_ascii=False), encoding="utf-8")
+
+    # Switch readers to the new generation atomically, then drop old ones that are not in use.
+    tmp = root / f"{_CURRENT}.tmp{os.getpid()}"
+    tmp.write_text(name, encoding="utf-8")
+    os.replace(tmp, root / _CURRENT)
+    for old in root.glob("gen-*"):
+        if old.name != name:
+            # Still mapped by a reader on Windows: left for the next write to clean up.
+            shutil.rmtree(old, ignore_errors=True)
+    return n
+
+
+def convert_jsonl_to_columnar(db_dir: Path, *, force_doc_ids: set[str] | None = None) -> int:
+    """Converter from the JSONL layout; reuses unchanged docs of an existing store."""
+    prev = open_columnar_store(db_dir, require_fresh=False)
+    try:
+        return write_columnar_store(db_dir, prev=prev, force_doc_ids=force_doc_ids)
+    finally:
+        if prev is not None:
+            prev.close()
+
+
+class ColumnarChunkStore:
+    """
+    Read-only view over one generation of the columnar store.
+    Chunk i follows load_all_chunks() order; text/meta are only decoded when asked for.
+    """
+
+    def __init__(self, gen_dir: Path) -> None:
+        self._dir = Path(gen_dir)
+        header = json.loads((self._dir / "header.json").read_text(encoding="utf-8"))
+        if int(header.get("version") or 0) != _STORE_VERSION:
+            raise ValueError(f"unsupported columnar store version: {header.get('version')}")
+        self._n = int(header.get("n") or 0)
+        self._source_paths = [str(x) for x in (header.get("source_paths") or [])]
+        self._doc_ids: list[str] = []
+        self._docs: dict[str, tuple[str, int, int, int]] = {}
+        for doc_id, sha1, num, first, count in header.get("docs") or []:
+            self._doc_ids.append(str(doc_id))
+            self._docs[str(doc_id)] = (str(sha1), int(num), int(first), int(count))
+        self._cols = {fname: self._map_column(fname, dtype) for fname, dtype in _COLUMNS.items()}
+        self._text = self._map_blob("text.bin")
+        self._heading = self._map_blob("heading.bin")
+
+    def _map_column(self, fname: str, dtype: str) -> np.ndarray:
+        p = self._dir / fname
+        if p.stat().st_size == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(str(p), dtype=dtype, mode="r")
+
+    def _map_blob(self, fname: str) -> mmap.mmap | bytes:
+        with (self._dir / fname).open("rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b""
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self) -> None:
+        for blob in (self._text, self._heading):
+            if isinstance(blob, mmap.mmap):
+                try:
+                    blob.close()
+                except BufferError:
+                    pass
+        self._cols = {}
+
+    def __len__(self) -> int:
+        return self._n
+
+    @property
+    def doc_ids(self) -> list[str]:
+        return list(self._doc_ids)
+
+    def doc_record(self, doc_id: str) -> tuple[str, int] | None:
+        d = self._docs.get(doc_id)
+        return (d[0], d[1]) if d else None
+
+    def doc_records(self) -> dict[str, tuple[str, int]]:
+        return {doc_id: (d[0], d[1]) for doc_id, d in self._docs.items()}
+
+    def doc_range(self, doc_id: str) -> range | None:
+        d = self._docs.get(doc_id)
+        return range(d[2], d[2] + d[3]) if d else None
+
+    def text(self, i: int) -> str:
+        off = self._cols["text_off.u64"]
+        return self._text[int(off[i]) : int(off[i + 1])].decode("utf-8", errors="replace")
+
+    def iter_texts(self) -> Iterator[str]:
+        for i in range(self._n):
+            yield self.text(i)
+
+    def chunk_id(self, i: int) -> str:
+        return f"{self._doc_ids[int(self._cols['doc_idx.u32'][i])]}:{int(self._cols['pos.u32'][i])}"
+
+    def meta(self, i: int) -> dict:
+        cols = self._cols
+        meta: dict = {}
+        si = int(cols["source_idx.i32"][i])
+        if si >= 0:
+            meta["source_path"] = self._source_paths[si]
+        off = cols["heading_off.u64"]
+        meta["heading_path"] = self._heading[int(off[i]) : int(off[i + 1])].decode("utf-8", errors="replace")
+        for key, fname in (("char_len", "char_len.i32"), ("page_start", "page_start.i32"), ("page_end", "page_end.i32")):
+            v = int(cols[fname][i])
+            if v >= 0:
+                meta[key] = v
+        return meta
+
+    def chunk(self, i: int) -> dict:
+        """Same dict shape as one JSONL line."""
+        return {"text": self.text(i), "meta": self.meta(i), "id": self.chunk_id(i)}
+
+
+def open_columnar_store(db_dir: Path, *, require_fresh: bool = True) -> ColumnarChunkStore | None:
+    """Open the current generation; None when missing, unreadable or (by default) stale vs docs.json."""
+    db_dir = Path(db_dir)
+    gen = _current_generation(db_dir)
+    if gen is None:
+        return None
+    try:
+        store = ColumnarChunkStore(gen)
+    except (OSError, ValueError):
+        return None
+    if require_fresh and store.doc_records() != current_doc_records(db_dir):
+        store.close()
+        return None
+    return store
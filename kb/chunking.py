@@ -12,10 +12,16 @@ class Block:
     page: int | None = None
 
 
-def _parse_blocks(md: str) -> list[Block]:
+def _parse_blocks(
+    md: str,
+    *,
+    heading_stack: list[tuple[int, str]] | None = None,
+    page: int | None = None,
+) -> list[Block]:
+    # heading_stack/page: parser state at the start of `md` when it is one section of a larger file.
     blocks: list[Block] = []
-    heading_stack: list[tuple[int, str]] = []
-    cur_page: int | None = None
+    heading_stack = list(heading_stack or [])
+    cur_page: int | None = page
 
     # Page marker inserted by our converter:
     # <!-- kb_page: 12 -->
@@ -163,8 +169,11 @@ def chunk_markdown(
     source_path: str,
     chunk_size: int = 1400,
     overlap: int = 200,
+    *,
+    heading_stack: list[tuple[int, str]] | None = None,
+    page: int | None = None,
 ) -> list[dict]:
-    blocks = _parse_blocks(md)
+    blocks = _parse_blocks(md, heading_stack=heading_stack, page=page)
     return _merge_blocks_into_chunks(
         blocks=blocks,
         source_path=source_path,
@@ -0,0 +1,42 @@
+"""
+The DB dir the current task works on, for helpers deep in the retrieval path (disk cache,
+doc index) that are not handed a db_dir.
+- context-local (contextvars): set around one generation task or bench run, so Streamlit
+  sessions using different DB dirs never read or write each other's files
+- worker pools do not inherit it: submit with submit_in_scope(), or carry current_db_dir()
+  along with the work item and re-enter it with use_db_dir()
+"""
+
+from __future__ import annotations
+
+import contextvars
+from concurrent.futures import Executor, Future
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Iterator
+
+_DB_DIR: contextvars.ContextVar[Path | None] = contextvars.ContextVar("kb_db_dir", default=None)
+
+
+@contextmanager
+def use_db_dir(db_dir: Path | None) -> Iterator[None]:
+    token = _DB_DIR.set(Path(db_dir) if db_dir else None)
+    try:
+        yield
+    finally:
+        _DB_DIR.reset(token)
+
+
+def current_db_dir() -> Path | None:
+    return _DB_DIR.get()
+
+
+def submit_in_scope(pool: Executor, fn: Callable, /, *args, **kwargs) -> Future:
+    """pool.submit() that runs fn under the caller's DB dir."""
+    db_dir = current_db_dir()
+
+    def run():
+        with use_db_dir(db_dir):
+            return fn(*args, **kwargs)
+
+    return pool.submit(run)
@@ -0,0 +1,225 @@
+"""
+Disk-backed layer for the slow-to-recompute runtime cache buckets (LLM translations,
+reranks, refs packs, deep-read snippets), so they survive restarts and are shared
+between processes using the same DB dir.
+
+- one SQLite file: <db>/runtime_cache.sqlite3
+- per-bucket TTL, item cap and byte cap; LRU eviction by last access time
+- values are JSON; dicts with int keys (refs_pack) round-trip
+"""
+
+from __future__ import annotations
+
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable
+
+from .db_scope import current_db_dir
+
+
+# bucket -> (ttl seconds, max items, max bytes)
+BUCKET_POLICIES: dict[str, tuple[float, int, int]] = {
+    "trans": (30 * 86400.0, 5000, 8 * 1024 * 1024),
+    "rerank": (14 * 86400.0, 20000, 32 * 1024 * 1024),
+    "refs_pack": (7 * 86400.0, 5000, 64 * 1024 * 1024),
+    "deep_read": (7 * 86400.0, 3000, 64 * 1024 * 1024),
+}
+
+# Access times are only rewritten when older than this, so hot reads do not turn into writes.
+_TOUCH_GRANULARITY_S = 60.0
+# Caps are enforced every N writes per bucket (and on open).
+_ENFORCE_EVERY = 32
+
+_REGISTRY_LOCK = threading.Lock()
+_REGISTRY: dict[str, "DiskCache"] = {}
+# db_dir as given -> cache, so per-lookup selection skips path resolution.
+_BY_DIR: dict[str, "DiskCache"] = {}
+
+
+def disk_cache_path(db_dir: Path) -> Path:
+    return Path(db_dir) / "runtime_cache.sqlite3"
+
+
+def _encode(val) -> str | None:
+    try:
+        if isinstance(val, dict) and val and all(isinstance(k, int) for k in val):
+            return json.dumps({"int_keys": True, "v": {str(k): v for k, v in val.items()}}, ensure_ascii=False)
+        return json.dumps({"v": val}, ensure_ascii=False)
+    except (TypeError, ValueError):
+        return None
+
+
+def _decode(text: str):
+    obj = json.loads(text)
+    v = obj.get("v")
+    if obj.get("int_keys") and isinstance(v, dict):
+        return {int(k): x for k, x in v.items()}
+    return v
+
+
+class DiskCache:
+    def __init__(self, path: Path) -> None:
+        self._path = Path(path)
+        self._path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._writes: dict[str, int] = {}
+        self._conn = sqlite3.connect(str(self._path), timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL;")
+        self._conn.execute("PRAGMA synchronous=NORMAL;")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS entries (
+              bucket TEXT NOT NULL,
+              key TEXT NOT NULL,
+              value TEXT NOT NULL,
+              size INTEGER NOT NULL,
+              created_at REAL NOT NULL,
+              accessed_at REAL NOT NULL,
+              PRIMARY KEY (bucket, key)
+            ) WITHOUT ROWID
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_entries_lru ON entries(bucket, accessed_at)")
+        for bucket in BUCKET_POLICIES:
+            self._enforce(bucket)
+
+    @property
+    def path(self) -> Path:
+        return self._path
+
+    def get(self, bucket: str, key: str):
+        policy = BUCKET_POLICIES.get(bucket)
+        if policy is None:
+            return None
+        now = time.time()
+        try:
+            with self._lock:
+                row = self._conn.execute(
+                    "SELECT value, created_at, accessed_at FROM entries WHERE bucket = ? AND key = ?",
+                    (bucket, str(key)),
+                ).fetchone()
+                if row is None:
+                    return None
+                if now - float(row[1]) > policy[0]:
+                    self._conn.execute("DELETE FROM entries WHERE bucket = ? AND key = ?", (bucket, str(key)))
+                    return None
+                if now - float(row[2]) > _TOUCH_GRANULARITY_S:
+                    self._conn.execute("UPDATE entries SET accessed_at = ? WHERE bucket = ? AND key = ?", (now, bucket, str(key)))
+            return _decode(row[0])
+        except (sqlite3.Error, ValueError):
+            return None
+
+    def set(self, bucket: str, key: str, val) -> None:
+        if bucket not in BUCKET_POLICIES:
+            return
+        text = _encode(val)
+        if text is None:
+            return
+        now = time.time()
+        try:
+            with self._lock:
+                self._conn.execute(
+                    """
+                    INSERT INTO entries (bucket, key, value, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(bucket, key) DO UPDATE SET
+                      value = excluded.value, size = excluded.size, created_at = excluded.created_at, accessed_at = excluded.accessed_at
+                    """,
+                    (bucket, str(key), text, len(text.encode("utf-8")), now, now),
+                )
+                n = self._writes.get(bucket, 0) + 1
+                self._writes[bucket] = n
+                if n % _ENFORCE_EVERY == 0:
+                    self._enforce(bucket)
+        except sqlite3.Error:
+            pass
+
+    def _enforce(self, bucket: str) -> None:
+        """Drop expired rows, then least recently used ones until under the item and byte caps."""
+        ttl, max_items, max_bytes = BUCKET_POLICIES[bucket]
+        conn = self._conn
+        conn.execute("DELETE FROM entries WHERE bucket = ? AND created_at < ?", (bucket, time.time() - ttl))
+        n, total = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries WHERE bucket = ?", (bucket,)).fetchone()
+        n, total = int(n), int(total)
+        if n <= max_items and total <= max_bytes:
+            return
+        drop: list[str] = []
+        for key, size in conn.execute("SELECT key, size FROM entries WHERE bucket = ? ORDER BY accessed_at ASC", (bucket,)):
+            if n <= max_items and total <= max_bytes:
+                break
+            drop.append(str(key))
+            n -= 1
+            total -= int(size)
+        conn.executemany("DELETE FROM entries WHERE bucket = ? AND key = ?", ((bucket, k) for k in drop))
+
+    def clear(self, bucket: str | None = None) -> None:
+        with self._lock:
+            if bucket is None:
+                self._conn.execute("DELETE FROM entries")
+            else:
+                self._conn.execute("DELETE FROM entries WHERE bucket = ?", (bucket,))
+
+    def stats(self) -> dict[str, dict]:
+        with self._lock:
+            rows = self._conn.execute("SELECT bucket, COUNT(*), COALESCE(SUM(size), 0) FROM entries GROUP BY bucket").fetchall()
+        return {str(b): {"items": int(n), "bytes": int(sz)} for b, n, sz in rows}
+
+
+def open_disk_cache(db_dir: Path) -> DiskCache | None:
+    """One DiskCache per file per process; None if it cannot be opened."""
+    dc = _BY_DIR.get(str(db_dir))
+    if dc is not None:
+        return dc
+    p = disk_cache_path(db_dir)
+    try:
+        key = str(p.expanduser().resolve())
+    except Exception:
+        key = str(p)
+    with _REGISTRY_LOCK:
+        dc = _REGISTRY.get(key)
+        if dc is None:
+            try:
+                dc = DiskCache(p)
+            except (sqlite3.Error, OSError):
+                return None
+            _REGISTRY[key] = dc
+        _BY_DIR[str(db_dir)] = dc
+        return dc
+
+
+def active_disk_cache() -> DiskCache | None:
+    """Disk cache of the current task's DB dir (kb.db_scope); None outside a task."""
+    db_dir = current_db_dir()
+    return open_disk_cache(db_dir) if db_dir is not None else None
+
+
+def layered_cache(
+    mem_get: Callable[[str, str], Any],
+    mem_set: Callable[..., None],
+) -> tuple[Callable[[str, str], Any], Callable[..., None]]:
+    """
+    Wrap in-memory get/set so BUCKET_POLICIES buckets also read through / write through
+    the disk cache of the current task's DB dir. Same signatures, so it plugs into configure_cache() as is.
+    """
+
+    def get(bucket: str, key: str):
+        val = mem_get(bucket, key)
+        if val is not None:
+            return val
+        dc = active_disk_cache()
+        if dc is None or bucket not in BUCKET_POLICIES:
+            return None
+        val = dc.get(bucket, key)
+        if val is not None:
+            mem_set(bucket, key, val)
+        return val
+
+    def set(bucket: str, key: str, val, **kw) -> None:
+        mem_set(bucket, key, val, **kw)
+        dc = active_disk_cache()
+        if dc is not None and bucket in BUCKET_POLICIES:
+            dc.set(bucket, key, val)
+
+    return get, set
@@ -0,0 +1,359 @@
+"""
+Per-document structure precomputed by ingest.py, so the refs builder does not re-parse
+markdown files per question.
+- one SQLite file: <db>/doc_index.sqlite3
+- docs: doc_id -> integer doc_key (used by the other tables), source path, mtime and size
+  of the file that was indexed
+- headings: one row per heading line (level, title, normalized title, bad-heading flag, page),
+  taken from the same chunking._parse_blocks pass that ingest chunks the file with
+- subchunks / subchunk_terms: the deep-read layer, 900-char / no-overlap chunks of those blocks
+  with their term counts, so deep-read is an indexed lookup per doc; the sub-chunk text is a
+  third copy of the corpus (after the JSONL chunks and the columnar store), so it is stored
+  zlib-compressed and only the returned rows are decompressed
+Rows are ignored once the file's mtime/size differ (not re-ingested yet).
+"""
+
+from __future__ import annotations
+
+import sqlite3
+import threading
+import zlib
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable
+
+from .chunking import Block, _merge_blocks_into_chunks
+from .retrieval_heuristics import _is_probably_bad_heading, _normalize_heading
+from .db_scope import current_db_dir
+from .store import compute_doc_id
+from .tokenize import tokenize
+
+_INDEX_VERSION = 4
+
+# Deep-read layer: same parameters and minimum length as the on-demand scan in retrieval_engine.
+DEEP_CHUNK_SIZE = 900
+DEEP_MIN_CHARS = 80
+# Docs per write transaction of DocIndexWriter: other writers wait at most one batch.
+_WRITE_BATCH_DOCS = 64
+# SQLite host-parameter budget per IN (...) query.
+_MAX_PARAMS = 500
+
+_REGISTRY_LOCK = threading.Lock()
+_REGISTRY: dict[str, "DocIndex"] = {}
+# db_dir as given -> index, so per-lookup selection skips path resolution.
+_BY_DIR: dict[str, "DocIndex"] = {}
+
+
+@dataclass(frozen=True)
+class DocHeading:
+    level: int
+    title: str
+    norm_title: str
+    bad: bool
+    page: int | None
+
+
+def doc_index_path(db_dir: Path) -> Path:
+    return Path(db_dir) / "doc_index.sqlite3"
+
+
+def doc_headings(blocks: list[Block]) -> list[DocHeading]:
+    """Heading lines of a file, from its chunking._parse_blocks() blocks."""
+    out: list[DocHeading] = []
+    for b in blocks:
+        if b.kind != "heading":
+            continue
+        level = len(b.text) - len(b.text.lstrip("#"))
+        title = b.text[level:].strip()
+        norm = _normalize_heading(title)
+        out.append(DocHeading(level=level, title=title, norm_title=norm, bad=(not norm) or _is_probably_bad_heading(norm), page=b.page))
+    return out
+
+
+def build_deep_chunks(blocks: list[Block], source_path: str) -> list[tuple[dict, dict[str, int]]]:
+    """Deep-read sub-chunks worth scoring (from the file's _parse_blocks() blocks), with their term counts."""
+    out: list[tuple[dict, dict[str, int]]] = []
+    for c in _merge_blocks_into_chunks(blocks, source_path=source_path, chunk_size=DEEP_CHUNK_SIZE, overlap=0):
+        body = (c.get("text") or "").strip()
+        if len(body) < DEEP_MIN_CHARS:
+            continue
+        counts: dict[str, int] = {}
+        for t in tokenize(body):
+            counts[t] = counts.get(t, 0) + 1
+        out.append((c, counts))
+    return out
+
+
+class DocIndexWriter:
+    """
+    Ingest side. Rows are committed every _WRITE_BATCH_DOCS docs and by close(),
+    each batch in its own BEGIN IMMEDIATE transaction, so overlapping ingests interleave
+    instead of one holding the write lock for its whole run.
+    """
+
+    def __init__(self, db_dir: Path) -> None:
+        conn = sqlite3.connect(str(doc_index_path(db_dir)), timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL;")
+        # Schema check and (re)creation as one transaction, so two ingests never both rebuild it.
+        conn.execute("BEGIN IMMEDIATE")
+        if int(conn.execute("PRAGMA user_version").fetchone()[0]) != _INDEX_VERSION:
+            # Derived data only: an older layout is dropped and refilled by later ingests.
+            for table in ("subchunk_terms", "subchunks", "headings", "docs"):
+                conn.execute(f"DROP TABLE IF EXISTS {table}")
+            conn.execute(
+                """
+                CREATE TABLE docs (
+                  doc_key INTEGER PRIMARY KEY,
+                  doc_id TEXT NOT NULL UNIQUE,
+                  source_path TEXT NOT NULL,
+                  mtime REAL NOT NULL,
+                  size INTEGER NOT NULL
+                )
+                """
+            )
+            conn.execute(
+                """
+                CREATE TABLE headings (
+                  doc_key INTEGER NOT NULL,
+                  ord INTEGER NOT NULL,
+                  level INTEGER NOT NULL,
+                  title TEXT NOT NULL,
+                  norm_title TEXT NOT NULL,
+                  bad INTEGER NOT NULL,
+                  page INTEGER,
+                  PRIMARY KEY (doc_key, ord)
+                ) WITHOUT ROWID
+                """
+            )
+            conn.execute(
+                """
+                CREATE TABLE subchunks (
+                  doc_key INTEGER NOT NULL,
+                  ord INTEGER NOT NULL,
+                  text_z BLOB NOT NULL,
+                  heading_path TEXT NOT NULL,
+                  page_start INTEGER,
+                  page_end INTEGER,
+                  char_len INTEGER NOT NULL,
+                  PRIMARY KEY (doc_key, ord)
+                ) WITHOUT ROWID
+                """
+            )
+            conn.execute(
+                """
+                CREATE TABLE subchunk_terms (
+                  doc_key INTEGER NOT NULL,
+                  term TEXT NOT NULL,
+                  ord INTEGER NOT NULL,
+                  tf INTEGER NOT NULL,
+                  PRIMARY KEY (doc_key, term, ord)
+                ) WITHOUT ROWID
+                """
+            )
+            conn.execute(f"PRAGMA user_version = {_INDEX_VERSION}")
+        self._stamps: dict[str, tuple[float, int]] = {
+            str(d): (float(m), int(sz)) for d, m, sz in conn.execute("SELECT doc_id, mtime, size FROM docs")
+        }
+        conn.commit()
+        self._conn = conn
+        self._in_batch = False
+        self._batch_docs = 0
+
+    def _begin(self) -> None:
+        if not self._in_batch:
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._in_batch = True
+
+    def _commit(self) -> None:
+        if self._in_batch:
+            self._conn.commit()
+            self._in_batch = False
+            self._batch_docs = 0
+
+    def is_fresh(self, doc_id: str, *, mtime: float, size: int) -> bool:
+        """True if the doc's rows were taken from a file with this mtime/size."""
+        return self._stamps.get(doc_id) == (float(mtime), int(size))
+
+    def save_doc(
+        self,
+        doc_id: str,
+        source_path: str,
+        *,
+        mtime: float,
+        size: int,
+        headings: list[DocHeading],
+        deep_chunks: list[tuple[dict, dict[str, int]]],
+    ) -> None:
+        self._begin()
+        conn = self._conn
+        row = conn.execute("SELECT doc_key FROM docs WHERE doc_id = ?", (doc_id,)).fetchone()
+        if row is None:
+            cur = conn.execute(
+                "INSERT INTO docs (doc_id, source_path, mtime, size) VALUES (?, ?, ?, ?)",
+                (doc_id, str(source_path), float(mtime), int(size)),
+            )
+            key = int(cur.lastrowid)
+        else:
+            key = int(row[0])
+            conn.execute(
+                "UPDATE docs SET source_path = ?, mtime = ?, size = ? WHERE doc_key = ?",
+                (str(source_path), float(mtime), int(size), key),
+            )
+            for table in ("subchunk_terms", "subchunks", "headings"):
+                conn.execute(f"DELETE FROM {table} WHERE doc_key = ?", (key,))
+        self._stamps[doc_id] = (float(mtime), int(size))
+        conn.executemany(
+            "INSERT INTO headings (doc_key, ord, level, title, norm_title, bad, page) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                (key, i, h.level, h.title, h.norm_title, int(h.bad), h.page)
+                for i, h in enumerate(headings)
+            ),
+        )
+        sub_rows = []
+        term_rows = []
+        for i, (c, counts) in enumerate(deep_chunks):
+            meta = c.get("meta", {}) or {}
+            text = str(c.get("text") or "")
+            sub_rows.append(
+                (key, i, zlib.compress(text.encode("utf-8"), 6), str(meta.get("heading_path") or ""), meta.get("page_start"), meta.get("page_end"), int(meta.get("char_len") or len(text)))
+            )
+            term_rows.extend((key, t, i, int(tf)) for t, tf in counts.items())
+        conn.executemany(
+            "INSERT INTO subchunks (doc_key, ord, text_z, heading_path, page_start, page_end, char_len) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            sub_rows,
+        )
+        conn.executemany("INSERT INTO subchunk_terms (doc_key, term, ord, tf) VALUES (?, ?, ?, ?)", term_rows)
+        self._batch_docs += 1
+        if self._batch_docs >= _WRITE_BATCH_DOCS:
+            self._commit()
+
+    def prune(self, keep_doc_ids: Iterable[str]) -> int:
+        self._begin()
+        keep = set(keep_doc_ids)
+        stale = [(int(k), str(d)) for k, d in self._conn.execute("SELECT doc_key, doc_id FROM docs") if str(d) not in keep]
+        for key, doc_id in stale:
+            for table in ("subchunk_terms", "subchunks", "headings", "docs"):
+                self._conn.execute(f"DELETE FROM {table} WHERE doc_key = ?", (key,))
+            self._stamps.pop(doc_id, None)
+        return len(stale)
+
+    def close(self) -> None:
+        try:
+            self._commit()
+        finally:
+            self._conn.close()
+
+
+class DocIndex:
+    """Read side; one shared read-only connection per file."""
+
+    def __init__(self, path: Path) -> None:
+        self._path = Path(path)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(f"{self._path.resolve().as_uri()}?mode=ro", uri=True, timeout=30, check_same_thread=False)
+        if int(self._conn.execute("PRAGMA user_version").fetchone()[0]) != _INDEX_VERSION:
+            self._conn.close()
+            raise ValueError(f"unsupported doc index version: {self._path}")
+
+    def _fresh_doc_key(self, source_path: Path) -> int | None:
+        """doc_key of `source_path` if it was indexed from the file as it is now."""
+        p = Path(source_path)
+        try:
+            st = p.stat()
+            doc_id = compute_doc_id(p)
+        except OSError:
+            return None
+        with self._lock:
+            row = self._conn.execute("SELECT doc_key, mtime, size FROM docs WHERE doc_id = ?", (doc_id,)).fetchone()
+        if row is None or float(row[1]) != float(st.st_mtime) or int(row[2]) != int(st.st_size):
+            return None
+        return int(row[0])
+
+    def headings(self, source_path: Path) -> list[DocHeading] | None:
+        """None when the file is not indexed or changed since."""
+        try:
+            key = self._fresh_doc_key(source_path)
+            if key is None:
+                return None
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT level, title, norm_title, bad, page FROM headings WHERE doc_key = ? ORDER BY ord",
+                    (key,),
+                ).fetchall()
+        except sqlite3.Error:
+            return None
+        return [
+            DocHeading(level=int(lv), title=str(t), norm_title=str(nt), bad=bool(bad), page=(int(pg) if pg is not None else None))
+            for lv, t, nt, bad, pg in rows
+        ]
+
+    def deep_read(self, source_path: Path, query_tokens: list[str], *, top_n: int) -> list[tuple[float, dict]] | None:
+        """
+        Top deep-read sub-chunks of one doc for query_tokens, as (score, chunk dict), best first.
+        Score and tie order match scoring every sub-chunk with _score_tokens and a stable sort.
+        None when the file is not indexed or changed since.
+        """
+        try:
+            key = self._fresh_doc_key(source_path)
+            if key is None:
+                return None
+            weights: dict[str, int] = {}
+            for t in query_tokens:
+                weights[t] = weights.get(t, 0) + 1
+            terms = list(weights)
+            scores: dict[int, int] = {}
+            with self._lock:
+                for i in range(0, len(terms), _MAX_PARAMS):
+                    part = terms[i : i + _MAX_PARAMS]
+                    q = f"SELECT term, ord, tf FROM subchunk_terms WHERE doc_key = ? AND term IN ({','.join('?' * len(part))})"
+                    for term, ord_, tf in self._conn.execute(q, (key, *part)):
+                        scores[int(ord_)] = scores.get(int(ord_), 0) + weights[str(term)] * int(tf)
+                top = sorted((o for o, sc in scores.items() if sc > 0), key=lambda o: (-scores[o], o))[: max(1, int(top_n))]
+                rows = {}
+                if top:
+                    q = f"SELECT ord, text_z, heading_path, page_start, page_end, char_len FROM subchunks WHERE doc_key = ? AND ord IN ({','.join('?' * len(top))})"
+                    rows = {int(r[0]): r for r in self._conn.execute(q, (key, *top))}
+        except sqlite3.Error:
+            return None
+        out: list[tuple[float, dict]] = []
+        for o in top:
+            r = rows.get(o)
+            if r is None:
+                continue
+            meta: dict = {"source_path": str(source_path), "heading_path": str(r[2]), "char_len": int(r[5])}
+            if r[3] is not None:
+                meta["page_start"] = int(r[3])
+            if r[4] is not None:
+                meta["page_end"] = int(r[4])
+            out.append((float(scores[o]), {"text": zlib.decompress(bytes(r[1])).decode("utf-8"), "meta": meta}))
+        return out
+
+
+def open_doc_index(db_dir: Path) -> DocIndex | None:
+    """One DocIndex per file per process; None if missing or unreadable."""
+    idx = _BY_DIR.get(str(db_dir))
+    if idx is not None:
+        return idx
+    p = doc_index_path(db_dir)
+    if not p.exists():
+        return None
+    try:
+        key = str(p.expanduser().resolve())
+    except Exception:
+        key = str(p)
+    with _REGISTRY_LOCK:
+        idx = _REGISTRY.get(key)
+        if idx is None:
+            try:
+                idx = DocIndex(p)
+            except (sqlite3.Error, OSError, ValueError):
+                return None
+            _REGISTRY[key] = idx
+        _BY_DIR[str(db_dir)] = idx
+        return idx
+
+
+def active_doc_index() -> DocIndex | None:
+    """Doc index of the current task's DB dir (kb.db_scope); None: callers parse files instead."""
+    db_dir = current_db_dir()
+    return open_doc_index(db_dir) if db_dir is not None else None
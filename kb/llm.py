@@ -1,12 +1,51 @@
 from __future__ import annotations
 
+import os
+import threading
 import time
 from typing import Iterator, Optional
 
-from openai import OpenAI
+import httpx
+from openai import DefaultHttpxClient, OpenAI
 
 from .config import Settings
 
+# Process-wide clients: one keep-alive connection pool per (api_key, base_url, timeout profile).
+_CLIENTS_LOCK = threading.Lock()
+_CLIENTS: dict[tuple[str, str, float], OpenAI] = {}
+
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return max(1, int(os.environ.get(name, str(default))))
+    except ValueError:
+        return default
+
+
+def shared_client(api_key: str, base_url: str, timeout_s: float) -> OpenAI:
+    """
+    OpenAI client shared by every DeepSeekChat with the same key, endpoint and timeout.
+    Pool size: KB_LLM_MAX_CONNECTIONS (default 16) / KB_LLM_MAX_KEEPALIVE (default: same).
+    """
+    key = (str(api_key), str(base_url or ""), float(timeout_s))
+    with _CLIENTS_LOCK:
+        client = _CLIENTS.get(key)
+        if client is None:
+            max_conn = _env_int("KB_LLM_MAX_CONNECTIONS", 16)
+            limits = httpx.Limits(
+                max_connections=max_conn,
+                max_keepalive_connections=_env_int("KB_LLM_MAX_KEEPALIVE", max_conn),
+                keepalive_expiry=30.0,
+            )
+            client = OpenAI(
+                api_key=api_key,
+                base_url=base_url,
+                timeout=float(timeout_s),
+                http_client=DefaultHttpxClient(limits=limits, timeout=float(timeout_s)),
+            )
+            _CLIENTS[key] = client
+        return client
+
 
 class DeepSeekChat:
     def __init__(self, settings: Settings) -> None:
@@ -15,7 +54,7 @@ class DeepSeekChat:
                 "缺少 DEEPSEEK_API_KEY（或 OPENAI_API_KEY）。请先在环境变量里设置，再启动 UI/脚本。"
             )
         self._settings = settings
-        self._client = OpenAI(api_key=settings.api_key, base_url=settings.base_url)
+        self._client = shared_client(settings.api_key, settings.base_url, settings.timeout_s)
 
     def chat(
         self,
@@ -0,0 +1,141 @@
+from __future__ import annotations
+
+import sys
+import threading
+from collections import OrderedDict
+from typing import Any, Callable
+
+
+class LRUCache:
+    """
+    Thread-safe LRU map with O(1) get/set/evict (OrderedDict).
+    - bounded by item count and/or total size (sizeof(value) bytes)
+    - hit/miss/eviction counters for diagnostics
+    """
+
+    def __init__(
+        self,
+        max_items: int | None = 600,
+        *,
+        max_bytes: int | None = None,
+        sizeof: Callable[[Any], int] | None = None,
+    ) -> None:
+        self._lock = threading.Lock()
+        self._data: OrderedDict[str, tuple[Any, int]] = OrderedDict()
+        self._max_items = max_items
+        self._max_bytes = max_bytes
+        self._sizeof = sizeof or sys.getsizeof
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    @property
+    def max_items(self) -> int | None:
+        return self._max_items
+
+    def get(self, key: str):
+        with self._lock:
+            ent = self._data.get(key)
+            if ent is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return ent[0]
+
+    def set(self, key: str, val) -> None:
+        try:
+            size = int(self._sizeof(val)) if self._max_bytes is not None else 0
+        except Exception:
+            size = 0
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            if self._max_bytes is not None and size > self._max_bytes:
+                # Would evict everything else and still not fit.
+                return
+            self._data[key] = (val, size)
+            self._bytes += size
+            self._evict_locked()
+
+    def resize(self, *, max_items: int | None = None, max_bytes: int | None = None) -> None:
+        with self._lock:
+            if max_items is not None:
+                self._max_items = int(max_items)
+            if max_bytes is not None:
+                self._max_bytes = int(max_bytes)
+            self._evict_locked()
+
+    def _evict_locked(self) -> None:
+        data = self._data
+        while data and (
+            (self._max_items is not None and len(data) > self._max_items)
+            or (self._max_bytes is not None and self._bytes > self._max_bytes)
+        ):
+            _k, (_v, size) = data.popitem(last=False)
+            self._bytes -= size
+            self.evictions += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "items": len(self._data),
+                "bytes": self._bytes if self._max_bytes is not None else None,
+                "max_items": self._max_items,
+                "max_bytes": self._max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+class CacheBuckets:
+    """
+    Named LRUCache buckets behind the (bucket, key) get/set interface used by configure_cache().
+    Buckets listed in byte_budgets are bounded by bytes and ignore the callers' max_items.
+    """
+
+    def __init__(self, byte_budgets: dict[str, int] | None = None) -> None:
+        self._lock = threading.Lock()
+        self._buckets: dict[str, LRUCache] = {}
+        self._byte_budgets = dict(byte_budgets or {})
+
+    def bucket(self, name: str, *, max_items: int = 600) -> LRUCache:
+        with self._lock:
+            b = self._buckets.get(name)
+            if b is None:
+                if name in self._byte_budgets:
+                    b = LRUCache(None, max_bytes=self._byte_budgets[name])
+                else:
+                    b = LRUCache(int(max_items))
+                self._buckets[name] = b
+            return b
+
+    def get(self, bucket: str, key: str):
+        return self.bucket(bucket).get(key)
+
+    def set(self, bucket: str, key: str, val, *, max_items: int = 600) -> None:
+        b = self.bucket(bucket, max_items=max_items)
+        if bucket not in self._byte_budgets and b.max_items != int(max_items):
+            b.resize(max_items=int(max_items))
+        b.set(key, val)
+
+    def stats(self) -> dict[str, dict]:
+        with self._lock:
+            items = list(self._buckets.items())
+        return {name: b.stats() for name, b in items}
+
+
+def new_runtime_cache() -> CacheBuckets:
+    """Buckets used by app.py / retrieval_engine, each bounded by the callers' max_items."""
+    return CacheBuckets()
@@ -0,0 +1,109 @@
+"""
+Structural index of a markdown file, built from a memory map of its bytes.
+- headings: level, title, byte offset of the heading line, page in effect there
+- page markers (<!-- kb_page: N -->): byte offset -> page
+Sections (text between two heading lines) are decoded one at a time on demand,
+so callers never hold a whole multi-megabyte document as one str.
+"""
+
+from __future__ import annotations
+
+import bisect
+import mmap
+import re
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterator
+
+# Same line shapes as chunking._parse_blocks (which matches on line.strip()).
+_RE_LINE = re.compile(
+    rb"^[ \t\f\v]*(?:(?P<hashes>#+)(?P<title>[^\n]*)|<!--\s*kb_page\s*:\s*(?P<page>\d+)\s*-->[ \t\f\v\r]*)$",
+    flags=re.M | re.I,
+)
+
+
+@dataclass(frozen=True)
+class MdHeading:
+    level: int
+    title: str
+    offset: int
+    page: int | None
+
+
+class MdIndex:
+    def __init__(self, path: Path, *, mtime: float, size: int, headings: list[MdHeading], pages: list[tuple[int, int]]) -> None:
+        self.path = Path(path)
+        self.mtime = float(mtime)
+        self.size = int(size)
+        self.headings = headings
+        self.pages = pages
+        self._page_offsets = [off for off, _ in pages]
+
+    def page_at(self, offset: int) -> int | None:
+        i = bisect.bisect_right(self._page_offsets, int(offset)) - 1
+        return self.pages[i][1] if i >= 0 else None
+
+    def iter_sections(self) -> Iterator[tuple[list[tuple[int, str]], int | None, str]]:
+        """
+        Yield (heading stack before the section, page at its start, section text) in file order.
+        Pass the first two to chunk_markdown(heading_stack=..., page=...) to get the same chunks
+        as chunking the whole file (chunks never cross heading lines).
+        """
+        if self.size <= 0:
+            return
+        try:
+            f = self.path.open("rb")
+        except OSError:
+            return
+        with f:
+            try:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                return
+            try:
+                end = min(self.size, len(mm))
+                bounds = [0] + [h.offset for h in self.headings if h.offset < end] + [end]
+                stack: list[tuple[int, str]] = []
+                for i in range(len(bounds) - 1):
+                    a, b = bounds[i], bounds[i + 1]
+                    if b > a:
+                        yield list(stack), self.page_at(a), mm[a:b].decode("utf-8", errors="replace")
+                    if i >= 1:
+                        # Section i starts at heading i-1; fold it in for the next section.
+                        h = self.headings[i - 1]
+                        while stack and stack[-1][0] >= h.level:
+                            stack.pop()
+                        stack.append((h.level, h.title))
+            finally:
+                mm.close()
+
+
+def build_md_index(path: Path) -> MdIndex | None:
+    """None if the file cannot be read."""
+    p = Path(path)
+    try:
+        st = p.stat()
+        f = p.open("rb")
+    except OSError:
+        return None
+    headings: list[MdHeading] = []
+    pages: list[tuple[int, int]] = []
+    with f:
+        if st.st_size > 0:
+            try:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                return None
+            try:
+                cur_page: int | None = None
+                for m in _RE_LINE.finditer(mm):
+                    if m.group("page") is not None:
+                        cur_page = int(m.group("page"))
+                        pages.append((m.start(), cur_page))
+                        continue
+                    hashes = m.group("hashes")
+                    title = m.group("title").decode("utf-8", errors="replace").strip()
+                    headings.append(MdHeading(level=len(hashes), title=title, offset=m.start(), page=cur_page))
+            finally:
+                mm.close()
+    return MdIndex(p, mtime=float(st.st_mtime), size=int(st.st_size), headings=headings, pages=pages)
@@ -0,0 +1,84 @@
+from __future__ import annotations
+
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Hashable
+
+
+class MicroBatcher:
+    """
+    Collects submit()ted payloads per batch key for up to window_s (or until max_batch are pending),
+    then runs run_batch(key, payloads) -> results (same order) on a small worker pool.
+    - a payload whose key has nothing pending or in flight is dispatched at once (no window wait)
+    - each submit() gets a Future with its own result (None if run_batch returned fewer)
+    - an exception in run_batch is set on every Future of that batch
+    """
+
+    def __init__(
+        self,
+        run_batch: Callable[[Hashable, list[Any]], list[Any]],
+        *,
+        window_s: float,
+        max_batch: int,
+        max_workers: int = 4,
+        name: str = "kb-batch",
+    ) -> None:
+        self._run_batch = run_batch
+        self._window_s = max(0.0, float(window_s))
+        self._max_batch = max(1, int(max_batch))
+        self._name = name
+        self._cond = threading.Condition()
+        self._pending: dict[Hashable, list[tuple[Any, Future]]] = {}
+        self._deadlines: dict[Hashable, float] = {}
+        self._inflight: dict[Hashable, int] = {}
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._thread: threading.Thread | None = None
+
+    def submit(self, key: Hashable, payload: Any) -> Future:
+        fut: Future = Future()
+        with self._cond:
+            batch = self._pending.setdefault(key, [])
+            if not batch:
+                self._deadlines[key] = time.monotonic() + self._window_s
+            batch.append((payload, fut))
+            if len(batch) >= self._max_batch or (len(batch) == 1 and not self._inflight.get(key)):
+                self._dispatch_locked(key)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name=f"{self._name}-collect", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+        return fut
+
+    def _dispatch_locked(self, key: Hashable) -> None:
+        batch = self._pending.pop(key, None) or []
+        self._deadlines.pop(key, None)
+        if batch:
+            self._inflight[key] = self._inflight.get(key, 0) + 1
+            self._pool.submit(self._run, key, batch)
+
+    def _loop(self) -> None:
+        while True:
+            with self._cond:
+                now = time.monotonic()
+                for key in [k for k, d in self._deadlines.items() if d <= now]:
+                    self._dispatch_locked(key)
+                timeout = (min(self._deadlines.values()) - now) if self._deadlines else None
+                self._cond.wait(timeout)
+
+    def _run(self, key: Hashable, batch: list[tuple[Any, Future]]) -> None:
+        try:
+            results = list(self._run_batch(key, [p for p, _f in batch]) or [])
+        except Exception as e:  # noqa: BLE001
+            for _p, f in batch:
+                f.set_exception(e)
+            return
+        finally:
+            with self._cond:
+                n = self._inflight.get(key, 0) - 1
+                if n > 0:
+                    self._inflight[key] = n
+                else:
+                    self._inflight.pop(key, None)
+        for n, (_p, f) in enumerate(batch):
+            f.set_result(results[n] if n < len(results) else None)
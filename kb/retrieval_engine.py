@@ -1,15 +1,23 @@
 ﻿from __future__ import annotations
 
 import hashlib
+import heapq
 import json
+import os
 import re
-from collections import Counter
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeout
 from dataclasses import replace
 from pathlib import Path
 from typing import Any, Callable
 
 from .chunking import chunk_markdown
+from .db_scope import current_db_dir, submit_in_scope, use_db_dir
+from .doc_index import DEEP_CHUNK_SIZE, DEEP_MIN_CHARS, active_doc_index
 from .llm import DeepSeekChat
+from .md_index import MdIndex, build_md_index
+from .micro_batch import MicroBatcher
 from .retrieval_heuristics import (
     _aspects_from_snippets,
     _clean_snippet_for_display,
@@ -26,6 +34,7 @@ from .retrieval_heuristics import (
     _score_tokens,
 )
 from .retriever import BM25Retriever
+from .token_cache import term_counts
 from .tokenize import tokenize
 
 # These callbacks are injected by app.py so this module can reuse the shared runtime cache.
@@ -33,6 +42,59 @@ _CACHE_GET: Callable[[str, str], Any] = lambda _bucket, _key: None
 _CACHE_SET: Callable[..., None] = lambda _bucket, _key, _val, **_kw: None
 
 
+# Query translations run here, alongside the original-language search.
+_TRANSLATE_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="kb-translate")
+# Extra wait for a translation once the original query already has a strong match (KB_TRANSLATE_DEADLINE_S).
+try:
+    _TRANSLATE_DEADLINE_S = max(0.0, float(os.environ.get("KB_TRANSLATE_DEADLINE_S", "2.5")))
+except ValueError:
+    _TRANSLATE_DEADLINE_S = 2.5
+# "Strong match": at least KB_TRANSLATE_STRONG_HITS hits with a positive score and a best BM25
+# score of at least KB_TRANSLATE_STRONG_SCORE. Weaker results wait for the translation in full.
+try:
+    _TRANSLATE_STRONG_HITS = max(1, int(os.environ.get("KB_TRANSLATE_STRONG_HITS", "3")))
+except ValueError:
+    _TRANSLATE_STRONG_HITS = 3
+try:
+    _TRANSLATE_STRONG_SCORE = max(0.0, float(os.environ.get("KB_TRANSLATE_STRONG_SCORE", "1.0")))
+except ValueError:
+    _TRANSLATE_STRONG_SCORE = 1.0
+
+
+# Per-doc refs building (_group_hits_by_doc_for_refs) fans out here, bounded by KB_REFS_BUDGET_S in total.
+_REFS_POOL = ThreadPoolExecutor(max_workers=6, thread_name_prefix="kb-refs")
+try:
+    _REFS_BUDGET_S = max(0.0, float(os.environ.get("KB_REFS_BUDGET_S", "3.0")))
+except ValueError:
+    _REFS_BUDGET_S = 3.0
+
+# Rerank / refs-pack completions wait up to KB_LLM_BATCH_WINDOW_MS for other questions and go out as one
+# request (0 disables batching).
+try:
+    _LLM_BATCH_WINDOW_S = max(0.0, float(os.environ.get("KB_LLM_BATCH_WINDOW_MS", "40"))) / 1000.0
+except ValueError:
+    _LLM_BATCH_WINDOW_S = 0.04
+# Batch result for a request the combined answer skipped: its caller retries it alone.
+_RETRY_ALONE = object()
+_RERANK_BATCHER = MicroBatcher(lambda k, reqs: _rerank_batch(k, reqs), window_s=_LLM_BATCH_WINDOW_S, max_batch=8, name="kb-rerank")
+_REFS_PACK_BATCHER = MicroBatcher(lambda k, reqs: _refs_pack_batch(k, reqs), window_s=_LLM_BATCH_WINDOW_S, max_batch=4, name="kb-refs-pack")
+
+
+def _llm_batch_key(settings, kind: str, en: bool) -> tuple:
+    # Only requests for the same provider/model and prompt language can share a completion.
+    return (kind, str(getattr(settings, "api_key", "") or ""), str(getattr(settings, "base_url", "") or ""), str(getattr(settings, "model", "") or ""), bool(en))
+
+
+def _llm_batch_wait_s(settings) -> float:
+    try:
+        timeout_s = float(getattr(settings, "timeout_s", 60.0) or 60.0)
+        retries = int(getattr(settings, "max_retries", 0) or 0)
+    except Exception:
+        timeout_s, retries = 60.0, 0
+    # One combined completion (with the client's own retries); skipped ids are retried by their callers.
+    return timeout_s * (retries + 1) + 5.0 + _LLM_BATCH_WINDOW_S
+
+
 def configure_cache(cache_get: Callable[[str, str], Any], cache_set: Callable[..., None]) -> None:
     global _CACHE_GET, _CACHE_SET
     _CACHE_GET = cache_get
@@ -194,8 +256,22 @@ def _llm_semantic_rerank_score(settings, *, question: str, doc_headings: list[st
         except Exception:
             return 0.0, ""
 
-    ds = DeepSeekChat(settings)
     en = _has_latin(q) and (not _has_cjk(q))
+    req = {"settings": settings, "q": q, "hs": hs, "sn": sn, "en": en, "cache_key": cache_key, "db_dir": current_db_dir()}
+    if _LLM_BATCH_WINDOW_S > 0:
+        # Joined with other pending rerank requests into one completion (see _rerank_batch).
+        try:
+            res = _RERANK_BATCHER.submit(_llm_batch_key(settings, "rerank", en), req).result(timeout=_llm_batch_wait_s(settings))
+        except Exception:
+            res = None
+        if res is _RETRY_ALONE:
+            res = _rerank_batch(None, [req])[0]
+    else:
+        res = _rerank_batch(None, [req])[0]
+    return res if res is not None else (0.0, "")
+
+
+def _rerank_system_prompt(en: bool) -> str:
     if en:
         sys = (
             "You are a strict academic retriever reranker.\n"
@@ -216,28 +292,21 @@ def _llm_semantic_rerank_score(settings, *, question: str, doc_headings: list[st
             "- 鍙兘鏍规嵁 snippets/headings 鍒ゆ柇锛屼笉鑳芥牴鎹枃浠跺悕鍒ゆ柇銆俓n"
             "- why锛?= 18 涓瓧锛屽啓娓呮涓轰粈涔堛€俓n"
         )
+    return sys
 
-    user = (
-        f"Question: {q}\n\n"
-        "Available headings:\n- " + "\n- ".join(hs) + "\n\n"
-        "Snippets:\n- " + "\n- ".join(sn) + "\n"
-    )
-    try:
-        out = (ds.chat(messages=[{"role": "system", "content": sys}, {"role": "user", "content": user}], temperature=0.0, max_tokens=160) or "").strip()
-    except Exception:
-        out = ""
-
+def _parse_llm_json(out: str):
+    out = (out or "").strip()
     if out.startswith("```"):
         out = out.strip().strip("`")
         out = out.replace("json", "", 1).strip()
-
     try:
-        data = json.loads(out)
+        return json.loads(out)
     except Exception:
-        data = None
-    if not isinstance(data, dict):
-        return 0.0, ""
+        return None
 
+def _rerank_result(data, cache_key: str) -> tuple[float, str] | None:
+    if not isinstance(data, dict):
+        return None
     try:
         score = float(data.get("score", 0.0) or 0.0)
     except Exception:
@@ -247,6 +316,59 @@ def _llm_semantic_rerank_score(settings, *, question: str, doc_headings: list[st
     _cache_set("rerank", cache_key, {"score": score, "why": why}, max_items=600)
     return score, why
 
+def _rerank_batch(_key, reqs: list[dict]) -> list:
+    """
+    Score rerank requests (same provider/language) with one completion; results land in the rerank cache.
+    A single request uses the original one-question prompt; ids missing from a combined answer get
+    _RETRY_ALONE, so each caller retries on its own thread instead of holding up the whole batch.
+    """
+    settings = reqs[0]["settings"]
+    ds = DeepSeekChat(settings)
+    sys = _rerank_system_prompt(bool(reqs[0]["en"]))
+    if len(reqs) == 1:
+        r = reqs[0]
+        user = (
+            f"Question: {r['q']}\n\n"
+            "Available headings:\n- " + "\n- ".join(r["hs"]) + "\n\n"
+            "Snippets:\n- " + "\n- ".join(r["sn"]) + "\n"
+        )
+        try:
+            out = (ds.chat(messages=[{"role": "system", "content": sys}, {"role": "user", "content": user}], temperature=0.0, max_tokens=160) or "").strip()
+        except Exception:
+            out = ""
+        with use_db_dir(r.get("db_dir")):
+            return [_rerank_result(_parse_llm_json(out), r["cache_key"])]
+
+    sys = sys + (
+        "\nBatch mode: the user message is JSON {\"requests\":[{\"id\",\"question\",\"headings\",\"snippets\"}]}; "
+        "judge each request independently with the rules above.\n"
+        "Output JSON ONLY: {\"results\":[{\"id\":string,\"score\":number,\"why\":string}]}, one per request id.\n"
+    )
+    payload = {"requests": [{"id": f"r{n}", "question": r["q"], "headings": r["hs"], "snippets": r["sn"]} for n, r in enumerate(reqs, start=1)]}
+    try:
+        out = (
+            ds.chat(
+                messages=[{"role": "system", "content": sys}, {"role": "user", "content": json.dumps(payload, ensure_ascii=False)}],
+                temperature=0.0,
+                max_tokens=160 * len(reqs),
+            )
+            or ""
+        ).strip()
+    except Exception:
+        out = ""
+    data = _parse_llm_json(out)
+    by_id: dict[str, dict] = {}
+    if isinstance(data, dict) and isinstance(data.get("results"), list):
+        for it in data["results"]:
+            if isinstance(it, dict) and it.get("id") is not None:
+                by_id[str(it.get("id"))] = it
+    res: list[tuple[float, str] | None] = []
+    for n, r in enumerate(reqs, start=1):
+        it = by_id.get(f"r{n}")
+        with use_db_dir(r.get("db_dir")):
+            res.append(_rerank_result(it, r["cache_key"]) if it is not None else _RETRY_ALONE)
+    return res
+
 def _search_hits_with_fallback(
     prompt_text: str,
     retriever: BM25Retriever,
@@ -254,11 +376,24 @@ def _search_hits_with_fallback(
     settings,
     *,
     allow_translate: bool = True,
+    translate_deadline_s: float | None = None,
 ) -> tuple[list[dict], list[float], str, bool]:
     """
     Returns: (hits_raw, scores, used_query, used_translation)
+
+    The translation (LLM, up to ~8s) starts on a worker thread while the original query is searched.
+    If the original query already matched strongly (_TRANSLATE_STRONG_HITS / _TRANSLATE_STRONG_SCORE),
+    the translation only gets `translate_deadline_s` (default _TRANSLATE_DEADLINE_S) more; a late
+    result still lands in the cache.
     """
     q1 = (prompt_text or "").strip()
+    fut: Future | None = None
+    if bool(allow_translate) and _has_cjk(q1) and not _has_latin(q1):
+        try:
+            fut = submit_in_scope(_TRANSLATE_POOL, _translate_query_for_search, settings, q1)
+        except RuntimeError:
+            fut = None
+
     hits1 = retriever.search(q1, top_k=max(10, top_k * 6)) if q1 else []
     hits1 = [h for h in (hits1 or []) if not _is_temp_source_path(str((h.get("meta") or {}).get("source_path") or ""))]
     scores1 = [float(h.get("score", 0.0) or 0.0) for h in hits1]
@@ -267,7 +402,17 @@ def _search_hits_with_fallback(
     # If the query is CJK-only, BM25 over English corpora can return all-zeros (but still returns arbitrary docs).
     # Try translating to English to get meaningful retrieval.
     used_trans = False
-    q2 = _translate_query_for_search(settings, q1) if bool(allow_translate) else None
+    q2 = None
+    if fut is not None:
+        deadline = _TRANSLATE_DEADLINE_S if translate_deadline_s is None else max(0.0, float(translate_deadline_s))
+        strong = (sum(1 for s in scores1 if s > 0.0) >= _TRANSLATE_STRONG_HITS) and (best1 >= _TRANSLATE_STRONG_SCORE)
+        try:
+            # Nothing good to fall back on: wait for the translation's own timeout.
+            q2 = fut.result(timeout=deadline if strong else None)
+        except FutureTimeout:
+            q2 = None
+        except Exception:
+            q2 = None
     if q2:
         hits2 = retriever.search(q2, top_k=max(10, top_k * 6))
         hits2 = [h for h in (hits2 or []) if not _is_temp_source_path(str((h.get("meta") or {}).get("source_path") or ""))]
@@ -279,6 +424,202 @@ def _search_hits_with_fallback(
 
     return hits1, scores1, q1, used_trans
 
+def _past(deadline: float | None) -> bool:
+    return (deadline is not None) and (time.monotonic() >= deadline)
+
+
+def _build_doc_ref(
+    src: str,
+    hs: list[dict],
+    prompt_text: str,
+    *,
+    deep_query: str,
+    do_deep: bool,
+    profile: dict,
+    deadline: float | None = None,
+) -> dict | None:
+    """
+    One ref entry for one doc: headings, display snippets, locations and heuristic score.
+    Independent per doc, so _group_hits_by_doc_for_refs runs these in parallel.
+    Returns None once `deadline` (time.monotonic()) has passed, checked between stages, so an
+    abandoned build frees its _REFS_POOL worker instead of finishing for nobody.
+    """
+    hs2 = sorted(hs, key=lambda x: float(x.get("score", 0.0) or 0.0), reverse=True)
+    best_score = float(hs2[0].get("score", 0.0) or 0.0) if hs2 else 0.0
+    # Candidate headings: (score, top_heading)
+    cand: list[tuple[float, str]] = []
+    snippets: list[str] = []
+    locs: list[tuple[float, str]] = []
+    for h in hs2[:6]:
+        meta = h.get("meta", {}) or {}
+        top = (meta.get("top_heading") or _top_heading(meta.get("heading_path", "")) or "").strip()
+        if top:
+            cand.append((float(h.get("score", 0.0) or 0.0), top))
+            if not _is_probably_bad_heading(top):
+                locs.append((float(h.get("score", 0.0) or 0.0), top))
+        t = (h.get("text") or "").strip()
+        if t:
+            snippets.append(t)
+
+    # Optional deep-read for better section targeting + aspects + ranking.
+    deep_best = 0.0
+    if _past(deadline):
+        return None
+    if do_deep and deep_query:
+        try:
+            extra = _deep_read_md_for_context(Path(src), deep_query, max_snippets=2, snippet_chars=1400)
+        except Exception:
+            extra = []
+        for ex in extra or []:
+            meta_ex = ex.get("meta", {}) or {}
+            top2 = _top_heading(meta_ex.get("heading_path", "") or "")
+            if top2:
+                cand.append((float(ex.get("score", 0.0) or 0.0) + 0.2, top2))
+            tx = (ex.get("text") or "").strip()
+            if tx:
+                snippets.append(tx)
+            try:
+                deep_best = max(deep_best, float(ex.get("score", 0.0) or 0.0))
+            except Exception:
+                pass
+
+    # Final heading MUST be a real heading from this doc.
+    # Prefer headings already attached to hits (grounded), but also read real md headings for navigation.
+    best_heading = _pick_best_heading_for_doc(cand, prompt_text)
+    headings_for_pack: list[str] = []
+    if _past(deadline):
+        return None
+    try:
+        prefer = _preferred_section_keys(prompt_text)
+        picked = _pick_heading_from_md(Path(src), deep_query or prompt_text, prefer=prefer)
+        if picked:
+            best_heading = picked
+    except Exception:
+        pass
+    if _past(deadline):
+        return None
+    try:
+        headings_for_pack = _extract_md_headings(Path(src), max_n=40)
+    except Exception:
+        headings_for_pack = []
+    if not headings_for_pack:
+        # Minimal heading set: only what we have seen from hits/deep-read.
+        seen_h2: list[str] = []
+        for _sc2, hh in sorted(cand, key=lambda x: x[0], reverse=True):
+            hh2 = _normalize_heading(hh)
+            if not hh2 or _is_probably_bad_heading(hh2) or hh2 in seen_h2:
+                continue
+            seen_h2.append(hh2)
+            if len(seen_h2) >= 22:
+                break
+        headings_for_pack = seen_h2
+    if _past(deadline):
+        return None
+    aspects = _aspects_from_snippets(snippets[:3], prompt_text)
+
+    # Build display snippets: pick the most relevant, non-noise snippets.
+    q_for_pick = (deep_query or prompt_text or "").strip()
+    q_tokens = [t for t in tokenize(q_for_pick) if len(t) >= 3]
+    scored_snips: list[tuple[float, str]] = []
+    for s in snippets:
+        s2 = (s or "").strip()
+        if not s2:
+            continue
+        if _is_noise_snippet_text(s2):
+            continue
+        try:
+            sc = _score_tokens(s2, q_tokens) if q_tokens else 0.0
+        except Exception:
+            sc = 0.0
+        # Prefer snippets that literally contain key phrases for single-shot/single-pixel disambiguation.
+        low = _norm_text_for_match(s2)
+        if profile.get("wants_single_shot") and any(k in low for k in ["single-shot", "single shot", "single exposure", "snapshot"]):
+            sc += 3.0
+        if profile.get("wants_single_shot") and any(k in low for k in ["single-pixel", "single pixel"]):
+            sc -= 3.0
+        scored_snips.append((float(sc), s2))
+    scored_snips.sort(key=lambda x: x[0], reverse=True)
+    show_snips = [_clean_snippet_for_display(s, max_chars=900) for _, s in scored_snips[:2]]
+
+    # Best location candidates (real headings)
+    locs.sort(key=lambda x: x[0], reverse=True)
+    locs2 = []
+    seen_h = set()
+    for sc, hh in locs:
+        hh2 = _normalize_heading(hh)
+        if not hh2 or _is_probably_bad_heading(hh2) or hh2 in seen_h:
+            continue
+        seen_h.add(hh2)
+        locs2.append({"heading": hh2, "score": float(sc)})
+        if len(locs2) >= 3:
+            break
+
+    # Heuristic base score: BM25 + small deep-read signal + term mismatch penalties.
+    doc_name = Path(src).name
+    term_bonus = _doc_term_bonus(profile, doc_name, snippets[:3])
+    deep_scaled = 1.6 * (deep_best ** 0.6) if deep_best > 0 else 0.0
+    combined = (0.75 * best_score) + (0.25 * deep_scaled) + term_bonus
+
+    meta_out = {"source_path": src}
+    if best_heading:
+        meta_out["top_heading"] = best_heading
+    meta_out["ref_aspects"] = aspects
+    meta_out["ref_snippets"] = snippets[:2]
+    meta_out["ref_show_snippets"] = show_snips
+    meta_out["ref_locs"] = locs2
+    meta_out["ref_headings"] = headings_for_pack
+    meta_out["ref_rank"] = {"bm25": best_score, "deep": deep_best, "term_bonus": term_bonus, "llm": 0.0, "why": "", "score": combined}
+
+    return {
+        "score": float(combined),
+        "id": f"doc:{hashlib.sha1(src.encode('utf-8','ignore')).hexdigest()[:12]}",
+        "text": snippets[0] if snippets else "",
+        "meta": meta_out,
+    }
+
+def _apply_refs_pack_entry(d: dict, pr: dict) -> None:
+    """Fold one _llm_refs_pack entry into a ref entry: ref_pack, top_heading and the semantic score."""
+    meta = d.get("meta", {}) or {}
+    try:
+        llm_score = float(pr.get("score", 0.0) or 0.0)
+    except Exception:
+        llm_score = 0.0
+    llm_score = max(0.0, min(100.0, llm_score))
+    llm_why = str(pr.get("why") or "").strip()
+
+    meta["ref_pack"] = {
+        "score": llm_score,
+        "why": llm_why,
+        "what": str(pr.get("what") or "").strip(),
+        "find": [str(x).strip() for x in (pr.get("find") or []) if str(x).strip()][:4] if isinstance(pr.get("find"), list) else [],
+        "section": str(pr.get("section") or "").strip(),
+    }
+
+    # Use the packed section as the final "top_heading" when present (it is forced to be a real heading).
+    sec = str(pr.get("section") or "").strip()
+    if sec and (not _is_probably_bad_heading(sec)):
+        meta["top_heading"] = sec
+
+    # Recompute combined score with semantic signal.
+    r = meta.get("ref_rank") or {}
+    try:
+        bm25 = float(r.get("bm25", 0.0) or 0.0)
+    except Exception:
+        bm25 = 0.0
+    try:
+        deep_best = float(r.get("deep", 0.0) or 0.0)
+    except Exception:
+        deep_best = 0.0
+    try:
+        term_bonus = float(r.get("term_bonus", 0.0) or 0.0)
+    except Exception:
+        term_bonus = 0.0
+    deep_scaled = 1.6 * (deep_best ** 0.6) if deep_best > 0 else 0.0
+    combined2 = (llm_score / 10.0) + (0.25 * deep_scaled) + (0.10 * bm25) + (0.50 * term_bonus)
+    d["score"] = float(combined2)
+    meta["ref_rank"] = {"bm25": bm25, "deep": deep_best, "term_bonus": term_bonus, "llm": llm_score, "why": llm_why, "score": combined2}
+    d["meta"] = meta
+
 def _group_hits_by_doc_for_refs(
     hits_raw: list[dict],
     prompt_text: str,
@@ -288,9 +629,13 @@ def _group_hits_by_doc_for_refs(
     deep_read: bool = False,
     llm_rerank: bool = False,
     settings=None,
+    time_budget_s: float | None = None,
+    on_update: Callable[[list[dict]], None] | None = None,
 ) -> list[dict]:
     """
     Merge hits from the same markdown doc into a single ref entry.
+    time_budget_s bounds the per-doc work (default KB_REFS_BUDGET_S).
+    on_update (with llm_rerank) receives the provisional top refs each time a streamed rerank item lands.
     """
     by_doc: dict[str, list[dict]] = {}
     for h in hits_raw or []:
@@ -310,190 +655,81 @@ def _group_hits_by_doc_for_refs(
         doc_order.append((best_score, src))
     doc_order.sort(key=lambda x: x[0], reverse=True)
 
-    docs: list[dict] = []
     profile = _query_term_profile(prompt_text, deep_query or "")
     # Keep it fast: do NOT do full-doc deep scoring for every hit.
     # Deep-read expansion (reading full md) is only applied to a couple of top docs.
     deep_expand_docs = 2 if deep_read else 0
     # Bound work: only consider a limited number of candidate docs.
     max_docs_consider = max(int(top_k_docs) * 2, 12)
-    for _best, src in doc_order[:max_docs_consider]:
-        hs = by_doc.get(src) or []
-        hs2 = sorted(hs, key=lambda x: float(x.get("score", 0.0) or 0.0), reverse=True)
-        best_score = float(hs2[0].get("score", 0.0) or 0.0) if hs2 else 0.0
-        # Candidate headings: (score, top_heading)
-        cand: list[tuple[float, str]] = []
-        snippets: list[str] = []
-        locs: list[tuple[float, str]] = []
-        for h in hs2[:6]:
-            meta = h.get("meta", {}) or {}
-            top = (meta.get("top_heading") or _top_heading(meta.get("heading_path", "")) or "").strip()
-            if top:
-                cand.append((float(h.get("score", 0.0) or 0.0), top))
-                if not _is_probably_bad_heading(top):
-                    locs.append((float(h.get("score", 0.0) or 0.0), top))
-            t = (h.get("text") or "").strip()
-            if t:
-                snippets.append(t)
-
-        # Optional deep-read for better section targeting + aspects + ranking.
-        deep_best = 0.0
-        if deep_read and deep_query and (len(docs) < deep_expand_docs):
-            try:
-                extra = _deep_read_md_for_context(Path(src), deep_query, max_snippets=2, snippet_chars=1400)
-            except Exception:
-                extra = []
-            for ex in extra or []:
-                meta_ex = ex.get("meta", {}) or {}
-                top2 = _top_heading(meta_ex.get("heading_path", "") or "")
-                if top2:
-                    cand.append((float(ex.get("score", 0.0) or 0.0) + 0.2, top2))
-                tx = (ex.get("text") or "").strip()
-                if tx:
-                    snippets.append(tx)
-                try:
-                    deep_best = max(deep_best, float(ex.get("score", 0.0) or 0.0))
-                except Exception:
-                    pass
-
-        # Final heading MUST be a real heading from this doc.
-        # Prefer headings already attached to hits (grounded), but also read real md headings for navigation.
-        best_heading = _pick_best_heading_for_doc(cand, prompt_text)
-        headings_for_pack: list[str] = []
-        try:
-            prefer = _preferred_section_keys(prompt_text)
-            picked = _pick_heading_from_md(Path(src), deep_query or prompt_text, prefer=prefer)
-            if picked:
-                best_heading = picked
-        except Exception:
-            pass
-        try:
-            headings_for_pack = _extract_md_headings(Path(src), max_n=40)
-        except Exception:
-            headings_for_pack = []
-        if not headings_for_pack:
-            # Minimal heading set: only what we have seen from hits/deep-read.
-            seen_h2: list[str] = []
-            for _sc2, hh in sorted(cand, key=lambda x: x[0], reverse=True):
-                hh2 = _normalize_heading(hh)
-                if not hh2 or _is_probably_bad_heading(hh2) or hh2 in seen_h2:
-                    continue
-                seen_h2.append(hh2)
-                if len(seen_h2) >= 22:
-                    break
-            headings_for_pack = seen_h2
-        aspects = _aspects_from_snippets(snippets[:3], prompt_text)
-
-        # Build display snippets: pick the most relevant, non-noise snippets.
-        q_for_pick = (deep_query or prompt_text or "").strip()
-        q_tokens = [t for t in tokenize(q_for_pick) if len(t) >= 3]
-        scored_snips: list[tuple[float, str]] = []
-        for s in snippets:
-            s2 = (s or "").strip()
-            if not s2:
-                continue
-            if _is_noise_snippet_text(s2):
-                continue
+    cand_docs = [src for _best, src in doc_order[:max_docs_consider]]
+
+    # Docs are built in parallel under one deadline; a doc that misses it (or fails) gets the fast shape.
+    budget = _REFS_BUDGET_S if time_budget_s is None else max(0.0, float(time_budget_s))
+    deadline = time.monotonic() + budget
+    futs = [
+        submit_in_scope(
+            _REFS_POOL,
+            _build_doc_ref,
+            src,
+            by_doc.get(src) or [],
+            prompt_text,
+            deep_query=deep_query,
+            do_deep=(i < deep_expand_docs),
+            profile=profile,
+            deadline=deadline,
+        )
+        for i, src in enumerate(cand_docs)
+    ]
+    wait(futs, timeout=budget)
+    docs: list[dict] = []
+    for src, fut in zip(cand_docs, futs):
+        d = None
+        if fut.done():
             try:
-                sc = _score_tokens(s2, q_tokens) if q_tokens else 0.0
+                d = fut.result()
             except Exception:
-                sc = 0.0
-            # Prefer snippets that literally contain key phrases for single-shot/single-pixel disambiguation.
-            low = _norm_text_for_match(s2)
-            if profile.get("wants_single_shot") and any(k in low for k in ["single-shot", "single shot", "single exposure", "snapshot"]):
-                sc += 3.0
-            if profile.get("wants_single_shot") and any(k in low for k in ["single-pixel", "single pixel"]):
-                sc -= 3.0
-            scored_snips.append((float(sc), s2))
-        scored_snips.sort(key=lambda x: x[0], reverse=True)
-        show_snips = [_clean_snippet_for_display(s, max_chars=900) for _, s in scored_snips[:2]]
-
-        # Best location candidates (real headings)
-        locs.sort(key=lambda x: x[0], reverse=True)
-        locs2 = []
-        seen_h = set()
-        for sc, hh in locs:
-            hh2 = _normalize_heading(hh)
-            if not hh2 or _is_probably_bad_heading(hh2) or hh2 in seen_h:
+                d = None
+        else:
+            fut.cancel()
+        if d is None:
+            fast = _group_hits_by_doc_for_refs_fast(by_doc.get(src) or [], top_k_docs=1)
+            if not fast:
                 continue
-            seen_h.add(hh2)
-            locs2.append({"heading": hh2, "score": float(sc)})
-            if len(locs2) >= 3:
-                break
-
-        # Heuristic base score: BM25 + small deep-read signal + term mismatch penalties.
-        doc_name = Path(src).name
-        term_bonus = _doc_term_bonus(profile, doc_name, snippets[:3])
-        deep_scaled = 1.6 * (deep_best ** 0.6) if deep_best > 0 else 0.0
-        combined = (0.75 * best_score) + (0.25 * deep_scaled) + term_bonus
-
-        meta_out = {"source_path": src}
-        if best_heading:
-            meta_out["top_heading"] = best_heading
-        meta_out["ref_aspects"] = aspects
-        meta_out["ref_snippets"] = snippets[:2]
-        meta_out["ref_show_snippets"] = show_snips
-        meta_out["ref_locs"] = locs2
-        meta_out["ref_headings"] = headings_for_pack
-        meta_out["ref_rank"] = {"bm25": best_score, "deep": deep_best, "term_bonus": term_bonus, "llm": 0.0, "why": "", "score": combined}
-
-        docs.append(
-            {
-                "score": float(combined),
-                "id": f"doc:{hashlib.sha1(src.encode('utf-8','ignore')).hexdigest()[:12]}",
-                "text": snippets[0] if snippets else "",
-                "meta": meta_out,
-            }
-        )
+            d = fast[0]
+            # Same scale as a built entry without the deep-read signal, so a doc that timed out
+            # cannot outrank the built ones on its raw BM25 score.
+            meta = d.get("meta") or {}
+            bm25 = float(d.get("score", 0.0) or 0.0)
+            top_texts = [
+                (h.get("text") or "").strip()
+                for h in sorted(by_doc.get(src) or [], key=lambda x: float(x.get("score", 0.0) or 0.0), reverse=True)[:3]
+            ]
+            term_bonus = _doc_term_bonus(profile, Path(src).name, [t for t in top_texts if t])
+            d["score"] = float((0.75 * bm25) + term_bonus)
+            meta["ref_rank"] = {"bm25": bm25, "deep": 0.0, "term_bonus": term_bonus, "llm": 0.0, "why": "", "score": d["score"]}
+            d["meta"] = meta
+        docs.append(d)
 
     # Optional LLM pack: one-shot semantic rerank + strong directional one-liner pieces (grounded on snippets/headings).
     if llm_rerank and settings and docs:
-        pack = _llm_refs_pack(settings, question=(prompt_text or deep_query or ""), docs=docs)
+        on_item = None
+        if on_update is not None:
+
+            def on_item(i: int, pr: dict) -> None:
+                # Streamed entry: apply it now and publish the provisional order (unscored docs keep heuristic scores).
+                if 1 <= i <= len(docs):
+                    _apply_refs_pack_entry(docs[i - 1], pr)
+                try:
+                    on_update(sorted(docs, key=lambda x: float(x.get("score", 0.0) or 0.0), reverse=True)[: max(1, int(top_k_docs))])
+                except Exception:
+                    pass
+
+        pack = _llm_refs_pack(settings, question=(prompt_text or deep_query or ""), docs=docs, on_item=on_item)
         if isinstance(pack, dict) and pack:
             for i, d in enumerate(docs, start=1):
-                meta = d.get("meta", {}) or {}
                 pr = pack.get(i) or {}
-                if not isinstance(pr, dict):
-                    continue
-                try:
-                    llm_score = float(pr.get("score", 0.0) or 0.0)
-                except Exception:
-                    llm_score = 0.0
-                llm_score = max(0.0, min(100.0, llm_score))
-                llm_why = str(pr.get("why") or "").strip()
-
-                meta["ref_pack"] = {
-                    "score": llm_score,
-                    "why": llm_why,
-                    "what": str(pr.get("what") or "").strip(),
-                    "find": [str(x).strip() for x in (pr.get("find") or []) if str(x).strip()][:4] if isinstance(pr.get("find"), list) else [],
-                    "section": str(pr.get("section") or "").strip(),
-                }
-
-                # Use the packed section as the final "top_heading" when present (it is forced to be a real heading).
-                sec = str(pr.get("section") or "").strip()
-                if sec and (not _is_probably_bad_heading(sec)):
-                    meta["top_heading"] = sec
-
-                # Recompute combined score with semantic signal.
-                r = meta.get("ref_rank") or {}
-                try:
-                    bm25 = float(r.get("bm25", 0.0) or 0.0)
-                except Exception:
-                    bm25 = 0.0
-                try:
-                    deep_best = float(r.get("deep", 0.0) or 0.0)
-                except Exception:
-                    deep_best = 0.0
-                try:
-                    term_bonus = float(r.get("term_bonus", 0.0) or 0.0)
-                except Exception:
-                    term_bonus = 0.0
-                deep_scaled = 1.6 * (deep_best ** 0.6) if deep_best > 0 else 0.0
-                combined2 = (llm_score / 10.0) + (0.25 * deep_scaled) + (0.10 * bm25) + (0.50 * term_bonus)
-                d["score"] = float(combined2)
-                meta["ref_rank"] = {"bm25": bm25, "deep": deep_best, "term_bonus": term_bonus, "llm": llm_score, "why": llm_why, "score": combined2}
-                d["meta"] = meta
+                if isinstance(pr, dict):
+                    _apply_refs_pack_entry(d, pr)
 
     docs.sort(key=lambda x: float(x.get("score", 0.0) or 0.0), reverse=True)
     return docs[: max(1, int(top_k_docs))]
@@ -543,22 +779,52 @@ def _group_hits_by_doc_for_refs_fast(hits_raw: list[dict], top_k_docs: int) -> l
     docs.sort(key=lambda x: float(x.get("score", 0.0) or 0.0), reverse=True)
     return docs[: max(1, int(top_k_docs))]
 
-def _read_text_cached(path: Path) -> str:
+def _md_index_cached(path: Path) -> MdIndex | None:
+    """Structural index of an .md file (headings / page markers by byte offset), cached per mtime+size."""
     p = Path(path)
     try:
-        mtime = float(p.stat().st_mtime)
+        st = p.stat()
     except Exception:
-        mtime = 0.0
-    key = f"{str(p)}|{mtime}"
-    v0 = _cache_get("file_text", key)
-    if isinstance(v0, str):
+        return None
+    key = f"{str(p)}|{float(st.st_mtime)}|{int(st.st_size)}"
+    v0 = _cache_get("md_index", key)
+    if isinstance(v0, MdIndex):
         return v0
+    idx = build_md_index(p)
+    if idx is not None:
+        _cache_set("md_index", key, idx, max_items=512)
+    return idx
+
+def _md_heading_table(md_path: Path) -> list[tuple[int, str, bool]]:
+    """
+    (level, normalized title, bad-heading flag) per heading line of an .md file.
+    From the heading table written by ingest.py when it is fresh for this file, else parsed via the md index.
+    """
+    p = Path(md_path)
     try:
-        text = p.read_text(encoding="utf-8", errors="replace")
+        st = p.stat()
     except Exception:
-        text = ""
-    _cache_set("file_text", key, text, max_items=220)
-    return text
+        return []
+    key = f"{str(p)}|{float(st.st_mtime)}|{int(st.st_size)}"
+    v0 = _cache_get("md_headings", key)
+    if isinstance(v0, list):
+        return v0
+    rows: list[tuple[int, str, bool]] | None = None
+    dix = active_doc_index()
+    if dix is not None:
+        hs = dix.headings(p)
+        if hs is not None:
+            rows = [(h.level, h.norm_title, h.bad) for h in hs]
+    if rows is None:
+        idx = _md_index_cached(p)
+        if idx is None:
+            return []
+        rows = []
+        for h in idx.headings:
+            title = _normalize_heading(h.title)
+            rows.append((h.level, title, (not title) or _is_probably_bad_heading(title)))
+    _cache_set("md_headings", key, rows, max_items=512)
+    return rows
 
 def _extract_md_headings(md_path: Path, *, max_n: int = 80) -> list[str]:
     """
@@ -568,20 +834,11 @@ def _extract_md_headings(md_path: Path, *, max_n: int = 80) -> list[str]:
     md_path = Path(md_path)
     if not md_path.exists():
         return []
-    text = _read_text_cached(md_path)
-    if not text:
-        return []
     out: list[str] = []
-    for line in text.splitlines():
-        s = line.strip()
-        if not s.startswith("#"):
-            continue
-        level = len(s) - len(s.lstrip("#"))
+    for level, title, bad in _md_heading_table(md_path):
         if level <= 0 or level > 4:
             continue
-        title = s[level:].strip()
-        title = _normalize_heading(title)
-        if not title or _is_probably_bad_heading(title):
+        if bad:
             continue
         if title not in out:
             out.append(title)
@@ -606,8 +863,7 @@ def _pick_heading_from_md(md_path: Path, query: str, *, prefer: list[str]) -> st
         # Keyword overlap
         base = 0.0
         if q_toks:
-            ht = tokenize(h)
-            ct = Counter(ht)
+            ct = term_counts(h)
             base += float(sum(ct.get(t, 0) for t in q_toks))
         # Preference boost (method/results/intro etc)
         bonus = 0.0
@@ -631,17 +887,36 @@ def _pick_heading_from_md(md_path: Path, query: str, *, prefer: list[str]) -> st
         return ""
     return best
 
+def _deep_read_scan(md_path: Path, q_tokens: list[str], *, max_snippets: int) -> list[tuple[float, dict]]:
+    """Deep-read without the ingest-time sub-chunk layer: chunk and score the whole file."""
+    idx = _md_index_cached(md_path)
+    if idx is None:
+        return []
+
+    def iter_scored():
+        # One section (heading to heading) decoded at a time from the mmap; chunks never cross headings.
+        for stack, page, section in idx.iter_sections():
+            for c in chunk_markdown(section, source_path=str(md_path), chunk_size=DEEP_CHUNK_SIZE, overlap=0, heading_stack=stack, page=page):
+                body = (c.get("text") or "").strip()
+                if len(body) < DEEP_MIN_CHARS:
+                    continue
+                s = _score_tokens(body, q_tokens)
+                if s <= 0.0:
+                    continue
+                yield (s, c)
+
+    # Same order as a stable sort by score (desc), without keeping every scored chunk.
+    return heapq.nlargest(max(1, int(max_snippets)), iter_scored(), key=lambda x: x[0])
+
 def _deep_read_md_for_context(md_path: Path, query: str, *, max_snippets: int = 3, snippet_chars: int = 1400) -> list[dict]:
     """
-    Read the full .md and extract the most relevant snippets (by token overlap),
+    Extract the most relevant snippets of one .md (by token overlap),
     then return in the same dict shape as retriever hits.
+    Uses the sub-chunk layer written by ingest.py when it is fresh for this file, else scans the file.
     """
     md_path = Path(md_path)
     if not md_path.exists():
         return []
-    text = _read_text_cached(md_path)
-    if not text.strip():
-        return []
 
     q_tokens = [t for t in tokenize(query or "") if len(t) >= 3]
     if not q_tokens:
@@ -660,20 +935,12 @@ def _deep_read_md_for_context(md_path: Path, query: str, *, max_snippets: int =
         except Exception:
             return []
 
-    chunks = chunk_markdown(text, source_path=str(md_path), chunk_size=900, overlap=0)
-    scored: list[tuple[float, dict]] = []
-    for c in chunks:
-        body = (c.get("text") or "").strip()
-        if len(body) < 80:
-            continue
-        s = _score_tokens(body, q_tokens)
-        if s <= 0.0:
-            continue
-        scored.append((s, c))
-
-    scored.sort(key=lambda x: x[0], reverse=True)
+    dix = active_doc_index()
+    top = dix.deep_read(md_path, q_tokens, top_n=max(1, int(max_snippets))) if dix is not None else None
+    if top is None:
+        top = _deep_read_scan(md_path, q_tokens, max_snippets=max_snippets)
     out: list[dict] = []
-    for rank, (s, c) in enumerate(scored[: max(1, int(max_snippets))], start=1):
+    for rank, (s, c) in enumerate(top, start=1):
         meta = dict((c.get("meta") or {}))
         meta.setdefault("source_path", str(md_path))
         meta["deep_read"] = True
@@ -684,11 +951,18 @@ def _deep_read_md_for_context(md_path: Path, query: str, *, max_snippets: int =
     _cache_set("deep_read", cache_key, out, max_items=320)
     return out
 
-def _llm_refs_pack(settings, *, question: str, docs: list[dict]) -> dict[int, dict]:
+def _llm_refs_pack(
+    settings,
+    *,
+    question: str,
+    docs: list[dict],
+    on_item: Callable[[int, dict], None] | None = None,
+) -> dict[int, dict]:
     """
     One-shot LLM pack for refs:
     - semantic relevance score (0..100) for reranking
     - a strong directional one-liner pieces (what/find/section) grounded on snippets
+    - with on_item: the response is streamed and on_item(idx, entry) is called as each item closes
 
     Returns: {idx -> {"score":float, "why":str, "what":str, "find":[str], "section":str}}
     """
@@ -738,8 +1012,49 @@ def _llm_refs_pack(settings, *, question: str, docs: list[dict]) -> dict[int, di
     if isinstance(v0, dict):
         return v0
 
-    ds = DeepSeekChat(settings)
     en = _has_latin(q) and (not _has_cjk(q))
+    req = {"settings": settings, "q": q, "items": items, "en": en, "cache_key": cache_key, "db_dir": current_db_dir()}
+    if on_item is not None:
+        ds = DeepSeekChat(settings)
+        # Keep payload small
+        user = json.dumps({"question": q, "docs": items}, ensure_ascii=False)
+        messages = [{"role": "system", "content": _refs_pack_system_prompt(en)}, {"role": "user", "content": user}]
+        result: dict[int, dict] = {}
+        parser = _JsonItemsStream("items")
+        try:
+            for piece in ds.chat_stream(messages=messages, temperature=0.0, max_tokens=520):
+                for it in parser.feed(piece):
+                    ent = _refs_pack_entry(it)
+                    if ent is None:
+                        continue
+                    result[ent[0]] = ent[1]
+                    try:
+                        on_item(ent[0], ent[1])
+                    except Exception:
+                        pass
+        except Exception:
+            # Keep what already arrived; only fall back to the one-shot call if nothing did.
+            return result if result else _llm_refs_pack(settings, question=question, docs=docs)
+        if result:
+            # A stream cut off before the array closed (e.g. at max_tokens) is used but not cached.
+            if parser.closed:
+                _cache_set("refs_pack", cache_key, result, max_items=260)
+            return result
+        return _refs_pack_result(_parse_llm_json(parser.text), cache_key) or {}
+    if _LLM_BATCH_WINDOW_S > 0:
+        # Joined with other pending refs packs into one completion (see _refs_pack_batch).
+        try:
+            res = _REFS_PACK_BATCHER.submit(_llm_batch_key(settings, "refs_pack", en), req).result(timeout=_llm_batch_wait_s(settings))
+        except Exception:
+            res = None
+        if res is _RETRY_ALONE:
+            res = _refs_pack_batch(None, [req])[0]
+    else:
+        res = _refs_pack_batch(None, [req])[0]
+    return res or {}
+
+
+def _refs_pack_system_prompt(en: bool) -> str:
     if en:
         sys = (
             "You are a strict academic retriever reranker and paper navigator.\n"
@@ -762,48 +1077,161 @@ def _llm_refs_pack(settings, *, question: str, docs: list[dict]) -> dict[int, di
             "- section 蹇呴』浠庣粰瀹?headings 涓€変竴涓紱閫変笉鍑烘潵灏辩┖瀛楃涓层€俓n"
             "- what锛?= 22瀛楋紱why锛?= 16瀛楋紱find锛?-4 涓煭璇紙鍏蜂綋鑳芥壘鍒颁粈涔堬級銆俓n"
         )
+    return sys
 
-    # Keep payload small
-    payload = {"question": q, "docs": items}
-    user = json.dumps(payload, ensure_ascii=False)
-    try:
-        out = (ds.chat(messages=[{"role": "system", "content": sys}, {"role": "user", "content": user}], temperature=0.0, max_tokens=520) or "").strip()
-    except Exception:
-        out = ""
-    if out.startswith("```"):
-        out = out.strip().strip("`")
-        out = out.replace("json", "", 1).strip()
-
-    try:
-        data = json.loads(out)
-    except Exception:
-        data = None
+def _refs_pack_result(data, cache_key: str, *, qid: str | None = None) -> dict[int, dict] | None:
+    """Parsed pack JSON -> {idx -> entry} (only items tagged with qid, when given), cached; None if unusable."""
     if not isinstance(data, dict):
-        return {}
+        return None
     arr = data.get("items") or []
     if not isinstance(arr, list):
-        return {}
-
+        return None
     result: dict[int, dict] = {}
     for it in arr:
-        if not isinstance(it, dict):
-            continue
-        try:
-            i = int(it.get("i"))
-        except Exception:
+        if qid is not None and not (isinstance(it, dict) and str(it.get("qid")) == qid):
             continue
+        ent = _refs_pack_entry(it)
+        if ent is not None:
+            result[ent[0]] = ent[1]
+    if qid is not None and not result:
+        return None
+    _cache_set("refs_pack", cache_key, result, max_items=260)
+    return result
+
+def _refs_pack_batch(_key, reqs: list[dict]) -> list:
+    """
+    Refs packs for several questions (same provider/language) with one completion; results land in the refs_pack cache.
+    A single request uses the original one-question prompt; questions missing from a combined answer
+    get _RETRY_ALONE and are retried by their callers.
+    """
+    settings = reqs[0]["settings"]
+    ds = DeepSeekChat(settings)
+    sys = _refs_pack_system_prompt(bool(reqs[0]["en"]))
+    if len(reqs) == 1:
+        r = reqs[0]
+        # Keep payload small
+        user = json.dumps({"question": r["q"], "docs": r["items"]}, ensure_ascii=False)
         try:
-            sc = float(it.get("score", 0.0) or 0.0)
+            out = (ds.chat(messages=[{"role": "system", "content": sys}, {"role": "user", "content": user}], temperature=0.0, max_tokens=520) or "").strip()
         except Exception:
-            sc = 0.0
-        sc = max(0.0, min(100.0, sc))
-        result[i] = {
-            "score": sc,
-            "why": str(it.get("why") or "").strip(),
-            "what": str(it.get("what") or "").strip(),
-            "find": [str(x).strip() for x in (it.get("find") or []) if str(x).strip()][:4] if isinstance(it.get("find"), list) else [],
-            "section": str(it.get("section") or "").strip(),
-        }
+            out = ""
+        with use_db_dir(r.get("db_dir")):
+            return [_refs_pack_result(_parse_llm_json(out), r["cache_key"])]
+
+    sys = sys + (
+        "\nBatch mode: the user message is JSON {\"questions\":[{\"qid\",\"question\",\"docs\"}]}; "
+        "handle each question independently with the rules above (i refers to that question's docs).\n"
+        "Output JSON ONLY: {\"items\":[{\"qid\":string,\"i\":int,\"score\":number,\"why\":string,\"what\":string,\"find\":[string],\"section\":string}]}.\n"
+    )
+    payload = {"questions": [{"qid": f"q{n}", "question": r["q"], "docs": r["items"]} for n, r in enumerate(reqs, start=1)]}
+    try:
+        out = (
+            ds.chat(
+                messages=[{"role": "system", "content": sys}, {"role": "user", "content": json.dumps(payload, ensure_ascii=False)}],
+                temperature=0.0,
+                max_tokens=min(520 * len(reqs), 4096),
+            )
+            or ""
+        ).strip()
+    except Exception:
+        out = ""
+    data = _parse_llm_json(out)
+    res: list[dict[int, dict] | None] = []
+    for n, r in enumerate(reqs, start=1):
+        with use_db_dir(r.get("db_dir")):
+            got = _refs_pack_result(data, r["cache_key"], qid=f"q{n}")
+        res.append(got if got is not None else _RETRY_ALONE)
+    return res
+
+
+def _refs_pack_entry(it) -> tuple[int, dict] | None:
+    """One parsed "items" element -> (idx, normalized entry); None if unusable."""
+    if not isinstance(it, dict):
+        return None
+    try:
+        i = int(it.get("i"))
+    except Exception:
+        return None
+    try:
+        sc = float(it.get("score", 0.0) or 0.0)
+    except Exception:
+        sc = 0.0
+    sc = max(0.0, min(100.0, sc))
+    return i, {
+        "score": sc,
+        "why": str(it.get("why") or "").strip(),
+        "what": str(it.get("what") or "").strip(),
+        "find": [str(x).strip() for x in (it.get("find") or []) if str(x).strip()][:4] if isinstance(it.get("find"), list) else [],
+        "section": str(it.get("section") or "").strip(),
+    }
+
+
+class _JsonItemsStream:
+    """
+    Incremental reader for streamed JSON like {"items":[{...},{...}]}.
+    feed() returns the array's objects that closed in this piece (code fences / prefixes are skipped);
+    closed turns True once the array's "]" arrives (a stream cut off at max_tokens never gets there).
+    """
 
-    _cache_set("refs_pack", cache_key, result, max_items=260)
-    return result
+    def __init__(self, key: str) -> None:
+        self._re_open = re.compile(r'"' + re.escape(key) + r'"\s*:\s*\[')
+        self._buf = ""
+        self._pos = -1
+        self._depth = 0
+        self._in_str = False
+        self._esc = False
+        self._obj_start = -1
+        self._closed = False
+
+    @property
+    def text(self) -> str:
+        return self._buf
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def feed(self, piece: str) -> list[dict]:
+        self._buf += piece or ""
+        buf = self._buf
+        if self._closed:
+            return []
+        if self._pos < 0:
+            m = self._re_open.search(buf)
+            if m is None:
+                return []
+            self._pos = m.end()
+        out: list[dict] = []
+        i = self._pos
+        n = len(buf)
+        while i < n:
+            ch = buf[i]
+            if self._in_str:
+                if self._esc:
+                    self._esc = False
+                elif ch == "\\":
+                    self._esc = True
+                elif ch == '"':
+                    self._in_str = False
+            elif ch == '"':
+                self._in_str = True
+            elif ch == "{":
+                if self._depth == 0:
+                    self._obj_start = i
+                self._depth += 1
+            elif ch == "}" and self._depth > 0:
+                self._depth -= 1
+                if self._depth == 0 and self._obj_start >= 0:
+                    try:
+                        obj = json.loads(buf[self._obj_start : i + 1])
+                    except ValueError:
+                        obj = None
+                    if isinstance(obj, dict):
+                        out.append(obj)
+                    self._obj_start = -1
+            elif ch == "]" and self._depth == 0:
+                self._closed = True
+                break
+            i += 1
+        self._pos = i
+        return out
@@ -1,8 +1,8 @@
 from __future__ import annotations
 
 import re
-from collections import Counter
 
+from .token_cache import term_counts
 from .tokenize import tokenize
 
 def _has_cjk(text: str) -> bool:
@@ -363,10 +363,9 @@ def _aspects_from_snippets(snippets: list[str], prompt_text: str) -> list[str]:
     return out[:4]
 
 def _score_tokens(text: str, query_tokens: list[str]) -> float:
-    toks = tokenize(text or "")
-    if not toks:
+    ct = term_counts(text or "")
+    if not ct:
         return 0.0
     if not query_tokens:
         return 0.0
-    ct = Counter(toks)
     return float(sum(ct.get(t, 0) for t in query_tokens))
@@ -1,9 +1,13 @@
 from __future__ import annotations
 
+import math
+import threading
 from dataclasses import dataclass
+from pathlib import Path
 
-from rank_bm25 import BM25Okapi
+import numpy as np
 
+from .token_cache import TokenCacheReader, remember_term_counts
 from .tokenize import tokenize
 
 
@@ -15,42 +19,234 @@ class Hit:
     chunk_id: str
 
 
-class BM25Retriever:
+def _top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    Same result as sorted(range(len(scores)), key=scores.__getitem__, reverse=True)[:k],
+    i.e. descending score with ties kept in index order, without sorting the whole array.
+    """
+    n = int(scores.shape[0])
+    k = min(max(0, int(k)), n)
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    if k < n:
+        kth = scores[np.argpartition(-scores, k - 1)[k - 1]]
+        above = np.flatnonzero(scores > kth)
+        tied = np.flatnonzero(scores == kth)[: k - above.shape[0]]
+        sel = np.concatenate([above, tied])
+    else:
+        sel = np.arange(n)
+    # Stable sort keeps index order among equal scores.
+    return sel[np.argsort(-scores[sel], kind="stable")]
+
+
+class _ListChunkSource:
+    """Chunk source over in-memory JSONL dicts (same accessors as ColumnarChunkStore)."""
+
     def __init__(self, chunks: list[dict]) -> None:
-        # New users may run the app before ingesting any Markdown into the DB.
-        # BM25Okapi cannot be initialized with an empty corpus, so we treat empty DB as "no hits".
-        self._chunks = list(chunks or [])
-        self._corpus_tokens = [tokenize(c.get("text", "")) for c in self._chunks]
-        self._bm25 = BM25Okapi(self._corpus_tokens) if self._corpus_tokens else None
+        self._chunks = chunks
+
+    def __len__(self) -> int:
+        return len(self._chunks)
+
+    def iter_texts(self):
+        for c in self._chunks:
+            yield c.get("text", "")
+
+    def chunk_id(self, i: int) -> str:
+        return self._chunks[i].get("id", str(i))
+
+    def text(self, i: int) -> str:
+        return self._chunks[i].get("text", "")
+
+    def meta(self, i: int) -> dict:
+        return self._chunks[i].get("meta", {})
+
+
+class RetrieverSnapshot:
+    """
+    Reference count of the searches running on one retriever, so close() (called by the
+    retriever registry when the snapshot is replaced) waits for searches that picked it up
+    before the swap. Subclasses implement _search() and _release().
+    """
+
+    def __init__(self) -> None:
+        self._users = 0
+        self._users_lock = threading.Lock()
+        self._close_pending = False
+
+    def acquire(self) -> None:
+        with self._users_lock:
+            self._users += 1
+
+    def release(self) -> None:
+        with self._users_lock:
+            self._users -= 1
+            do_close = self._close_pending and self._users <= 0
+        if do_close:
+            self._release()
+
+    def close(self) -> None:
+        """Release mmaps/files now, or once the last running search has finished."""
+        with self._users_lock:
+            self._close_pending = True
+            if self._users > 0:
+                return
+        self._release()
+
+    def search(self, query: str, top_k: int = 6) -> list[dict]:
+        self.acquire()
+        try:
+            return self._search(query, top_k)
+        finally:
+            self.release()
+
+    def _search(self, query: str, top_k: int) -> list[dict]:
+        raise NotImplementedError
+
+    def _release(self) -> None:
+        pass
+
+
+class BM25Retriever(RetrieverSnapshot):
+    """
+    In-memory BM25 over all chunks, scored with NumPy over term-id postings.
+    Scores and ranking are identical to rank_bm25.BM25Okapi (k1=1.5, b=0.75, epsilon=0.25).
+    - chunks are int32 term-id arrays (from the token cache when tokens_db is given)
+    - doc-term matrix in CSR form (row per chunk) plus its transpose (row per term) for scoring
+    - hit id/text/meta come from the chunk source on demand; with a ColumnarChunkStore
+      (see from_store) chunk texts stay in the mmap
+    """
+
+    k1 = 1.5
+    b = 0.75
+    epsilon = 0.25
+
+    def __init__(self, chunks: list[dict], *, source=None, tokens_db: Path | None = None) -> None:
+        super().__init__()
+        # New users may run the app before ingesting any Markdown into the DB: an empty corpus means "no hits".
+        self._source = source if source is not None else _ListChunkSource(list(chunks or []))
+        self._n = len(self._source)
+        src = self._source
+        tokens = TokenCacheReader(tokens_db)
+        try:
+            self._build(tokens.iter_term_ids((src.chunk_id(i) for i in range(self._n)), src.iter_texts()))
+        finally:
+            tokens.close()
+        self._vocab = tokens.vocab
+
+    @classmethod
+    def from_store(cls, store, *, tokens_db: Path | None = None) -> "BM25Retriever":
+        """Build over a ColumnarChunkStore without materialising chunk dicts."""
+        return cls([], source=store, tokens_db=tokens_db)
+
+    def _release(self) -> None:
+        # The chunk source: the columnar store mmaps when built with from_store.
+        close = getattr(self._source, "close", None)
+        if close is not None:
+            close()
+
+    def _build(self, term_ids) -> None:
+        row_terms: list[np.ndarray] = []
+        row_tf: list[np.ndarray] = []
+        row_first: list[np.ndarray] = []
+        doc_len = np.zeros(self._n, dtype=np.int64)
+        for i, ids in enumerate(term_ids):
+            terms, first, tf = np.unique(ids, return_index=True, return_counts=True)
+            row_terms.append(terms.astype(np.int32))
+            row_tf.append(tf.astype(np.int32))
+            row_first.append(first)
+            doc_len[i] = ids.shape[0]
+        n_terms = max((int(t[-1]) + 1 for t in row_terms if t.shape[0]), default=0)
+        self._doc_len = doc_len
+        self._row_ptr = np.zeros(self._n + 1, dtype=np.int64)
+        np.cumsum([t.shape[0] for t in row_terms], out=self._row_ptr[1:])
+        self._row_terms = np.concatenate(row_terms) if row_terms else np.zeros(0, dtype=np.int32)
+        self._row_tf = np.concatenate(row_tf) if row_tf else np.zeros(0, dtype=np.int32)
+        first_pos = np.concatenate(row_first) if row_first else np.zeros(0, dtype=np.int64)
+
+        # Transpose: postings per term, chunk rows ascending.
+        rows = np.repeat(np.arange(self._n, dtype=np.int32), np.diff(self._row_ptr))
+        order = np.lexsort((rows, self._row_terms))
+        self._col_rows = rows[order]
+        self._col_tf = self._row_tf[order]
+        df = np.bincount(self._row_terms, minlength=n_terms)
+        self._col_ptr = np.zeros(n_terms + 1, dtype=np.int64)
+        np.cumsum(df, out=self._col_ptr[1:])
+
+        self._idf = np.zeros(n_terms)
+        self._norm = np.zeros(self._n)
+        if self._n <= 0:
+            return
+        # BM25Okapi sums idf over terms in corpus first-occurrence order (first chunk, then position
+        # in it), which decides the float rounding of average_idf and so the epsilon floor.
+        present = np.flatnonzero(df > 0)
+        head = self._col_ptr[present]
+        present = present[np.lexsort((first_pos[order][head], self._col_rows[head]))]
+        idf_sum = 0.0
+        negative: list[int] = []
+        n = self._n
+        for t in present.tolist():
+            freq = int(df[t])
+            idf = math.log(n - freq + 0.5) - math.log(freq + 0.5)
+            self._idf[t] = idf
+            idf_sum += idf
+            if idf < 0:
+                negative.append(t)
+        if present.shape[0]:
+            self._idf[negative] = self.epsilon * (idf_sum / present.shape[0])
+        avgdl = int(doc_len.sum()) / n
+        if avgdl > 0:
+            self._norm = self.k1 * (1 - self.b + self.b * doc_len / avgdl)
 
     @property
     def is_empty(self) -> bool:
-        return not self._chunks
+        return self._n <= 0
 
-    def search(self, query: str, top_k: int = 6) -> list[dict]:
-        if self._bm25 is None:
+    def _term_counts(self, i: int) -> dict[str, int]:
+        s, e = int(self._row_ptr[i]), int(self._row_ptr[i + 1])
+        terms = self._vocab.terms
+        return {terms[t]: tf for t, tf in zip(self._row_terms[s:e].tolist(), self._row_tf[s:e].tolist())}
+
+    def get_scores(self, q: list[str]) -> np.ndarray:
+        """Scores of all chunks for query tokens `q`, as BM25Okapi.get_scores()."""
+        scores = np.zeros(self._n)
+        n_terms = self._idf.shape[0]
+        # Repeated query terms are added repeatedly; chunks without the term add exactly 0.
+        for t in self._vocab.lookup(q):
+            if t is None or t >= n_terms:
+                continue
+            s, e = int(self._col_ptr[t]), int(self._col_ptr[t + 1])
+            if s == e:
+                continue
+            rows = self._col_rows[s:e]
+            tf = self._col_tf[s:e]
+            # Same operation order as BM25Okapi.get_scores() for bit-identical floats.
+            scores[rows] += self._idf[t] * (tf * (self.k1 + 1) / (tf + self._norm[rows]))
+        return scores
+
+    def _search(self, query: str, top_k: int) -> list[dict]:
+        if self._n <= 0:
             return []
         q = tokenize(query)
         if not q:
             return []
-        scores = self._bm25.get_scores(q)
-        try:
-            best = float(max(scores)) if len(scores) else 0.0
-        except Exception:
-            best = 0.0
+        scores = self.get_scores(q)
         # If nothing matches (common for cross-lingual queries), don't return arbitrary documents.
-        if best <= 0.0:
+        if not bool((scores > 0.0).any()):
             return []
-        idxs = sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)[: max(1, top_k)]
+        idxs = _top_k_indices(scores, max(1, top_k)).tolist()
+        src = self._source
         hits: list[dict] = []
         for i in idxs:
-            c = self._chunks[i]
+            text = src.text(i)
+            # Snippet scorers downstream get this hit's term counts without re-tokenizing.
+            remember_term_counts(text, self._term_counts(i))
             hits.append(
                 {
                     "score": float(scores[i]),
-                    "id": c.get("id", str(i)),
-                    "text": c.get("text", ""),
-                    "meta": c.get("meta", {}),
+                    "id": src.chunk_id(i),
+                    "text": text,
+                    "meta": src.meta(i),
                 }
             )
         return hits
@@ -0,0 +1,127 @@
+from __future__ import annotations
+
+import threading
+import time
+from pathlib import Path
+
+from . import runtime_state as RUNTIME
+from .bm25_index import BM25IndexRetriever, load_retriever, refresh_retriever
+from .chunk_store import colstore_dir
+from .retriever import BM25Retriever
+
+# Backward-compat for long-lived Streamlit processes that loaded older runtime_state.
+if not hasattr(RUNTIME, "RETRIEVER_LOCK"):
+    RUNTIME.RETRIEVER_LOCK = threading.Lock()
+if not hasattr(RUNTIME, "RETRIEVERS"):
+    RUNTIME.RETRIEVERS = {}
+
+
+def _db_key(db_dir: Path) -> str:
+    try:
+        return str(Path(db_dir).expanduser().resolve())
+    except Exception:
+        return str(db_dir)
+
+
+# A replaced snapshot is closed after this long (callers may hold it between fetching and searching);
+# close() itself then waits for the searches still running on it.
+_RETIRE_GRACE_S = 60.0
+
+
+def retriever_version(db_dir: Path) -> str:
+    """
+    Cheap version stamp of the DB: docs.json and columnar store mtimes.
+    The BM25 index is left out: it is synced from docs.json (also by the build itself),
+    so its mtime would only trigger a second, redundant rebuild.
+    """
+    parts: list[str] = []
+    for p in (Path(db_dir) / "docs.json", colstore_dir(db_dir) / "CURRENT"):
+        try:
+            parts.append(str(p.stat().st_mtime_ns))
+        except OSError:
+            parts.append("-")
+    return "|".join(parts)
+
+
+def _retire(old) -> None:
+    close = getattr(old, "close", None)
+    if close is None:
+        return
+    t = threading.Timer(_RETIRE_GRACE_S, close)
+    t.daemon = True
+    t.start()
+
+
+def _build(key: str, db_dir: Path, current, version: str, done: threading.Event) -> None:
+    try:
+        if current is not None:
+            nxt = refresh_retriever(db_dir, current)
+        else:
+            nxt = load_retriever(db_dir)
+        err = ""
+    except Exception as e:
+        # Never leave readers without a retriever: keep the old snapshot (or an empty one).
+        nxt = current if current is not None else BM25Retriever([])
+        err = f"{type(e).__name__}: {e}"
+    with RUNTIME.RETRIEVER_LOCK:
+        RUNTIME.RETRIEVERS[key] = {
+            "retriever": nxt,
+            "version": version,
+            "error": err,
+            "building": None,
+            "loaded_at": time.time(),
+        }
+    done.set()
+    if (current is not None) and (nxt is not current):
+        _retire(current)
+
+
+def get_shared_retriever(
+    db_dir: Path,
+    *,
+    force: bool = False,
+    wait: bool = False,
+    timeout_s: float = 600.0,
+) -> tuple[BM25IndexRetriever | BM25Retriever, str]:
+    """
+    Process-wide retriever for db_dir, shared by all Streamlit sessions and worker threads.
+
+    - first call builds synchronously; later callers reuse the same snapshot
+    - when the DB version changes (or force=True), the next snapshot is built in a
+      background thread while readers keep getting the current one
+    - wait=True blocks until a pending build has finished (e.g. the "reload" button)
+    - snapshots are not frozen: an index-backed one reads the BM25 index file that
+      sync_bm25_index updates in place (each search is one read transaction, so it sees
+      one consistent index state); only the columnar store is generation-versioned
+    - a replaced snapshot is closed after a grace period, and only once no search is running on it
+
+    Returns: (retriever, load_error)
+    """
+    key = _db_key(db_dir)
+    # Read before building: a change that lands mid-build triggers another reload.
+    version = retriever_version(db_dir)
+    start = False
+    with RUNTIME.RETRIEVER_LOCK:
+        ent = RUNTIME.RETRIEVERS.get(key)
+        if ent is None or ((force or ent.get("version") != version) and ent.get("building") is None):
+            base = ent or {"retriever": None, "version": "", "error": ""}
+            ent = {**base, "building": threading.Event()}
+            RUNTIME.RETRIEVERS[key] = ent
+            start = True
+        current = ent.get("retriever")
+        building = ent.get("building")
+
+    if start:
+        if (current is None) or wait:
+            _build(key, Path(db_dir), current, version, building)
+        else:
+            threading.Thread(target=_build, args=(key, Path(db_dir), current, version, building), daemon=True).start()
+    elif (building is not None) and ((current is None) or wait):
+        building.wait(timeout_s)
+
+    with RUNTIME.RETRIEVER_LOCK:
+        ent = RUNTIME.RETRIEVERS.get(key) or {}
+    r = ent.get("retriever")
+    if r is None:
+        r = BM25Retriever([])
+    return r, str(ent.get("error") or "")
@@ -3,6 +3,8 @@ from __future__ import annotations
 import threading
 from typing import Optional
 
+from .lru_cache import CacheBuckets, new_runtime_cache
+
 
 BG_LOCK = threading.Lock()
 BG_STATE = {
@@ -25,10 +27,11 @@ GEN_TASKS: dict[str, dict] = {}
 
 
 CACHE_LOCK = threading.Lock()
-CACHE: dict[str, dict] = {
-    "file_text": {},
-    "deep_read": {},
-    "trans": {},
-    "rerank": {},
-    "refs_pack": {},
-}
+# Per-bucket LRU caches (md_index, deep_read, trans, rerank, refs_pack, ...), see kb/lru_cache.py.
+CACHE: CacheBuckets = new_runtime_cache()
+
+
+# Shared retrievers, one per resolved db_dir (see kb/retriever_registry.py).
+# Entries are replaced as a whole, never mutated, so readers always see a complete snapshot.
+RETRIEVER_LOCK = threading.Lock()
+RETRIEVERS: dict[str, dict] = {}
@@ -54,6 +54,45 @@ def write_doc_chunks(db_dir: Path, doc_id: str, chunks: list[dict]) -> None:
             f.write(json.dumps(c, ensure_ascii=False) + "\n")
 
 
+def load_doc_chunks(db_dir: Path, doc_id: str) -> list[dict]:
+    chunks: list[dict] = []
+    p = doc_chunks_path(db_dir, doc_id)
+    if not p.exists():
+        return chunks
+    with p.open("r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            chunks.append(json.loads(line))
+    return chunks
+
+
+def list_chunk_doc_ids(db_dir: Path) -> list[str]:
+    # Same order as load_all_chunks(): one file per doc, sorted by name.
+    d = _chunks_dir(db_dir)
+    if not d.exists():
+        return []
+    return [p.stem for p in sorted(d.glob("*.jsonl"))]
+
+
+def current_doc_records(db_dir: Path) -> dict[str, tuple[str, int]]:
+    """
+    (sha1, num_chunks) from docs.json for every doc that has a chunk file, in chunk-file order.
+    Derived stores (BM25 index, columnar store) keep the same records to detect staleness.
+    """
+    docs_index = load_docs_index(db_dir)
+    out: dict[str, tuple[str, int]] = {}
+    for doc_id in list_chunk_doc_ids(db_dir):
+        rec = docs_index.get(doc_id) or {}
+        try:
+            num = int(rec.get("num_chunks") or 0)
+        except Exception:
+            num = 0
+        out[doc_id] = (str(rec.get("sha1") or ""), num)
+    return out
+
+
 def load_all_chunks(db_dir: Path) -> list[dict]:
     chunks: list[dict] = []
     d = _chunks_dir(db_dir)
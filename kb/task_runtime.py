@@ -19,7 +19,8 @@ from kb.bg_queue_state import (
     snapshot as bg_snapshot,
     update_page_progress as bg_update_page_progress,
 )
-from kb.chat_store import ChatStore
+from kb.chat_store import ChatStore, checkpoint_writer
+from kb.db_scope import use_db_dir
 from kb.file_ops import _resolve_md_output_paths
 from kb.llm import DeepSeekChat
 from kb.pdf_tools import run_pdf_to_md
@@ -30,8 +31,7 @@ from kb.retrieval_engine import (
     _top_heading,
 )
 from kb.retrieval_heuristics import _is_probably_bad_heading, _quick_answer_for_prompt
-from kb.store import load_all_chunks
-from kb.retriever import BM25Retriever
+from kb.retriever_registry import get_shared_retriever
 from ui.chat_widgets import _normalize_math_markdown
 from ui.strings import S
 
@@ -135,6 +135,8 @@ def _gen_store_answer(task: dict, answer: str) -> None:
     except Exception:
         amid = 0
     if amid > 0:
+        # The final text supersedes any buffered checkpoint; written synchronously.
+        checkpoint_writer().drop(chat_db, amid)
         ok = chat_store.update_message_content(amid, answer)
         if not ok:
             chat_store.append_message(conv_id, "assistant", answer)
@@ -142,8 +144,8 @@ def _gen_store_answer(task: dict, answer: str) -> None:
         chat_store.append_message(conv_id, "assistant", answer)
 
 def _gen_store_partial(task: dict, partial: str) -> None:
+    # Buffered: the checkpoint writer keeps the latest text per message and flushes in batches.
     chat_db = Path(str(task.get("chat_db") or "")).expanduser()
-    chat_store = ChatStore(chat_db)
     try:
         amid = int(task.get("assistant_msg_id") or 0)
     except Exception:
@@ -153,16 +155,19 @@ def _gen_store_partial(task: dict, partial: str) -> None:
     txt = str(partial or "").strip()
     if not txt:
         return
-    try:
-        chat_store.update_message_content(amid, txt)
-    except Exception:
-        pass
+    checkpoint_writer().put(chat_db, amid, txt)
 
 def _gen_worker(session_id: str, task_id: str) -> None:
     task = _gen_get_task(session_id) or {}
     if str(task.get("id") or "") != str(task_id or ""):
         return
+    # Disk cache / doc index lookups deep in the retrieval path follow this task's DB dir.
+    db_dir = str(task.get("db_dir") or "").strip()
+    with use_db_dir(Path(db_dir).expanduser() if db_dir else None):
+        _gen_run(session_id, task_id, task)
+
 
+def _gen_run(session_id: str, task_id: str, task: dict) -> None:
     _gen_update_task(session_id, task_id, status="running", stage="starting", started_at=time.time())
 
     try:
@@ -206,8 +211,7 @@ def _gen_worker(session_id: str, task_id: str) -> None:
             _gen_update_task(session_id, task_id, status="done", stage="done", answer=quick_answer, partial=quick_answer, char_count=len(quick_answer), finished_at=time.time())
             return
 
-        chunks = load_all_chunks(db_dir)
-        retriever = BM25Retriever(chunks)
+        retriever, _retriever_err = get_shared_retriever(db_dir)
 
         _gen_update_task(session_id, task_id, stage="retrieve")
         hits_raw, scores_raw, used_query, used_translation = _search_hits_with_fallback(
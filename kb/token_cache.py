@@ -0,0 +1,270 @@
+"""
+Tokenization cache, so a text is tokenized once over its lifetime.
+- persistent: <db>/token_cache.sqlite3, written by ingest.py
+  - vocab: term <-> int32 term id, append-only so ids stay stable across incremental runs
+  - chunk_tokens: one row per chunk (doc_id, pos, text hash) -> int32 term-id array
+- in-process: bounded LRU of term counts keyed by text hash, for the snippet and heading scorers
+"""
+
+from __future__ import annotations
+
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from types import MappingProxyType
+from typing import Iterable, Iterator, Mapping
+
+import numpy as np
+
+from .tokenize import tokenize
+
+_CACHE_VERSION = 2
+_TERM_DTYPE = "<i4"
+
+# Docs per write transaction of TokenCacheWriter: other writers wait at most one batch.
+_WRITE_BATCH_DOCS = 64
+
+_COUNTS_MAX = 8192
+_COUNTS_LOCK = threading.Lock()
+# text_hash(text) -> read-only counts; the texts themselves are not kept alive.
+_COUNTS: OrderedDict[str, Mapping[str, int]] = OrderedDict()
+
+
+def token_cache_path(db_dir: Path) -> Path:
+    return Path(db_dir) / "token_cache.sqlite3"
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha1((text or "").encode("utf-8", "ignore")).hexdigest()[:16]
+
+
+def _split_chunk_id(chunk_id: str) -> tuple[str, int] | None:
+    doc_id, _, pos = str(chunk_id or "").rpartition(":")
+    try:
+        return (doc_id, int(pos)) if doc_id else None
+    except ValueError:
+        return None
+
+
+class Vocabulary:
+    """term <-> term id. New terms get the next id; existing ids never change."""
+
+    def __init__(self, terms: list[str] | None = None) -> None:
+        self.terms: list[str] = list(terms or [])
+        self.ids: dict[str, int] = {t: i for i, t in enumerate(self.terms)}
+
+    def __len__(self) -> int:
+        return len(self.terms)
+
+    def add(self, term: str) -> int:
+        i = self.ids.get(term)
+        if i is None:
+            i = len(self.terms)
+            self.ids[term] = i
+            self.terms.append(term)
+        return i
+
+    def encode(self, tokens: list[str]) -> np.ndarray:
+        """Token list -> int32 term ids, adding unseen terms."""
+        ids = self.ids
+        out = [ids.get(t) for t in tokens]
+        if None in out:
+            add = self.add
+            out = [add(t) for t in tokens]
+        return np.array(out, dtype=np.int32)
+
+    def lookup(self, tokens: list[str]) -> list[int | None]:
+        """Token list -> term ids without adding; None for unknown terms."""
+        return [self.ids.get(t) for t in tokens]
+
+    def decode(self, ids: np.ndarray) -> list[str]:
+        terms = self.terms
+        return [terms[i] for i in ids.tolist()]
+
+
+def _load_vocab(conn: sqlite3.Connection) -> Vocabulary:
+    return Vocabulary([str(t) for (t,) in conn.execute("SELECT term FROM vocab ORDER BY id")])
+
+
+class TokenCacheWriter:
+    """
+    Ingest side. Rows are committed every _WRITE_BATCH_DOCS docs and by close().
+    Each batch is one BEGIN IMMEDIATE transaction that first picks up terms another writer
+    committed meanwhile, so two ingests never hand out the same new term id.
+    """
+
+    def __init__(self, db_dir: Path) -> None:
+        conn = sqlite3.connect(str(token_cache_path(db_dir)), timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL;")
+        if int(conn.execute("PRAGMA user_version").fetchone()[0]) != _CACHE_VERSION:
+            # Derived data only: an older layout is dropped and refilled by later ingests.
+            conn.execute("DROP TABLE IF EXISTS chunk_tokens")
+            conn.execute("DROP TABLE IF EXISTS vocab")
+            conn.execute("CREATE TABLE vocab (id INTEGER PRIMARY KEY, term TEXT NOT NULL UNIQUE)")
+            conn.execute(
+                """
+                CREATE TABLE chunk_tokens (
+                  doc_id TEXT NOT NULL,
+                  pos INTEGER NOT NULL,
+                  text_hash TEXT NOT NULL,
+                  term_ids BLOB NOT NULL,
+                  PRIMARY KEY (doc_id, pos)
+                ) WITHOUT ROWID
+                """
+            )
+            conn.execute(f"PRAGMA user_version = {_CACHE_VERSION}")
+        self._conn = conn
+        self._vocab = Vocabulary()
+        self._n_saved_terms = 0
+        self._in_batch = False
+        self._batch_docs = 0
+
+    def _begin(self) -> None:
+        if self._in_batch:
+            return
+        self._conn.execute("BEGIN IMMEDIATE")
+        # Our vocab equals what was committed at our last batch; newer ids are another writer's.
+        for _i, term in self._conn.execute("SELECT id, term FROM vocab WHERE id >= ? ORDER BY id", (len(self._vocab),)):
+            self._vocab.add(str(term))
+        self._n_saved_terms = len(self._vocab)
+        self._in_batch = True
+
+    def _commit(self) -> None:
+        if not self._in_batch:
+            return
+        terms = self._vocab.terms
+        self._conn.executemany(
+            "INSERT INTO vocab (id, term) VALUES (?, ?)",
+            ((i, terms[i]) for i in range(self._n_saved_terms, len(terms))),
+        )
+        self._conn.commit()
+        self._n_saved_terms = len(terms)
+        self._in_batch = False
+        self._batch_docs = 0
+
+    def save_doc(self, doc_id: str, chunks: list[dict], tokens: list[list[str]] | None = None) -> None:
+        """Replace one doc's rows. `tokens` (per chunk) may come precomputed from an ingest worker."""
+        self._begin()
+        if tokens is None:
+            tokens = [tokenize(c.get("text", "")) for c in chunks]
+        rows = [
+            (doc_id, pos, text_hash(c.get("text", "")), self._vocab.encode(toks).astype(_TERM_DTYPE).tobytes())
+            for pos, (c, toks) in enumerate(zip(chunks, tokens))
+        ]
+        self._conn.execute("DELETE FROM chunk_tokens WHERE doc_id = ?", (doc_id,))
+        self._conn.executemany("INSERT INTO chunk_tokens (doc_id, pos, text_hash, term_ids) VALUES (?, ?, ?, ?)", rows)
+        self._batch_docs += 1
+        if self._batch_docs >= _WRITE_BATCH_DOCS:
+            self._commit()
+
+    def prune(self, keep_doc_ids: Iterable[str]) -> int:
+        self._begin()
+        keep = set(keep_doc_ids)
+        stale = [str(r[0]) for r in self._conn.execute("SELECT DISTINCT doc_id FROM chunk_tokens") if str(r[0]) not in keep]
+        self._conn.executemany("DELETE FROM chunk_tokens WHERE doc_id = ?", ((d,) for d in stale))
+        return len(stale)
+
+    def close(self) -> None:
+        try:
+            self._commit()
+        finally:
+            self._conn.close()
+
+
+class TokenCacheReader:
+    """
+    Read side, used while building retrievers and the BM25 index.
+    Rows are fetched per doc and used only if the text hash still matches; otherwise the
+    text is tokenized again. The vocabulary starts from the cache's and grows for such misses.
+    """
+
+    def __init__(self, db_dir: Path | None) -> None:
+        self._conn: sqlite3.Connection | None = None
+        self._doc_id: str | None = None
+        self._rows: dict[int, tuple[str, bytes]] = {}
+        self.vocab = Vocabulary()
+        p = token_cache_path(db_dir) if db_dir is not None else None
+        if p is not None and p.exists():
+            try:
+                conn = sqlite3.connect(f"{p.resolve().as_uri()}?mode=ro", uri=True, timeout=30)
+                # One read transaction: vocab and rows come from the same snapshot even if ingest commits meanwhile.
+                conn.execute("BEGIN")
+                if int(conn.execute("PRAGMA user_version").fetchone()[0]) == _CACHE_VERSION:
+                    self.vocab = _load_vocab(conn)
+                    self._conn = conn
+                else:
+                    conn.close()
+            except sqlite3.Error:
+                self._conn = None
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _load(self, doc_id: str) -> None:
+        self._doc_id = doc_id
+        self._rows = {}
+        if self._conn is None:
+            return
+        try:
+            rows = self._conn.execute("SELECT pos, text_hash, term_ids FROM chunk_tokens WHERE doc_id = ?", (doc_id,)).fetchall()
+        except sqlite3.Error:
+            return
+        self._rows = {int(pos): (str(h), bytes(data)) for pos, h, data in rows}
+
+    def term_ids(self, doc_id: str | None, pos: int, text: str) -> np.ndarray:
+        if self._conn is not None and doc_id is not None:
+            if doc_id != self._doc_id:
+                self._load(doc_id)
+            row = self._rows.get(pos)
+            if row is not None and row[0] == text_hash(text):
+                return np.frombuffer(row[1], dtype=_TERM_DTYPE).astype(np.int32, copy=False)
+        return self.vocab.encode(tokenize(text))
+
+    def tokens(self, doc_id: str | None, pos: int, text: str) -> list[str]:
+        return self.vocab.decode(self.term_ids(doc_id, pos, text))
+
+    def iter_term_ids(self, chunk_ids: Iterable[str], texts: Iterable[str]) -> Iterator[np.ndarray]:
+        """Term ids for each (chunk id, text) in order."""
+        for chunk_id, text in zip(chunk_ids, texts):
+            key = _split_chunk_id(chunk_id)
+            if key is None:
+                yield self.term_ids(None, 0, text)
+            else:
+                yield self.term_ids(key[0], key[1], text)
+
+
+def _remember(key: str, counts: Mapping[str, int]) -> None:
+    with _COUNTS_LOCK:
+        _COUNTS[key] = counts
+        _COUNTS.move_to_end(key)
+        while len(_COUNTS) > _COUNTS_MAX:
+            _COUNTS.popitem(last=False)
+
+
+def remember_term_counts(text: str, counts: Mapping[str, int]) -> None:
+    """Seed the in-process cache with counts already known (e.g. BM25 term frequencies of a hit); copied."""
+    if not text:
+        return
+    _remember(text_hash(text), MappingProxyType(dict(counts)))
+
+
+def term_counts(text: str) -> Mapping[str, int]:
+    """Token -> count for `text`, as a read-only mapping shared with other callers."""
+    if not text:
+        return MappingProxyType({})
+    key = text_hash(text)
+    with _COUNTS_LOCK:
+        hit = _COUNTS.get(key)
+        if hit is not None:
+            _COUNTS.move_to_end(key)
+            return hit
+    counts: dict[str, int] = {}
+    for t in tokenize(text):
+        counts[t] = counts.get(t, 0) + 1
+    ro = MappingProxyType(counts)
+    _remember(key, ro)
+    return ro
@@ -0,0 +1,98 @@
+from __future__ import annotations
+
+import threading
+
+from kb.chat_store import ChatStore
+
+
+def _paper_hits(n: int) -> list[dict]:
+    # Same paper in every question: headings and snippets are shared ref_parts.
+    return [
+        {
+            "score": 1.0 / (n + 1),
+            "id": "doc:paper",
+            "text": "shared snippet about single-pixel imaging",
+            "meta": {
+                "source_path": "/md/paper/paper.en.md",
+                "top_heading": "Method",
+                "ref_headings": [f"Heading {i}" for i in range(40)],
+                "ref_snippets": ["shared snippet about single-pixel imaging", f"snippet only in question {n}"],
+                "ref_show_snippets": ["shared snippet about single-pixel imaging"],
+            },
+        }
+    ]
+
+
+def test_concurrent_upserts_share_parts(tmp_path):
+    db = tmp_path / "chat.sqlite3"
+    store = ChatStore(db)
+    conv_id = store.create_conversation()
+    other_conv = store.create_conversation()
+    n_threads, per_thread = 8, 25
+    msg_ids = [[store.append_message(conv_id, "user", f"q{t}-{i}") for i in range(per_thread)] for t in range(n_threads)]
+    other_ids = [store.append_message(other_conv, "user", f"o{i}") for i in range(per_thread)]
+
+    # 8 upserting threads plus one that churns refs of another conversation.
+    barrier = threading.Barrier(n_threads + 1)
+    errors: list[BaseException] = []
+
+    def upsert(t: int) -> None:
+        s = ChatStore(db)
+        barrier.wait()
+        for i, mid in enumerate(msg_ids[t]):
+            try:
+                ok = s.upsert_message_refs(
+                    user_msg_id=mid,
+                    conv_id=conv_id,
+                    prompt=f"q{t}-{i}",
+                    prompt_sig="sig",
+                    hits=_paper_hits(t * per_thread + i),
+                    scores=[1.0],
+                    used_query="",
+                    used_translation=False,
+                )
+                assert ok
+            except BaseException as e:  # noqa: BLE001
+                errors.append(e)
+
+    def churn_other() -> None:
+        # Writes and deletes refs pointing at the same parts while the upserts run.
+        s = ChatStore(db)
+        barrier.wait()
+        for i, mid in enumerate(other_ids):
+            try:
+                s.upsert_message_refs(
+                    user_msg_id=mid, conv_id=other_conv, prompt="o", prompt_sig="sig",
+                    hits=_paper_hits(10_000 + i), scores=[], used_query="", used_translation=False,
+                )
+                s.delete_message(mid)
+            except BaseException as e:  # noqa: BLE001
+                errors.append(e)
+
+    threads = [threading.Thread(target=upsert, args=(t,)) for t in range(n_threads)]
+    threads.append(threading.Thread(target=churn_other))
+    for th in threads:
+        th.start()
+    for th in threads:
+        th.join()
+
+    assert errors == []
+    refs = store.list_message_refs(conv_id)
+    assert len(refs) == n_threads * per_thread
+    for t in range(n_threads):
+        for i, mid in enumerate(msg_ids[t]):
+            assert refs[mid]["hits"] == _paper_hits(t * per_thread + i)
+
+
+def test_delete_conversation_drops_orphan_parts(tmp_path):
+    store = ChatStore(tmp_path / "chat.sqlite3")
+    conv_id = store.create_conversation()
+    mid = store.append_message(conv_id, "user", "q")
+    store.upsert_message_refs(
+        user_msg_id=mid, conv_id=conv_id, prompt="q", prompt_sig="sig",
+        hits=_paper_hits(0), scores=[1.0], used_query="", used_translation=False,
+    )
+    store.delete_conversation(conv_id)
+    with store._connect() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM ref_parts").fetchone()[0] == 0
+        assert conn.execute("SELECT COUNT(*) FROM message_ref_parts").fetchone()[0] == 0
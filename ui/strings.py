@@ -56,5 +56,9 @@ S = {
     "handled_skip": "\u5df2\u8df3\u8fc7\uff08\u672a\u4fdd\u5b58\uff09",
     "handled_saved": "\u5df2\u4fdd\u5b58",
     "handled_converted": "\u5df2\u8f6c\u6362",
+    "cache_stats": "\u7f13\u5b58\u7edf\u8ba1",
+    "load_older": "\u52a0\u8f7d\u66f4\u65e9\u7684\u6d88\u606f",
+    "search_chats": "\u641c\u7d22\u5bf9\u8bdd\u8bb0\u5f55",
+    "search_no_hits": "\u6ca1\u6709\u5339\u914d\u7684\u6d88\u606f",
     "kb_miss": "\u672c\u6b21\u672a\u547d\u4e2d\u77e5\u8bc6\u5e93\u7247\u6bb5\uff0c\u56de\u7b54\u5c06\u4e3b\u8981\u57fa\u4e8e\u6a21\u578b\u901a\u7528\u77e5\u8bc6\u3002",
 }